@@ -0,0 +1,111 @@
+"""Load time and size of the swl.cache format against the dill swl.pkl.
+
+Synthetic environments of 1k, 10k and 100k macros (and a constant for every
+tenth one) are written in both formats, then loaded, and one macro is called.
+The macros share one namespace here; the swl.pkl of a real resolve is larger
+than this, since each macro kept a copy of the namespace built before it.
+
+usage:
+    python benchmarks/cache_format.py [--sizes 1000 10000 100000] [--repeat 3]
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "swirl"))
+
+import dill  # noqa: E402
+import evaluator as evl  # noqa: E402
+import cachefile  # noqa: E402
+from data_models import make_macro  # noqa: E402
+
+logging.disable(logging.DEBUG)
+
+
+FORMULAS = [
+    (["x"], "x * {i} + 1"),
+    (["r"], "math.pi * r ** 2 + {i}"),
+    (["a", "b"], "math.sqrt(a * a + b * b) / {i}"),
+    (["n", "k=2"], "n ** k if n > {i} else n * k"),
+]
+
+
+def synthetic_env(size: int) -> dict:
+    env = dict(evl.DEFAULT_PACKAGES)
+    for i in range(1, size + 1):
+        if i % 10 == 0:
+            env[f"c{i}"] = i * 0.5
+        else:
+            variables, formula = FORMULAS[i % len(FORMULAS)]
+            parsed = evl.ParsedExpression(formula.format(i=i))
+            env[f"m{i}"] = make_macro(f"m{i}", parsed, variables, env, True, 1024)
+    return env
+
+
+def best(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(size: int, repeat: int, tmp: str) -> dict:
+    env = synthetic_env(size)
+    pkl_file = f"{tmp}/swl.pkl"
+    cache_file = f"{tmp}/swl.cache"
+
+    def dump_pkl():
+        with open(pkl_file, "wb") as pkl:
+            dill.dump(env, pkl)
+
+    def dump_cache():
+        with open(cache_file, "wb") as cache:
+            cache.write(cachefile.dump_env(env))
+
+    def load_pkl():
+        with open(pkl_file, "rb") as pkl:
+            return dill.load(pkl)
+
+    def load_cache():
+        with open(cache_file, "rb") as cache:
+            return cachefile.load_env(cache.read())
+
+    results = {"size": size}
+    for name, dump, load, file_name in (("dill", dump_pkl, load_pkl, pkl_file), ("swl.cache", dump_cache, load_cache, cache_file)):
+        results[name] = {
+            "write": best(dump, repeat),
+            "bytes": os.path.getsize(file_name),
+            "load": best(load, repeat),
+            "first call": best(lambda: load()["m1"](3), repeat),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'macros':>8} {'format':>10} {'write (s)':>10} {'size (MB)':>10} {'load (s)':>10} {'load+call (s)':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            results = measure(size, args.repeat, tmp)
+            for name in ("dill", "swl.cache"):
+                r = results[name]
+                print(
+                    f"{size:>8} {name:>10} {r['write']:>10.3f} {r['bytes'] / 1e6:>10.2f}"
+                    f" {r['load']:>10.3f} {r['first call']:>14.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
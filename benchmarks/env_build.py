@@ -0,0 +1,68 @@
+"""Build time of an environment, and size of its caches, as it grows.
+
+Synthetic environments of macros (and a constant for every tenth one),
+each macro calling the one before it, are built with Environment.build and
+written as swl.cache and as the dill swl.pkl of older versions. Both should
+grow linearly with the number of macros.
+
+usage:
+    python benchmarks/env_build.py [--sizes 1000 2000 4000 8000] [--repeat 1]
+"""
+
+import sys
+import time
+import logging
+import argparse
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "swirl"))
+
+import dill  # noqa: E402
+import cachefile  # noqa: E402
+from data_models import Environment, Macro  # noqa: E402
+
+logging.disable(logging.DEBUG)
+
+
+def synthetic_env(size: int) -> Environment:
+    macros = []
+    for i in range(1, size + 1):
+        if i % 10 == 0:
+            macros.append(Macro(f"c{i}", "owner", f"c{i}", None, f"{i} * 0.5"))
+        elif i == 1 or (i - 1) % 10 == 0:
+            macros.append(Macro(f"m{i}", "owner", f"m{i}", ["x"], f"x * {i} + 1"))
+        else:
+            macros.append(Macro(f"m{i}", "owner", f"m{i}", ["x"], f"m{i - 1}(x) % {i} + math.pi"))
+    return Environment("synthetic", macros=macros)
+
+
+def best(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000])
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'macros':>8} {'build (s)':>10} {'per macro (us)':>15} {'swl.cache (MB)':>15} {'swl.pkl (MB)':>13}")
+    for size in args.sizes:
+        env_class = synthetic_env(size)
+        build_time, env = best(env_class.build, args.repeat)
+        cache_size = len(cachefile.dump_env(env))
+        pkl_size = len(dill.dumps(env))
+        print(
+            f"{size:>8} {build_time:>10.3f} {build_time / size * 1e6:>15.1f}"
+            f" {cache_size / 1e6:>15.3f} {pkl_size / 1e6:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Time of reading an env kept as a directory of json files, serially or by
+threads, kept as a bundle and as an sqlite database: listing and reading the files (read), and
+the whole resolver.scan_env, decoding them and finding their references.
+
+Synthetic environments of macro files are written in a temporary
+directory, then packed in a bundle and in a database. The scans have no manifest, so every
+file is read and decoded, as in a first or --full resolve.
+
+usage:
+    python benchmarks/env_store.py [--sizes 1000 10000 50000] [--repeat 3]
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "swirl"))
+
+import envstore  # noqa: E402
+from resolver import scan_env  # noqa: E402
+
+logging.disable(logging.DEBUG)
+
+
+def write_env(env_path: str, size: int) -> None:
+    for i in range(size):
+        data = {"_id": f"m{i}", "owner_id": "owner", "name": f"m{i}", "variables": ["x"], "formula": f"x * {i} + 1"}
+        with open(f"{env_path}/macro.m{i}.json", "w") as json_file:
+            json.dump(data, json_file)
+
+
+def read_all(env_path: str) -> None:
+    store = envstore.open_store(env_path)
+    store.read(store.stamps())
+
+
+def best(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'':>6} {'directory (s)':>14} {'threads (s)':>12} {'bundle (s)':>11} {'sqlite (s)':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            env_path = f"{tmp}/env{size}"
+            bundle_path = f"{tmp}/env{size}.swlb"
+            Path(env_path).mkdir()
+            write_env(env_path, size)
+            db_path = f"{tmp}/env{size}.db"
+            envstore.pack(env_path, bundle_path)
+            envstore.pack(env_path, db_path)
+
+            for name, scan in (("read", read_all), ("scan", scan_env)):
+                with mock.patch.object(envstore, "SERIAL_READS", size):  # no threads
+                    serial = best(lambda: scan(env_path), args.repeat)
+                threads = best(lambda: scan(env_path), args.repeat)
+                bundle = best(lambda: scan(bundle_path), args.repeat)
+                sqlite = best(lambda: scan(db_path), args.repeat)
+                print(f"{size:>8} {name:>6} {serial:>14.3f} {threads:>12.3f} {bundle:>11.3f} {sqlite:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Per-call latency of the sample ``factorial`` macro (see macro_builder.py).
+
+Compares the precompiled macro built by ``Macro.build`` against the old way of
+calling ``simple_eval`` with the formula string, which re-parses it on every call
+(and on every level of the recursion).
+
+usage:
+    python benchmarks/macro_call.py [--num 20] [--number 2000] [--repeat 5] [--engine closure] [--memo]
+"""
+
+import sys
+import timeit
+import logging
+import argparse
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "swirl"))
+
+import evaluator as evl  # noqa: E402
+from data_models import Macro  # noqa: E402
+
+logging.disable(logging.DEBUG)
+
+
+FACTORIAL = {
+    "_id": "",
+    "owner_id": "",
+    "name": "factorial",
+    "variables": ["num"],
+    "formula": "1 if num <= 1 else num*factorial(num-1)",
+    "description": "Just my another macro",
+}
+
+
+def build_reparsing(formula: str):
+    """the macro callable as it was built before formulas were precompiled"""
+
+    env = dict(evl.DEFAULT_PACKAGES)
+    env["factorial"] = lambda num: evl.simple_eval(evl.ParsedExpression(formula), names={"num": num}, functions=env)
+    return env["factorial"]
+
+
+def per_call(func, num: int, number: int, repeat: int, engine: str) -> float:
+    """best per-call time in microseconds"""
+
+    env = {"factorial": func}
+    expr = evl.ParsedExpression(f"factorial({num})")
+    timings = timeit.repeat(lambda: evl.simple_eval(expr, functions=env, engine=engine), number=number, repeat=repeat)
+    return min(timings) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num", type=int, default=20, help="argument passed to factorial")
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="timings to take the best of")
+    parser.add_argument("--engine", choices=evl.ENGINES, default=evl.ENGINES[0], help="how the formulas are run")
+    parser.add_argument("--memo", action="store_true", help="memoize factorial (pure), off to time the calls")
+    args = parser.parse_args()
+
+    macro = Macro(**FACTORIAL, memo_size=None if args.memo else 0)
+    precompiled = macro.build(env={})
+    reparsing = build_reparsing(macro.formula)
+
+    assert precompiled(args.num) == reparsing(args.num)
+
+    before = per_call(reparsing, args.num, args.number, args.repeat, args.engine)
+    after = per_call(precompiled, args.num, args.number, args.repeat, args.engine)
+
+    print(f"factorial({args.num}), {args.num} nested macro calls per call, {args.engine} engine")
+    print(f"  re-parsing formula : {before:10.1f} us/call")
+    print(f"  precompiled        : {after:10.1f} us/call")
+    print(f"  speedup            : {before / after:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
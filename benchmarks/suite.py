@@ -0,0 +1,207 @@
+"""The benchmark suite: resolve(), Environment.build, cache load, evaluate()
+latency and throughput and the overhead of a macro call, on synthetic
+environments of growing size (see synthetic.py), written as JSON results
+that two runs are compared by.
+
+Results are keyed "<size>/<benchmark>", with their value and unit; seconds
+and microseconds are better lower, evaluations per second higher.
+
+usage:
+    python benchmarks/suite.py run [--sizes 10 1000 10000 100000] [--repeat 3] [--output results.json]
+    python benchmarks/suite.py diff old.json new.json [--threshold 0.1]
+
+diff exits with 1 if a result regressed by more than threshold (10%).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "swirl"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import cachefile  # noqa: E402
+import synthetic  # noqa: E402
+import evaluator as evl  # noqa: E402
+from resolver import create_env_class, resolve  # noqa: E402
+
+logging.disable(logging.DEBUG)
+
+
+RESULTS_VERSION = 1
+HIGHER_IS_BETTER = {"evals/s"}
+LATENCY_CALLS = 2000  # calls timed one by one for the latency percentiles
+THROUGHPUT_BATCH = 2000  # expressions of an evaluate_many batch
+
+
+def best(func: Callable, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def latencies(func: Callable, calls: int) -> List[float]:
+    """the time of each call, in microseconds"""
+
+    timings = []
+    clock = time.perf_counter_ns
+    for _ in range(calls):
+        start = clock()
+        func()
+        timings.append((clock() - start) / 1e3)
+    return timings
+
+
+def percentile(timings: List[float], fraction: float) -> float:
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def expressions(size: int) -> Dict[str, str]:
+    """the expressions timed by evaluate(), by kind"""
+
+    return {
+        "arith": "2 * 3 + 4 ** 2 - 7 / 2",
+        "math": "math.sqrt(2) * math.pi",
+        "macro": f"{synthetic.last_macro(size)}(3)",
+        "package": f"pkg{max(synthetic.DEPTHS)}.scale(2)",
+    }
+
+
+def bench_size(size: int, repeat: int, tmp: str) -> Dict[str, Tuple[float, str]]:
+    env_path, cache_path = f"{tmp}/env{size}", f"{tmp}/cache{size}"
+    Path(env_path).mkdir()
+    Path(cache_path).mkdir()
+    synthetic.write_env(env_path, size)
+    results: Dict[str, Tuple[float, str]] = dict()
+
+    # resolve: everything, nothing changed, a macro changed (and what calls it)
+    results["resolve.full"] = best(lambda: resolve(env_path, cache_path, full=True), repeat), "s"
+    results["resolve.unchanged"] = best(lambda: resolve(env_path, cache_path), repeat), "s"
+
+    def resolve_changed():
+        first = f"{env_path}/macro.m1.json"
+        data = json.loads(Path(first).read_text())
+        data["formula"] = "x * 2 + 1" if data["formula"] != "x * 2 + 1" else "x * 1 + 1"
+        Path(first).write_text(json.dumps(data))
+        resolve(env_path, cache_path)
+
+    results["resolve.changed"] = best(resolve_changed, repeat), "s"
+
+    env_class = create_env_class(env_path)
+    results["env.build"] = best(env_class.build, repeat), "s"
+    results["cache.load"] = best(lambda: cachefile.read_cache(cache_path), repeat), "s"
+
+    # evaluate(), with the environment loaded
+    session = evl.Session(cache_path)
+    exprs = expressions(size)
+    for kind, expr in exprs.items():
+        session.evaluate(expr)  # the stubs compiled
+        timings = latencies(lambda: session.evaluate(expr), LATENCY_CALLS)
+        results[f"evaluate.{kind}.p50"] = statistics.median(timings), "us"
+        results[f"evaluate.{kind}.p99"] = percentile(timings, 0.99), "us"
+
+    batch = list(exprs.values()) * (THROUGHPUT_BATCH // len(exprs))
+    seconds = best(lambda: session.evaluate_many(batch), repeat)
+    results["evaluate.throughput"] = len(batch) / seconds, "evals/s"
+
+    # a call of call<n> down to call1(x) = x, against evaluating x
+    chain = f"call{synthetic.CALLS}(3)"
+    session.evaluate(chain)
+    calls = statistics.median(latencies(lambda: session.evaluate(chain), LATENCY_CALLS))
+    constant = statistics.median(latencies(lambda: session.evaluate("3"), LATENCY_CALLS))
+    results["macro.call"] = (calls - constant) / synthetic.CALLS, "us"
+
+    return results
+
+
+def run(args) -> None:
+    report = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": dict(),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for name, (value, unit) in bench_size(size, args.repeat, tmp).items():
+                key = f"{size}/{name}"
+                report["results"][key] = {"value": value, "unit": unit}
+                print(f"{key:>32} {value:>14.3f} {unit}", flush=True)
+
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(report, results_file, indent=2)
+
+
+def compare(old: Dict, new: Dict, threshold: float) -> List[Tuple[str, float, float, float, str]]:
+    """(key, old value, new value, change, status) of the results of both"""
+
+    rows = []
+    for key in sorted(old.keys() & new.keys()):
+        before, after, unit = old[key]["value"], new[key]["value"], new[key]["unit"]
+        change = (after - before) / before if before else 0.0
+        worse = -change if unit in HIGHER_IS_BETTER else change
+
+        status = ""
+        if worse > threshold:
+            status = "REGRESSION"
+        elif worse < -threshold:
+            status = "improved"
+        rows.append((key, before, after, change, status))
+    return rows
+
+
+def diff(args) -> int:
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = json.load(old_file)["results"], json.load(new_file)["results"]
+
+    rows = compare(old, new, args.threshold)
+    for key, before, after, change, status in rows:
+        print(f"{key:>32} {before:>14.3f} {after:>14.3f} {change:>+8.1%} {status}")
+    for key in sorted(old.keys() - new.keys()):
+        print(f"{key:>32} missing in {args.new}")
+
+    regressions = sum(status == "REGRESSION" for *_, status in rows)
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000, 100000])
+    run_parser.add_argument("--repeat", type=int, default=3, help="timings to take the best of")
+    run_parser.add_argument("--output", help="the JSON file of the results")
+
+    diff_parser = commands.add_parser("diff", help="compare the results of two runs")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    diff_parser.add_argument("--threshold", type=float, default=0.1, help="the change flagged as a regression")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(diff(args))
+
+
+if __name__ == "__main__":
+    main()
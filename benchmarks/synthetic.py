@@ -0,0 +1,96 @@
+"""Synthetic environments for the benchmarks, written as env directories of
+json files (see resolver.scan_env).
+
+An environment of size macros is made of blocks of ten: a macro of x, eight
+macros each calling the one before it (and a package every fifth block),
+and a constant. Packages nest their dependencies DEPTHS deep, each level
+calling the one it depends on. Macros aren't memoized (memo_size 0), so a
+call is timed as a call.
+"""
+
+import json
+
+from typing import Dict, List
+
+
+DEPTHS = (1, 4, 16)  # the dependency depths of the packages
+BLOCK = 10
+CALLS = 10  # the depth of the call<n> chain, see call_chain
+
+
+def macro_data(name: str, variables: List[str], formula: str) -> Dict:
+    return {
+        "_id": name,
+        "owner_id": "bench",
+        "name": name,
+        "variables": variables,
+        "formula": formula,
+        "description": "",
+        "memo_size": 0,
+    }
+
+
+def package_data(name: str, depth: int) -> Dict:
+    """a package calling its dependency, itself depth - 1 deep"""
+
+    if depth <= 1:
+        macros = [macro_data("scale", ["x"], "x * 2 + 1")]
+        dependencies = []
+    else:
+        dep = f"{name}_{depth - 1}"
+        macros = [macro_data("scale", ["x"], f"{dep}.scale(x) * 2 + 1")]
+        dependencies = [package_data(dep, depth - 1)]
+
+    return {
+        "_id": name,
+        "owner_id": "bench",
+        "name": name,
+        "description": "",
+        "date_created": "",
+        "macros": macros,
+        "dependencies": dependencies,
+    }
+
+
+def macros(size: int) -> List[Dict]:
+    data = []
+    for i in range(1, size + 1):
+        block, place = divmod(i - 1, BLOCK)
+        if place == BLOCK - 1:
+            data.append(macro_data(f"c{i}", [], f"{i} * 0.5"))
+        elif place == 0:
+            data.append(macro_data(f"m{i}", ["x"], f"x * {i} + 1"))
+        elif place == 1 and block % 5 == 4:
+            depth = DEPTHS[(block // 5) % len(DEPTHS)]
+            data.append(macro_data(f"m{i}", ["x"], f"pkg{depth}.scale(m{i - 1}(x)) % {i}"))
+        else:
+            data.append(macro_data(f"m{i}", ["x"], f"m{i - 1}(x) % {i} + math.pi"))
+    return data
+
+
+def call_chain() -> List[Dict]:
+    """call<CALLS>(x) calling call<CALLS - 1>(x)... down to call1(x) = x"""
+
+    data = [macro_data("call1", ["x"], "x")]
+    for i in range(2, CALLS + 1):
+        data.append(macro_data(f"call{i}", ["x"], f"call{i - 1}(x)"))
+    return data
+
+
+def write_env(env_path: str, size: int) -> None:
+    """an env directory of size macros, the packages of DEPTHS and the call chain"""
+
+    files = {f"package.pkg{depth}.json": package_data(f"pkg{depth}", depth) for depth in DEPTHS}
+    for data in macros(size) + call_chain():
+        files[f"macro.{data['name']}.json"] = data
+
+    for file, data in files.items():
+        with open(f"{env_path}/{file}", "w") as json_file:
+            json.dump(data, json_file)
+
+
+def last_macro(size: int) -> str:
+    """the macro at the end of the last chain, calling the most macros"""
+
+    last = size - 1 if size % BLOCK == 0 else size
+    return f"m{last}" if last > 0 else "call1"
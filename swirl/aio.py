@@ -0,0 +1,369 @@
+# asyncio evaluations of a cache directory, for the services embedding swirl:
+# cheap expressions are evaluated in the event loop, the expensive ones (a big
+# tree, or more steps than INLINE_STEPS) by worker processes keeping the
+# environment loaded. Cancelling the task awaiting one stops the evaluation in
+# its worker (see evaluator.Budget), the worker is replaced if it doesn't stop.
+
+import os
+import sys
+import time
+import pickle
+import asyncio
+import logging
+import threading
+import multiprocessing
+
+from queue import SimpleQueue
+from typing import Any, Dict, List, Optional, Tuple
+
+import evaluator as evl
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+INLINE_STEPS = 10000  # steps an expression runs in the event loop, before it is sent to a worker
+INLINE_NODES = 500  # nodes of the trees sent to a worker right away
+WORKERS = os.cpu_count() or 1
+CANCEL_GRACE = 1.0  # seconds a cancelled evaluation has to stop, before its worker is replaced
+START_METHOD = "spawn"  # of the worker processes, forking the threads of the service isn't safe
+
+
+# worker process
+
+
+def worker_main(conn, cache_path: str) -> None:
+    """answer the evaluations sent on conn, one at a time, with the
+    environment of cache_path loaded once. A thread reads the requests, so
+    that a cancel stops the evaluation running (at its next lease of steps)."""
+
+    session = evl.Session(cache_path)
+    try:
+        session.load()
+    except Exception as e:
+        conn.send(("failed", None, *error_state(e)))
+        return
+    conn.send(("ready", None))
+
+    budget = evl.thread_budget()  # of this thread, the one evaluating
+    requests: SimpleQueue = SimpleQueue()
+    lock = threading.Lock()
+    running: List[Optional[int]] = [None]  # the id of the request evaluated
+    cancelled = set()  # ids cancelled before they ran
+
+    def read() -> None:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                requests.put(None)
+                return
+
+            if message[0] != "cancel":
+                requests.put(message)
+                continue
+            with lock:
+                if running[0] == message[1]:
+                    budget.cancelled = True
+                else:
+                    cancelled.add(message[1])
+
+    threading.Thread(target=read, daemon=True).start()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+
+        _, request_id, expr, engine, max_steps, timeout = request
+        with lock:
+            skip = request_id in cancelled
+            cancelled.clear()  # the others were cancelled late, a request is sent once the one before is answered
+            running[0] = None if skip else request_id
+            budget.cancelled = False
+        if skip:
+            conn.send(("cancelled", request_id))
+            continue
+
+        try:
+            with evl.limits(max_steps, timeout):
+                reply: Tuple = ("result", request_id, session.evaluate(expr, engine))
+        except Exception as e:
+            reply = ("error", request_id, *error_state(e))
+
+        with lock:
+            running[0] = None
+
+        try:
+            conn.send(reply)
+        except Exception as e:  # a result that can't be pickled
+            conn.send(("error", request_id, *error_state(RuntimeError(f"The result can't be sent back: {e}"))))
+
+
+def picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+        return True
+    except Exception:
+        return False
+
+
+def error_state(error: Exception) -> Tuple:
+    """(module, class name, args, attributes) of an exception, sent back to
+    the event loop. Its class can't always be made again from its args
+    (e.g. NameNotDefined), so rebuild_error sets them instead."""
+
+    args = error.args if picklable(error.args) else (str(error),)
+    attributes = {name: value for name, value in vars(error).items() if picklable(value)}
+    return type(error).__module__, type(error).__name__, args, attributes
+
+
+def rebuild_error(module: str, kind: str, args: Tuple, attributes: Dict[str, Any]) -> Exception:
+    """the exception raised in a worker, of its class if the event loop's
+    process has imported it (e.g. the errors of the evaluator), with its
+    args and attributes (ref, name, expression...)"""
+
+    cls = getattr(sys.modules.get(module), kind, None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        message = ": ".join(str(arg) for arg in args)
+        return RuntimeError(f"{kind}: {message}")
+
+    error = cls.__new__(cls)
+    error.args = args
+    error.__dict__.update(attributes)
+    return error
+
+
+# event loop
+
+
+class Worker(object):
+    """a worker process and its connection, read by the event loop"""
+
+    def __init__(self, pool: "AsyncEvaluator"):
+        self.pool = pool
+        self.pending: Optional[Tuple[int, asyncio.Future]] = None  # (id, future) of the request sent
+        self.closed = False
+
+        context = multiprocessing.get_context(START_METHOD)
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child, pool.cache_path), daemon=True)
+        self.process.start()
+        child.close()
+
+        pool.loop.add_reader(self.conn.fileno(), self._receive)
+
+    def submit(self, request_id: int, expr: str, engine, max_steps, timeout) -> asyncio.Future:
+        future = self.pool.loop.create_future()
+        self.pending = (request_id, future)
+        self.conn.send(("eval", request_id, expr, engine, max_steps, timeout))
+        return future
+
+    def cancel(self, request_id: int) -> None:
+        """stop the evaluation of request_id, or the worker if it doesn't within CANCEL_GRACE"""
+
+        self.conn.send(("cancel", request_id))
+        self.pool.loop.call_later(CANCEL_GRACE, self._check_stopped, request_id)
+
+    def _check_stopped(self, request_id: int) -> None:
+        if not self.closed and self.pending is not None and self.pending[0] == request_id:
+            log.warning(f"A cancelled evaluation didn't stop in {CANCEL_GRACE}s, replacing its worker")
+            self.pool.replace(self)
+
+    def _receive(self) -> None:
+        try:
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            self.pool.replace(self)  # the process died
+            return
+
+        kind, request_id = message[:2]
+        if kind == "ready":
+            self.pool.release(self)
+            return
+        if kind == "failed":
+            self.pool.failed(rebuild_error(*message[2:]))
+            return
+
+        if self.pending is None or self.pending[0] != request_id:
+            return
+        future = self.pending[1]
+        self.pending = None
+
+        if not future.done():  # not cancelled
+            if kind == "result":
+                future.set_result(message[2])
+            elif kind == "error":
+                future.set_exception(rebuild_error(*message[2:]))
+            else:
+                future.cancel()
+        self.pool.release(self)
+
+    def close(self) -> None:
+        """stop the worker process and wait for it"""
+
+        if self.closed:
+            return
+        self.closed = True
+
+        self.pool.loop.remove_reader(self.conn.fileno())
+        self.conn.close()  # an idle worker exits when it reads the end
+        if self.pending is not None:
+            self.process.kill()
+            future = self.pending[1]
+            if not future.done():
+                future.set_exception(RuntimeError("The worker evaluating the expression stopped"))
+            self.pending = None
+
+        self.process.join(CANCEL_GRACE)
+        if self.process.is_alive():  # e.g. still loading the environment
+            self.process.kill()
+            self.process.join()
+
+
+class AsyncEvaluator(object):
+    """Evaluations of a cache directory for an asyncio event loop.
+    Expressions of at most inline_nodes nodes are evaluated in the loop (in
+    the session of the cache, see evaluator.get_session), within
+    inline_steps steps. The others, and the ones running out of these
+    steps, are sent to one of the worker processes, started on first use.
+    >>> await get_async_evaluator("swirl/cache").evaluate("mk.force(40, 45)")  # doctest: +SKIP
+    1800
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        workers: int = WORKERS,
+        inline_steps: int = INLINE_STEPS,
+        inline_nodes: int = INLINE_NODES,
+        engine: Optional[str] = None,
+    ):
+        self.cache_path = cache_path
+        self.workers = workers
+        self.inline_steps = inline_steps
+        self.inline_nodes = inline_nodes
+        self.engine = engine
+
+        self.session = evl.get_session(cache_path)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._workers: List[Worker] = []
+        self._idle: Optional[asyncio.Queue] = None  # of the workers ready, None once failed
+        self._error: Optional[Exception] = None
+        self._next_id = 0
+
+    async def evaluate(
+        self, expr: str, engine: Optional[str] = None, max_steps: Optional[int] = None, timeout: Optional[float] = None
+    ) -> Any:
+        """the result of expr, raising what its evaluation raises. max_steps
+        and timeout limit it (see evaluator.limits), the time spent inline
+        counting in timeout"""
+
+        engine = engine or self.engine
+        parsed = evl.PARSE_CACHE.get(expr)
+        steps = evl.MAX_STEPS if max_steps is None else max_steps
+
+        if parsed.steps <= self.inline_nodes:
+            inline_steps = min(self.inline_steps, steps)
+            start = time.monotonic()
+            try:
+                with evl.limits(inline_steps, timeout):
+                    return self.session.evaluate(parsed, engine)  # type: ignore
+            except evl.BudgetExceeded:
+                if timeout is not None:
+                    timeout -= time.monotonic() - start
+                if inline_steps == steps or (timeout is not None and timeout <= 0):
+                    raise
+
+        return await self._offload(expr, engine, max_steps, timeout)
+
+    async def _offload(self, expr: str, engine: Optional[str], max_steps: Optional[int], timeout: Optional[float]):
+        self.start()
+        while True:
+            worker = await self._idle.get()  # type: ignore
+            if worker is None:  # failed
+                self._idle.put_nowait(None)  # type: ignore
+                raise self._error  # type: ignore
+            if not worker.closed:
+                break
+
+        self._next_id += 1
+        request_id = self._next_id
+        future = worker.submit(request_id, expr, engine, max_steps, timeout)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if worker.pending is not None and worker.pending[0] == request_id:
+                worker.cancel(request_id)
+            raise
+
+    def start(self) -> None:
+        """start the worker processes, in the running event loop (on first
+        use, or again in another event loop)"""
+
+        loop = asyncio.get_running_loop()
+        if loop is self.loop:
+            return
+        self.close()
+
+        self.loop = loop
+        self._idle = asyncio.Queue()
+        self._error = None
+        self._workers = [Worker(self) for _ in range(self.workers)]
+
+    def release(self, worker: Worker) -> None:
+        if not worker.closed:
+            self._idle.put_nowait(worker)  # type: ignore
+
+    def replace(self, worker: Worker) -> None:
+        worker.close()
+        if worker in self._workers:
+            self._workers[self._workers.index(worker)] = Worker(self)
+
+    def failed(self, error: Exception) -> None:
+        """a worker couldn't load the environment, the evaluations sent to workers raise its error"""
+
+        log.error(f"A worker couldn't start: {error}")
+        self._error = error
+        for worker in self._workers:
+            worker.close()
+        self._idle.put_nowait(None)  # type: ignore
+
+    def close(self) -> None:
+        """stop the worker processes, and wait for them"""
+
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+        self.loop = None
+
+
+_evaluators: Dict[str, AsyncEvaluator] = {}
+
+
+def get_async_evaluator(cache_path: str) -> AsyncEvaluator:
+    """the shared AsyncEvaluator of a cache directory, used by evaluate_async()"""
+
+    try:
+        return _evaluators[cache_path]
+    except KeyError:
+        return _evaluators.setdefault(cache_path, AsyncEvaluator(cache_path))
+
+
+async def evaluate_async(
+    expr: str,
+    cache_path: str,
+    engine: Optional[str] = None,
+    max_steps: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> Any:
+    return await get_async_evaluator(cache_path).evaluate(expr, engine, max_steps, timeout)
+
+
+"""
+USAGE:
+    result = await evaluate_async("mk.force(40, 45)", "swirl/cache")
+    task = asyncio.ensure_future(evaluate_async(expr, "swirl/cache", max_steps=10**8))
+    task.cancel()   :: stops the evaluation in its worker
+
+"""
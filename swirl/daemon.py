@@ -0,0 +1,216 @@
+# evaluation daemon, keeps the resolved environment warm between expressions
+# the client side only needs the standard library, so that `swirl.py --expr` starts fast
+
+import os
+import json
+import socket
+import logging
+import itertools
+import socketserver
+
+from typing import Dict, Iterable, Iterator, List, Optional
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+SOCKET_NAME = "swirl.sock"
+CLIENT_TIMEOUT = 5.0  # seconds the client waits on the daemon, before evaluating in its own process
+PIPELINE_WINDOW = 256  # requests a client sends ahead of their responses (see DaemonClient.pipeline)
+
+
+def default_socket_path(cache_path: str) -> str:
+    return cache_path + "/" + SOCKET_NAME
+
+
+# server
+
+
+class EvalHandler(socketserver.StreamRequestHandler):
+    """answers each request line with a response line, in order"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.answer(line)  # type: ignore
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class EvalServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, cache_path: str):
+        from evaluator import Session
+
+        self.session = Session(cache_path)
+        self.session.load()  # failing now if there is no cache
+        super().__init__(socket_path, EvalHandler)
+
+    def answer(self, line: bytes) -> Dict:
+        from evaluator import InvalidExpression
+
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            if "metrics" in request:
+                return {"id": request_id, "metrics": self.metrics(request["metrics"])}
+            result = self.session.evaluate(request["expr"], request.get("engine"))
+            return {"id": request_id, "result": str(result), "truthy": bool(result)}
+
+        except InvalidExpression as e:
+            return {"id": request_id, "error": type(e).__name__, "message": str(e)}
+
+        except Exception as e:
+            return {"id": request_id, "error": type(e).__name__, "message": f"Unhandled exception! {e}"}
+
+    def metrics(self, kind: str):
+        from metrics import METRICS
+
+        if kind == "prometheus":
+            return METRICS.prometheus()
+        if kind == "json":
+            return METRICS.snapshot()
+        raise ValueError(f"Unknown metrics '{kind}', use prometheus or json")
+
+
+def serve(cache_path: str, socket_path: Optional[str] = None) -> None:
+    """serve evaluations on a unix socket, until interrupted"""
+
+    socket_path = socket_path or default_socket_path(cache_path)
+
+    if os.path.exists(socket_path):
+        if connect(socket_path) is not None:
+            raise RuntimeError(f"A daemon is already listening on '{socket_path}'")
+        os.unlink(socket_path)  # left by a daemon that died
+
+    with EvalServer(socket_path, cache_path) as server:
+        log.info(f"Listening on '{socket_path}'")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+# client
+
+
+class DaemonClient:
+    """a connection to a running daemon"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self._next_id = 0
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evaluate(self, expr: str, engine: Optional[str] = None) -> Dict:
+        return self.evaluate_many([expr], engine)[0]
+
+    def evaluate_many(self, exprs: Iterable[str], engine: Optional[str] = None) -> List[Dict]:
+        """send the requests, reading the responses as they come"""
+
+        return list(self.pipeline(exprs, engine))
+
+    def metrics(self, kind: str = "prometheus"):
+        """the macro metrics of the daemon (see metrics.METRICS), as prometheus text or json"""
+
+        request = {"id": self._next_id, "metrics": kind}
+        self._next_id += 1
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("The daemon closed the connection")
+        return json.loads(line)
+
+    def pipeline(self, exprs: Iterable[str], engine: Optional[str] = None) -> Iterator[Dict]:
+        """the responses to exprs, in order. Requests are sent by batches,
+        with at most PIPELINE_WINDOW of them unanswered: the daemon writes
+        each response before reading the next request, so sending them all
+        first blocks both sides once the socket buffers are full."""
+
+        requests = iter(exprs)
+        unanswered = 0
+        sent_all = False
+
+        while not sent_all or unanswered:
+            if not sent_all:
+                wanted = PIPELINE_WINDOW - unanswered
+                batch = []
+                for expr in itertools.islice(requests, wanted):
+                    request: Dict = {"id": self._next_id, "expr": expr}
+                    if engine:
+                        request["engine"] = engine
+                    batch.append(json.dumps(request).encode() + b"\n")
+                    self._next_id += 1
+                sent_all = len(batch) < wanted
+                if batch:
+                    self.sock.sendall(b"".join(batch))
+                unanswered += len(batch)
+
+            # half the window answered before the next batch, all of it after the last one
+            while unanswered > (0 if sent_all else PIPELINE_WINDOW // 2):
+                line = self.rfile.readline()
+                if not line:
+                    raise ConnectionError("The daemon closed the connection")
+                unanswered -= 1
+                yield json.loads(line)
+
+
+def connect(socket_path: str, timeout: Optional[float] = CLIENT_TIMEOUT) -> Optional[DaemonClient]:
+    """a client of the daemon listening on socket_path, if one is running.
+    timeout: of each connect, send and read on the socket (None: no timeout)"""
+
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+        sock.close()
+        return None
+
+    return DaemonClient(sock)
+
+
+def evaluate_remote(socket_path: str, expr: str, timeout: Optional[float] = CLIENT_TIMEOUT) -> Optional[Dict]:
+    """the response of the daemon listening on socket_path to expr, None if
+    there is none, or if it doesn't answer within timeout (e.g. wedged)"""
+
+    client = connect(socket_path, timeout)
+    if client is None:
+        return None
+
+    try:
+        with client:
+            return client.evaluate(expr)
+    except (socket.timeout, ConnectionError) as e:
+        log.warning(f"The daemon on '{socket_path}' didn't answer ({e or 'timed out'}), evaluating here")
+        return None
+
+
+"""
+PARAMETERS:
+    cache_path: str   :: the cache directory of the app (read by the daemon).
+    socket_path: str  :: the unix socket, <cache_path>/swirl.sock by default.
+
+PROTOCOL (JSON lines, requests can be pipelined, responses come in order):
+    request   {"id": 0, "expr": "mk.force(40, 45)", "engine": "closure"}  (engine is optional)
+    response  {"id": 0, "result": "1800", "truthy": true}
+    error     {"id": 0, "error": "NameNotDefined", "message": "..."}
+
+"""
@@ -1,15 +1,22 @@
 import ast
-import dill as pickle
+import contextvars
+import inspect
 import operator as op
+import os
 import sys
+import threading
+import time
 import warnings
 import random
 import math
 import logging
 
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from types import FunctionType, MappingProxyType, MethodType
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
-from pathlib import Path
-from typing import Dict, Optional
+from memo import MemoizedMacro
 
 log = logging.getLogger(__name__)  # type: ignore
 
@@ -24,9 +31,16 @@ MAX_STRING_LENGTH = 100000
 MAX_COMPREHENSION_LENGTH = 10000
 MAX_POWER = 1000  # highest exponent
 MAX_SHIFT = 10000  # highest << or >> (lshift / rshift)
+MAX_STEPS = 1000000  # nodes an evaluation runs, with the macros it calls (see Budget)
+EVAL_TIMEOUT = None  # seconds an evaluation may take, None: no deadline
+BUDGET_CHECK_STEPS = 1024  # steps between the checks of the deadline
 DISALLOW_PREFIXES = ["_", "func_"]
 DISALLOW_METHODS = ["format", "format_map", "mro"]
 DEFAULT_PACKAGES = {"math": math}
+ENGINES = ("interpreter", "closure", "stack")  # how a parsed tree is run, see SimpleEval.eval
+PARSE_CACHE_SIZE = 1024  # most expressions kept parsed
+PARSE_CACHE_BYTES = 32 * 1024 * 1024  # memory budget of the parsed expressions
+CHECK_INTERVAL = 0.5  # seconds a session goes without checking its cache file (see Session.load)
 
 
 # Disallow functions:
@@ -111,6 +125,12 @@ class IterableTooLong(InvalidExpression):
     pass
 
 
+class BudgetExceeded(InvalidExpression):
+    """The evaluation ran more steps than its budget, or past its deadline."""
+
+    pass
+
+
 class AssignmentAttempted(UserWarning):
     """Assignment not allowed in SimpleEval"""
 
@@ -135,6 +155,34 @@ def safe_power(a, b):  # pylint: disable=invalid-name
     return a**b
 
 
+class Square(ast.unaryop):
+    """x ** 2, in the formulas rewritten by optimizer.py"""
+
+
+class Cube(ast.unaryop):
+    """x ** 3, in the formulas rewritten by optimizer.py"""
+
+
+def safe_square(a):  # pylint: disable=invalid-name
+    """safe_power(a, 2), multiplying integers (exact, like int ** int)"""
+
+    if type(a) is int:
+        if abs(a) > MAX_POWER:
+            raise NumberTooHigh("Sorry! I don't want to evaluate {0} ** {1}".format(a, 2))
+        return a * a
+    return safe_power(a, 2)
+
+
+def safe_cube(a):  # pylint: disable=invalid-name
+    """safe_power(a, 3), multiplying integers (exact, like int ** int)"""
+
+    if type(a) is int:
+        if abs(a) > MAX_POWER:
+            raise NumberTooHigh("Sorry! I don't want to evaluate {0} ** {1}".format(a, 3))
+        return a * a * a
+    return safe_power(a, 3)
+
+
 def safe_mult(a, b):  # pylint: disable=invalid-name
     """limit the number of times an iterable can be repeated..."""
 
@@ -191,6 +239,8 @@ DEFAULT_OPERATORS = {
     ast.Not: op.not_,
     ast.USub: op.neg,
     ast.UAdd: op.pos,
+    Square: safe_square,
+    Cube: safe_cube,
     ast.In: lambda x, y: op.contains(y, x),
     ast.NotIn: lambda x, y: not op.contains(y, x),
     ast.Is: lambda x, y: x is y,
@@ -210,6 +260,651 @@ DEFAULT_NAMES = {"True": True, "False": False, "None": None}
 
 ATTR_INDEX_FALLBACK = True
 
+# read-only views of the defaults, shared by the evaluators not given their own
+SHARED_OPERATORS = MappingProxyType(DEFAULT_OPERATORS)
+SHARED_FUNCTIONS = MappingProxyType(DEFAULT_FUNCTIONS)
+SHARED_NAMES = MappingProxyType(DEFAULT_NAMES)
+
+
+########################################
+# Parsed expressions:
+
+
+def check_functions(functions):
+    """raise if one of the functions given to an evaluator is disallowed"""
+
+    try:
+        if DISALLOW_FUNCTIONS.isdisjoint(functions.values()):
+            return
+    except TypeError:  # an unhashable value, raised by the loop below as before
+        pass
+
+    for f in functions.values():
+        if f in DISALLOW_FUNCTIONS:
+            raise FeatureNotAvailable("This function {} is a really bad idea.".format(f))
+
+
+def is_disallowed(value):
+    try:
+        return value in DISALLOW_FUNCTIONS
+    except TypeError:  # unhashable, not a function
+        return False
+
+
+class Namespace(dict):
+    """The functions (and values) of an evaluation, e.g. a resolved
+    environment, checked against DISALLOW_FUNCTIONS as they are put in,
+    so that an evaluator given one trusts it instead of scanning it.
+    >>> SimpleEval(functions=Namespace(double=lambda x: x * 2)).eval("double(4)")
+    8
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if is_disallowed(value):
+            raise FeatureNotAvailable("This function {} is a really bad idea.".format(value))
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and isinstance(args[0], Namespace):
+            super().update(args[0])  # checked already
+            return
+
+        items = dict(*args, **kwargs)
+        for value in items.values():
+            if is_disallowed(value):
+                raise FeatureNotAvailable("This function {} is a really bad idea.".format(value))
+        super().update(items)
+
+    def copy(self):
+        return Namespace(self)
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        namespace = self.copy()
+        namespace.update(other)
+        return namespace
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+def check_attribute(attr):
+    """raise if an attribute name must never be reached from an expression"""
+
+    for prefix in DISALLOW_PREFIXES:
+        if attr.startswith(prefix):
+            raise FeatureNotAvailable(
+                "Sorry, access to __attributes " " or func_ attributes is not available. " "({0})".format(attr)
+            )
+    if attr in DISALLOW_METHODS:
+        raise FeatureNotAvailable("Sorry, this method is not available. " "({0})".format(attr))
+
+
+class ParsedExpression(object):
+    """An expression that is parsed and checked once, so it can be
+    evaluated many times without going through ``ast.parse`` again.
+    >>> p = ParsedExpression("20 + 30 - ( 10 * 5)")
+    >>> SimpleEval().eval(p)
+    0
+    """
+
+    __slots__ = ("expr", "_node", "steps", "plans", "transform")
+
+    def __init__(self, expr, lazy=False, transform=None):
+        """lazy: parse and check it on first use (for formulas checked before)
+        transform: a function of the checked tree giving the tree evaluated
+        (e.g. optimizer.optimize)"""
+
+        self.expr = expr
+        self._node = None
+        self.steps = 0  # the nodes of the tree evaluated, see SimpleEval.eval
+        self.plans = {}
+        self.transform = transform
+
+        if not lazy:
+            self._parse()
+
+    def _parse(self):
+        node = ast.parse(self.expr.strip()).body[0]
+
+        for child in ast.walk(node):
+            if isinstance(child, ast.Attribute):
+                check_attribute(child.attr)
+            elif isinstance(child, (ast.Import, ast.ImportFrom)):
+                raise FeatureNotAvailable("Sorry, 'import' is not allowed.")
+
+        if self.transform is not None:
+            node = self.transform(node)
+
+        self.steps = sum(1 for _ in ast.walk(node))
+        self._node = node
+
+    @property
+    def node(self):
+        if self._node is None:
+            self._parse()
+        return self._node
+
+    def __repr__(self):
+        return "ParsedExpression({0!r})".format(self.expr)
+
+    def __getstate__(self):
+        # compiled plans are closures, they are rebuilt on first use instead
+        return self.expr, self._node
+
+    def __setstate__(self, state):
+        self.expr, self._node = state
+        self.steps = 0 if self._node is None else sum(1 for _ in ast.walk(self._node))  # or set by _parse
+        self.plans = {}
+        self.transform = None
+
+    def plan(self, evaluator):
+        """the closure compiled for this kind of evaluator, compiled on first use"""
+
+        try:
+            return self.plans[type(evaluator)]
+        except KeyError:
+            plan = self.plans[type(evaluator)] = evaluator.compile(self.node, checked=True)
+            return plan
+
+    def program(self, evaluator):
+        """the instructions assembled for this kind of evaluator (see
+        run_program), assembled on first use"""
+
+        key = (type(evaluator), "stack")
+        try:
+            return self.plans[key]
+        except KeyError:
+            program = self.plans[key] = evaluator.assemble(self.node, checked=True)
+            return program
+
+    def size(self):
+        """rough memory used by the parsed tree, in bytes"""
+
+        total = sys.getsizeof(self.expr)
+        for node in ast.walk(self.node):
+            total += sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+        return total
+
+
+ParseCacheInfo = namedtuple("ParseCacheInfo", ["hits", "misses", "maxsize", "currsize", "bytes", "max_bytes"])
+
+
+class ParseCache(object):
+    """A bounded LRU cache of expression text to its ParsedExpression, so a
+    repeated expression is parsed and checked once.
+    Least recently used entries are evicted once there are more than maxsize
+    of them, or once they use more than max_bytes.
+    >>> cache = ParseCache(maxsize=2)
+    >>> cache.get("1 + 1") is cache.get("1 + 1")
+    True
+    >>> cache.info().hits
+    1
+    """
+
+    def __init__(self, maxsize=PARSE_CACHE_SIZE, max_bytes=PARSE_CACHE_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+        self._entries = OrderedDict()  # expr -> (parsed, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, expr):
+        """the parsed (and checked) expression, parsing it on a miss"""
+
+        with self._lock:
+            try:
+                parsed, _ = self._entries[expr]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(expr)
+                return parsed
+
+        # parsing outside the lock, errors are raised and not cached.
+        parsed = ParsedExpression(expr)
+        size = parsed.size()
+
+        with self._lock:
+            if expr not in self._entries and size <= self.max_bytes:
+                self._entries[expr] = (parsed, size)
+                self.bytes += size
+                self._evict()
+
+        return parsed
+
+    def configure(self, maxsize=None, max_bytes=None):
+        """change the limits, evicting what doesn't fit anymore"""
+
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.bytes = 0
+
+    def info(self):
+        return ParseCacheInfo(self.hits, self.misses, self.maxsize, len(self._entries), self.bytes, self.max_bytes)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.maxsize or self.bytes > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+
+
+# top-level expressions given as text, see SimpleEval.eval
+PARSE_CACHE = ParseCache()
+
+
+# the engine of the evaluation in progress, so macros called from an
+# expression are run the same way as the expression itself.
+_engine = contextvars.ContextVar("engine", default=ENGINES[0])
+
+
+########################################
+# Budget:
+
+
+class Budget(object):
+    """The steps (nodes evaluated) and the deadline of the evaluation
+    running in a thread, shared by the macros it calls (see thread_budget).
+
+    Each evaluator leases steps from it and counts them down: the nodes of
+    a tree at once (see SimpleEval._run), then each iteration of its
+    comprehensions, leasing BUDGET_CHECK_STEPS at a time for those. It gives
+    back what it didn't run when it ends, the steps leased count as run
+    until then. The deadline is checked on each lease, and whether it was
+    cancelled (by another thread, see aio.worker_main).
+    """
+
+    __slots__ = ("max_steps", "left", "deadline", "depth", "cancelled")
+
+    def __init__(self):
+        self.max_steps = self.left = 0
+        self.deadline = None
+        self.depth = 0  # the evaluations running, a macro call runs one
+        self.cancelled = False  # until reset by whoever cancelled it
+
+    def start(self):
+        """the budget of a top-level evaluation, its first lease"""
+
+        max_steps, timeout = _limits.get()
+        self.max_steps = steps = MAX_STEPS if max_steps is None else max_steps
+        if timeout is None:
+            timeout = EVAL_TIMEOUT
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+
+        # enough for most trees, but a small part of it: the macros called lease the rest
+        first = steps >> 4
+        if first > BUDGET_CHECK_STEPS:
+            first = BUDGET_CHECK_STEPS
+        self.left = steps - first
+        return first
+
+    def lease(self, needed, chunk=0):
+        """needed steps, or chunk if more are left, raising BudgetExceeded
+        if there are fewer than needed"""
+
+        if self.cancelled:
+            raise BudgetExceeded("Sorry, this evaluation was cancelled.")
+
+        left = self.left
+        if needed > left:
+            self.left = 0
+            raise BudgetExceeded("Sorry, this evaluation takes more than {0} steps.".format(self.max_steps))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded("Sorry, this evaluation takes too long.")
+
+        steps = chunk if needed < chunk else needed
+        if steps > left:
+            steps = left
+        self.left = left - steps
+        return steps
+
+
+_budgets = threading.local()
+
+
+def thread_budget():
+    """the budget of the evaluations of this thread: they run one in the
+    other (the macros called), not side by side, even in asyncio tasks"""
+
+    try:
+        return _budgets.budget
+    except AttributeError:
+        budget = _budgets.budget = Budget()
+        return budget
+
+
+# (max_steps, timeout) of the evaluations in progress, see limits()
+_limits = contextvars.ContextVar("limits", default=(None, None))
+
+
+@contextmanager
+def limits(max_steps=None, timeout=None):
+    """the budget of each top-level evaluation in this context, instead
+    of MAX_STEPS and EVAL_TIMEOUT
+    >>> with limits(max_steps=10):  # doctest: +SKIP
+    ...     simple_eval("1 + 2")
+    """
+
+    token = _limits.set((max_steps, timeout))
+    try:
+        yield
+    finally:
+        _limits.reset(token)
+
+
+def iteration_steps(node):
+    """the steps of an iteration of each generator of a comprehension: its
+    conditions, then the next iterable or the element (the tree is charged
+    once, see SimpleEval.eval, its iterations are charged here)"""
+
+    steps = []
+    for gi, generator in enumerate(node.generators):
+        parts = list(generator.ifs)
+        parts.append(node.generators[gi + 1].iter if gi + 1 < len(node.generators) else node.elt)
+        steps.append(sum(1 for part in parts for _ in ast.walk(part)))
+    return steps
+
+
+########################################
+# Profiling:
+
+
+NodeStats = namedtuple("NodeStats", ["count", "total_time", "self_time"])
+
+
+class ProfileReport(object):
+    """The nodes evaluated, by kind: their count and times in seconds,
+    total_time with the nodes under them, self_time without. Kinds are the
+    node types, with their operator (BinOp.Mult) or the function called
+    (Call.mk.force), so the self time of a call is its overhead: the time
+    of the nodes of the macro called is theirs.
+    """
+
+    def __init__(self, nodes: Dict[str, NodeStats], total_time: float):
+        self.nodes = nodes
+        self.total_time = total_time
+
+    def __repr__(self):
+        return "ProfileReport({0} kinds of nodes, {1:.1f} us)".format(len(self.nodes), self.total_time * 1e6)
+
+    def as_dict(self) -> Dict:
+        return {
+            "total_time": self.total_time,
+            "nodes": {kind: stats._asdict() for kind, stats in self.nodes.items()},
+        }
+
+    def __str__(self):
+        lines = ["{0:<32} {1:>8} {2:>12} {3:>12}".format("node", "count", "total (us)", "self (us)")]
+        for kind, stats in sorted(self.nodes.items(), key=lambda item: -item[1].self_time):
+            lines.append(
+                "{0:<32} {1:>8} {2:>12.1f} {3:>12.1f}".format(
+                    kind, stats.count, stats.total_time * 1e6, stats.self_time * 1e6
+                )
+            )
+        lines.append("total: {0:.1f} us".format(self.total_time * 1e6))
+        return "\n".join(lines)
+
+
+ProfiledResult = namedtuple("ProfiledResult", ["result", "report"])
+
+
+def node_kind(node):
+    kind = type(node).__name__
+    if isinstance(node, (ast.UnaryOp, ast.BinOp, ast.BoolOp)):
+        return "{0}.{1}".format(kind, type(node.op).__name__)
+    if isinstance(node, ast.Compare):
+        return "{0}.{1}".format(kind, ",".join(type(operation).__name__ for operation in node.ops))
+    if isinstance(node, ast.Call) and isinstance(node.func, (ast.Name, ast.Attribute)):
+        return "{0}.{1}".format(kind, ast.unparse(node.func))
+    return kind
+
+
+class Profile(object):
+    """The engine of a profiled evaluation (see SimpleEval.profile): set as
+    the engine, it is the one of the macros called too, and runs the trees
+    with the interpreter and a dispatch table timing each node. Evaluations
+    that aren't profiled don't check for it.
+    """
+
+    def __init__(self):
+        self.stats: Dict[str, List] = {}  # kind -> [count, total, self (ns), nodes running]
+        self._kinds: Dict[ast.AST, str] = {}
+        self._children = [0]  # the time of the children of the nodes being run (ns)
+
+    def run(self, evaluator, node):
+        # the evaluator as its profiled class for the evaluation, the
+        # handlers call _eval for their children, which times them too
+        cls = type(evaluator)
+        evaluator.__class__ = profiled_class(cls)
+        try:
+            return evaluator._eval(node)
+        finally:
+            evaluator.__class__ = cls
+
+    def time(self, handler, evaluator, node):
+        kind = self._kinds.get(node)
+        if kind is None:
+            kind = self._kinds[node] = node_kind(node)
+        stats = self.stats.get(kind)
+        if stats is None:
+            stats = self.stats[kind] = [0, 0, 0, 0]  # count, total, self, running
+
+        children = self._children
+        children.append(0)
+        stats[3] += 1
+        start = time.perf_counter_ns()
+        try:
+            return handler(evaluator, node)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            stats[3] -= 1
+            children[-2] += elapsed
+            stats[0] += 1
+            stats[2] += elapsed - children.pop()
+            if not stats[3]:
+                stats[1] += elapsed  # a node in a node of its kind is in its total already
+
+    def report(self) -> ProfileReport:
+        nodes = {kind: NodeStats(count, total / 1e9, own / 1e9) for kind, (count, total, own, _) in self.stats.items()}
+        return ProfileReport(nodes, self._children[0] / 1e9)
+
+
+def timed(handler):
+    def run(evaluator, node):
+        return _engine.get().time(handler, evaluator, node)
+
+    return run
+
+
+# evaluator class -> its subclass dispatching to timed handlers
+_profiled_classes: Dict[type, type] = {}
+
+
+def profiled_class(cls):
+    try:
+        return _profiled_classes[cls]
+    except KeyError:
+        pass
+
+    profiled = type("Profiled" + cls.__name__, (cls,), {"__slots__": ()})
+    profiled._dispatch = MappingProxyType({node_type: timed(handler) for node_type, handler in cls._dispatch.items()})
+    return _profiled_classes.setdefault(cls, profiled)
+
+
+########################################
+# The stack engine:
+#
+# A tree is assembled once into a list of instructions (see
+# SimpleEval.assemble), functions of the evaluator and the stack of values,
+# run one after the other by run_program. The calls of macros don't call
+# them, their formulas are run by the same loop on a stack of frames: the
+# depth of the macros calling each other is limited by the step budget,
+# instead of the Python stack (other functions are still called).
+
+
+class MacroCall(object):
+    """returned by the call instruction of a macro: the frame to run"""
+
+    __slots__ = ("formula", "env", "names", "memo", "key")
+
+    def __init__(self, formula, env, names, memo=None, key=None):
+        self.formula = formula
+        self.env = env
+        self.names = names
+        self.memo = memo  # the MemoizedMacro storing the result, with key
+        self.key = key
+
+
+RETURN = object()  # returned by the last instruction of a program
+
+_CALL_KINDS = {FunctionType: "function", MemoizedMacro: "memo"}
+
+
+def call_kind(cls):
+    """how the call instruction calls a callable of this class: "function"
+    (a macro, if it has a formula), "memo", "stub" (a stubs.MacroStub, to
+    make first) or "plain" (called, e.g. the macros measured by metrics)"""
+
+    try:
+        return _CALL_KINDS[cls]
+    except KeyError:
+        kind = _CALL_KINDS[cls] = "stub" if callable(getattr(cls, "materialize", None)) else "plain"
+        return kind
+
+
+def macro_binder(func):
+    """a function taking the arguments as the lambda of a macro does (see
+    data_models.macro_source), and giving the names of its formula. None for
+    the lambdas with *args, **kwargs or keyword-only arguments"""
+
+    try:
+        return func.binder
+    except AttributeError:
+        pass
+
+    code = func.__code__
+    binder = None
+    if not code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS) and not code.co_kwonlyargcount:
+        params = code.co_varnames[: code.co_argcount]  # identifiers, the ones of the lambda
+        source = "lambda {0}: {{{1}}}".format(", ".join(params), ", ".join("{0!r}: {0}".format(p) for p in params))
+        template = eval(source, {"__builtins__": {}})
+        # its name and defaults, so arguments are checked, and errors are, the same:
+        binder = FunctionType(template.__code__, {}, code.co_name, func.__defaults__)
+
+    func.binder = binder
+    return binder
+
+
+def call_function(func, args, kwargs, values):
+    """call func with args (and kwargs, or None) pushing the result on
+    values, or the MacroCall of the frame to run if it is a macro"""
+
+    kind = call_kind(func.__class__)
+    if kind == "stub":
+        func = func.materialize()
+        kind = call_kind(func.__class__)
+
+    macro, memo, key = func, None, None
+    if kind == "memo":
+        key = func.key(args, kwargs)
+        try:
+            values.append(func.lookup(key))
+            return None
+        except KeyError:
+            memo = func
+        except TypeError:  # unhashable arguments, not memoized
+            key = None
+        macro = func.func
+        kind = call_kind(macro.__class__)
+
+    if kind == "function":
+        formula = macro.__dict__.get("formula")
+        if formula.__class__ is ParsedExpression:
+            binder = macro_binder(macro)
+            if binder is not None:
+                names = binder(*args, **kwargs) if kwargs else binder(*args)
+                return MacroCall(formula, macro.env, names, memo, key)
+
+    values.append(func(*args, **kwargs) if kwargs else func(*args))
+    return None
+
+
+def run_program(evaluator, program):
+    """run the instructions of a tree with evaluator, and the macros called
+    on frames of their own. Steps are charged to evaluator: the nodes of
+    the formula of each macro called (see SimpleEval._run)"""
+
+    values = []
+    frames = []  # (program, pc, evaluator, memo, key) to return to
+    s = evaluator
+    pc = 0
+    scopes = len(evaluator._scopes)
+
+    try:
+        while True:
+            r = program[pc](s, values)
+            pc += 1
+            if r is None:
+                continue
+            if r.__class__ is int:  # a jump
+                pc = r
+                continue
+
+            if r is RETURN:
+                if not frames:
+                    return values.pop()
+                program, pc, s, memo, key = frames.pop()
+                if memo is not None:
+                    memo.store(key, values[-1])
+                continue
+
+            # a macro call, as its lambda would: SimpleEval(functions=env, names=...).eval(formula)
+            formula = r.formula
+            evaluator._steps_left -= formula.steps
+            if evaluator._steps_left < 0:
+                evaluator._lease(BUDGET_CHECK_STEPS)
+
+            frames.append((program, pc, s, r.memo, r.key))
+            s = SimpleEval(functions=r.env, names=r.names)
+            s.expr = formula.expr
+            s._checked = True
+            s._budget = evaluator._budget
+            s._steps_left = 0
+            program = formula.program(s)
+            pc = 0
+
+    except BaseException:
+        del evaluator._scopes[scopes:]  # of the comprehensions left
+        raise
+
 
 ########################################
 # And the actual evaluator:
@@ -222,91 +917,192 @@ class SimpleEval(object):  # pylint: disable=too-few-public-methods
     0
     """
 
-    expr = ""
+    # the handler of each kind of node, by method name so that subclasses
+    # overriding a handler are dispatched to it. The dispatch table of a class
+    # is made once (see _dispatch_table) and shared by all its instances.
+    NODE_HANDLERS = {
+        ast.Expr: "_eval_expr",
+        ast.Assign: "_eval_assign",
+        ast.AugAssign: "_eval_aug_assign",
+        ast.Import: "_eval_import",
+        ast.Num: "_eval_num",
+        ast.Str: "_eval_str",
+        ast.Name: "_eval_name",
+        ast.UnaryOp: "_eval_unaryop",
+        ast.BinOp: "_eval_binop",
+        ast.BoolOp: "_eval_boolop",
+        ast.Compare: "_eval_compare",
+        ast.IfExp: "_eval_ifexp",
+        ast.Call: "_eval_call",
+        ast.keyword: "_eval_keyword",
+        ast.Subscript: "_eval_subscript",
+        ast.Attribute: "_eval_attribute",
+        ast.Index: "_eval_index",
+        ast.Slice: "_eval_slice",
+    }
+
+    # py3k stuff:
+    if hasattr(ast, "NameConstant"):
+        NODE_HANDLERS[ast.NameConstant] = "_eval_constant"
+
+    # py3.6, f-strings
+    if hasattr(ast, "JoinedStr"):
+        NODE_HANDLERS[ast.JoinedStr] = "_eval_joinedstr"  # f-string
+        NODE_HANDLERS[ast.FormattedValue] = "_eval_formattedvalue"  # formatted value in f-string
+
+    # py3.8 uses ast.Constant instead of ast.Num, ast.Str, ast.NameConstant
+    if hasattr(ast, "Constant"):
+        NODE_HANDLERS[ast.Constant] = "_eval_constant"
+
+    # an evaluator is only the state of an evaluation, it is made for each
+    # top-level expression and macro call:
+    __slots__ = (
+        "operators",
+        "functions",
+        "names",
+        "expr",
+        "ATTR_INDEX_FALLBACK",  # ATTR_INDEX_FALLBACK by default, can be set per evaluator
+        "_checked",  # whether the attributes of the tree being run were checked when parsed
+        "_scopes",  # names of the comprehensions being run
+        "_max_count",
+        "_compile_scopes",
+        "_compile_checked",
+        "_budget",  # of the thread, see Budget
+        "_steps_left",  # the steps leased from it
+        "__dict__",  # the attributes set by callers, made when one is
+    )
 
     def __init__(self, operators=None, functions=None, names=None):
         """
         Create the evaluator instance.  Set up valid operators (+,-, etc)
-        functions (add, random, get_val, whatever) and names."""
+        functions (add, random, get_val, whatever) and names.
+        Not given, they are the (read-only) defaults."""
 
-        if not operators:
-            operators = DEFAULT_OPERATORS.copy()
-        if not functions:
-            functions = DEFAULT_FUNCTIONS.copy()
-        if not names:
-            names = DEFAULT_NAMES.copy()
+        self.operators = operators or SHARED_OPERATORS
+        self.functions = functions or SHARED_FUNCTIONS
+        self.names = names or SHARED_NAMES
 
-        self.operators = operators
-        self.functions = functions
-        self.names = names
+        self.expr = ""
+        self.ATTR_INDEX_FALLBACK = ATTR_INDEX_FALLBACK
+        self._checked = False
+        self._scopes = []
 
-        self.nodes = {
-            ast.Expr: self._eval_expr,
-            ast.Assign: self._eval_assign,
-            ast.AugAssign: self._eval_aug_assign,
-            ast.Import: self._eval_import,
-            ast.Num: self._eval_num,
-            ast.Str: self._eval_str,
-            ast.Name: self._eval_name,
-            ast.UnaryOp: self._eval_unaryop,
-            ast.BinOp: self._eval_binop,
-            ast.BoolOp: self._eval_boolop,
-            ast.Compare: self._eval_compare,
-            ast.IfExp: self._eval_ifexp,
-            ast.Call: self._eval_call,
-            ast.keyword: self._eval_keyword,
-            ast.Subscript: self._eval_subscript,
-            ast.Attribute: self._eval_attribute,
-            ast.Index: self._eval_index,
-            ast.Slice: self._eval_slice,
-        }
+        # Check for forbidden functions (a Namespace was, when filled):
 
-        # py3k stuff:
-        if hasattr(ast, "NameConstant"):
-            self.nodes[ast.NameConstant] = self._eval_constant
+        if functions and not isinstance(functions, Namespace):
+            check_functions(functions)
 
-        # py3.6, f-strings
-        if hasattr(ast, "JoinedStr"):
-            self.nodes[ast.JoinedStr] = self._eval_joinedstr  # f-string
-            self.nodes[ast.FormattedValue] = self._eval_formattedvalue  # formatted value in f-string
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = cls._dispatch_table()
 
-        # py3.8 uses ast.Constant instead of ast.Num, ast.Str, ast.NameConstant
-        if hasattr(ast, "Constant"):
-            self.nodes[ast.Constant] = self._eval_constant
+    @classmethod
+    def _dispatch_table(cls):
+        return MappingProxyType({node_type: getattr(cls, name) for node_type, name in cls.NODE_HANDLERS.items()})
 
-        # Defaults:
+    @property
+    def nodes(self):
+        """the handler of each kind of node, bound to this evaluator
+        (read-only: handlers are overridden in a subclass, see NODE_HANDLERS)"""
 
-        self.ATTR_INDEX_FALLBACK = ATTR_INDEX_FALLBACK
+        return MappingProxyType({node_type: MethodType(handler, self) for node_type, handler in self._dispatch.items()})
 
-        # Check for forbidden functions:
+    def eval(self, expr, engine=None):
+        """evaluate an expresssion, using the operators, functions and
+        names previously set up.
 
-        for f in self.functions.values():
-            if f in DISALLOW_FUNCTIONS:
-                raise FeatureNotAvailable("This function {} is a really bad idea.".format(f))
+        engine is one of ENGINES: "interpreter" walks the tree node by node,
+        "closure" compiles it once into nested closures and calls those,
+        "stack" assembles it into instructions run by a loop, with the
+        macros called (see run_program).
+        By default, the engine of the calling expression is used.
 
-    def __del__(self):
-        self.nodes = None
+        The evaluation, with the macros it calls, runs at most MAX_STEPS
+        nodes (and EVAL_TIMEOUT seconds), or the ones of limits()."""
 
-    def eval(self, expr):
-        """evaluate an expresssion, using the operators, functions and
-        names previously set up."""
+        try:
+            budget = _budgets.budget
+        except AttributeError:
+            budget = thread_budget()
+        # a top-level evaluation starts the budget, the macros it calls share it
+        self._steps_left = 0 if budget.depth else budget.start()
+        self._budget = budget
+        budget.depth += 1
+
+        try:
+            current = _engine.get()
+            if engine is None or engine == current:
+                return self._run(expr, current)
+
+            if engine not in ENGINES:
+                raise ValueError("Unknown engine '{0}', use one of {1}".format(engine, ", ".join(ENGINES)))
+
+            token = _engine.set(engine)
+            try:
+                return self._run(expr, engine)
+            finally:
+                _engine.reset(token)
+
+        finally:
+            budget.left += self._steps_left  # the steps leased and not run
+            budget.depth -= 1
+
+    def _lease(self, chunk=0):
+        # _steps_left went below 0, more steps from the budget (none if it raises)
+        steps_left, self._steps_left = self._steps_left, 0
+        self._steps_left = steps_left + self._budget.lease(-steps_left, chunk)
+
+    def _run(self, expr, engine):
+        # macro formulas are parsed at build time, text is parsed (once) here:
+
+        parsed = expr if isinstance(expr, ParsedExpression) else PARSE_CACHE.get(expr)
 
         # set a copy of the expression aside, so we can give nice errors...
 
-        self.expr = expr
+        self.expr = parsed.expr
+        self._checked = True
+
+        # charge the budget with every node of the tree at once (a node runs
+        # once but in comprehensions, which charge their iterations):
+        node = parsed.node
+        self._steps_left -= parsed.steps
+        if self._steps_left < 0:
+            self._lease()
 
         # and evaluate:
-        return self._eval(ast.parse(expr.strip()).body[0])
+        if engine == "closure":
+            return parsed.plan(self)(self)
+        if engine == "interpreter":
+            return self._eval(node)
+        if engine == "stack":
+            return run_program(self, parsed.program(self))
+        return engine.run(self, node)  # a Profile, see profile()
+
+    def profile(self, expr):
+        """evaluate an expression, timing the nodes evaluated, and the ones
+        of the macros it calls (with the interpreter): a ProfiledResult of
+        the result and its ProfileReport.
+        >>> SimpleEval().profile("2 * 3").report.nodes["BinOp.Mult"].count
+        1
+        """
+
+        profile = Profile()
+        token = _engine.set(profile)
+        try:
+            result = self.eval(expr)
+        finally:
+            _engine.reset(token)
+        return ProfiledResult(result, profile.report())
 
     def _eval(self, node):
         """The internal evaluator used on each node in the parsed tree."""
 
         try:
-            handler = self.nodes[type(node)]
+            handler = self._dispatch[type(node)]
         except KeyError:
             raise FeatureNotAvailable("Sorry, {0} is not available in this " "evaluator".format(type(node).__name__))
 
-        return handler(node)
+        return handler(self, node)
 
     def _eval_expr(self, node):
         return self._eval(node.value)
@@ -328,12 +1124,10 @@ class SimpleEval(object):  # pylint: disable=too-few-public-methods
     def _eval_import(self, node):
         raise FeatureNotAvailable("Sorry, 'import' is not allowed.")
 
-    @staticmethod
-    def _eval_num(node):
+    def _eval_num(self, node):
         return node.n
 
-    @staticmethod
-    def _eval_str(node):
+    def _eval_str(self, node):
         if len(node.s) > MAX_STRING_LENGTH:
             raise IterableTooLong(
                 "String Literal in statement is too long!"
@@ -341,8 +1135,7 @@ class SimpleEval(object):  # pylint: disable=too-few-public-methods
             )
         return node.s
 
-    @staticmethod
-    def _eval_constant(node):
+    def _eval_constant(self, node):
         if hasattr(node.value, "__len__") and len(node.value) > MAX_STRING_LENGTH:
             raise IterableTooLong(
                 "Literal in statement is too long!" " ({0}, when {1} is max)".format(len(node.value), MAX_STRING_LENGTH)
@@ -437,13 +1230,8 @@ class SimpleEval(object):  # pylint: disable=too-few-public-methods
             raise
 
     def _eval_attribute(self, node):
-        for prefix in DISALLOW_PREFIXES:
-            if node.attr.startswith(prefix):
-                raise FeatureNotAvailable(
-                    "Sorry, access to __attributes " " or func_ attributes is not available. " "({0})".format(node.attr)
-                )
-        if node.attr in DISALLOW_METHODS:
-            raise FeatureNotAvailable("Sorry, this method is not available. " "({0})".format(node.attr))
+        if not self._checked:
+            check_attribute(node.attr)
         # eval node
         node_evaluated = self._eval(node.value)
 
@@ -492,6 +1280,647 @@ class SimpleEval(object):  # pylint: disable=too-few-public-methods
             return fmt.format(self._eval(node.value))
         return self._eval(node.value)
 
+    ########################################
+    # The closure engine:
+    #
+    # Each _compile_<x> mirrors _eval_<x>, but does the dispatch once and
+    # returns a closure taking the evaluator (for names, functions, operators
+    # and the expression). Running an expression is then a call of the root
+    # closure, and the checks happen at the same point as in the interpreter,
+    # so results and exceptions are the same.
+
+    def compile(self, node, checked=False):
+        """compile a parsed tree into a closure, run with closure(evaluator).
+        checked trees (see ParsedExpression) skip the attribute checks."""
+
+        self._compile_scopes = 0
+        self._compile_checked = checked
+        return self._compile(node)
+
+    def _compile(self, node):
+        try:
+            handler_name = self.NODE_HANDLERS[type(node)]
+        except KeyError:
+            message = "Sorry, {0} is not available in this " "evaluator".format(type(node).__name__)
+
+            def unavailable(s):
+                raise FeatureNotAvailable(message)
+
+            return unavailable
+
+        compiler = getattr(self, handler_name.replace("_eval_", "_compile_", 1), None)
+        if compiler is None:
+            # no closure for this node, interpret it:
+            return lambda s: s._eval(node)
+
+        return compiler(node)
+
+    def _compile_expr(self, node):
+        return self._compile(node.value)
+
+    def _compile_assign(self, node):
+        value = self._compile(node.value)
+
+        def assign(s):
+            warnings.warn(
+                "Assignment ({}) attempted, but this is ignored".format(s.expr),
+                AssignmentAttempted,
+            )
+            return value(s)
+
+        return assign
+
+    _compile_aug_assign = _compile_assign
+
+    def _compile_import(self, node):
+        def import_(s):
+            raise FeatureNotAvailable("Sorry, 'import' is not allowed.")
+
+        return import_
+
+    def _compile_constant(self, node):
+        value = node.value
+
+        if not hasattr(value, "__len__"):
+            return lambda s: value
+
+        def constant(s):
+            if len(value) > MAX_STRING_LENGTH:
+                raise IterableTooLong(
+                    "Literal in statement is too long!" " ({0}, when {1} is max)".format(len(value), MAX_STRING_LENGTH)
+                )
+            return value
+
+        return constant
+
+    def _compile_unaryop(self, node):
+        op_type = type(node.op)
+        operand = self._compile(node.operand)
+
+        def unaryop(s):
+            return s.operators[op_type](operand(s))
+
+        return unaryop
+
+    def _compile_binop(self, node):
+        op_type = type(node.op)
+        left = self._compile(node.left)
+        right = self._compile(node.right)
+
+        def binop(s):
+            return s.operators[op_type](left(s), right(s))
+
+        return binop
+
+    def _compile_boolop(self, node):
+        values = [self._compile(value) for value in node.values]
+
+        if isinstance(node.op, ast.And):
+
+            def boolop(s):
+                vout = False
+                for value in values:
+                    vout = value(s)
+                    if not vout:
+                        return vout
+                return vout
+
+        elif isinstance(node.op, ast.Or):
+
+            def boolop(s):
+                for value in values:
+                    vout = value(s)
+                    if vout:
+                        return vout
+                return vout
+
+        else:
+            return lambda s: None
+
+        return boolop
+
+    def _compile_compare(self, node):
+        first = self._compile(node.left)
+        comparisons = [(type(operation), self._compile(comp)) for operation, comp in zip(node.ops, node.comparators)]
+
+        if len(comparisons) == 1:
+            op_type, comp = comparisons[0]
+
+            def compare(s):
+                left = first(s)
+                right = comp(s)
+                return s.operators[op_type](left, right)
+
+            return compare
+
+        def compare_chain(s):
+            right = first(s)
+            to_return = True
+            for op_type, comp in comparisons:
+                if not to_return:
+                    break
+                left = right
+                right = comp(s)
+                to_return = s.operators[op_type](left, right)
+            return to_return
+
+        return compare_chain
+
+    def _compile_ifexp(self, node):
+        test = self._compile(node.test)
+        body = self._compile(node.body)
+        orelse = self._compile(node.orelse)
+
+        def ifexp(s):
+            return body(s) if test(s) else orelse(s)
+
+        return ifexp
+
+    def _compile_call(self, node):
+        args = [self._compile(a) for a in node.args]
+        keywords = [self._compile(k) for k in node.keywords]
+
+        if isinstance(node.func, ast.Attribute):
+            get_func = self._compile(node.func)
+
+        elif isinstance(node.func, ast.Name):
+            func_name = node.func.id
+
+            def get_func(s):
+                try:
+                    func = s.functions[func_name]
+                except KeyError:
+                    raise FunctionNotDefined(func_name, s.expr)
+
+                if func in DISALLOW_FUNCTIONS:
+                    raise FeatureNotAvailable("This function is forbidden")
+                return func
+
+        else:
+
+            def get_func(s):
+                raise FeatureNotAvailable("Lambda Functions not implemented")
+
+        if keywords:
+
+            def call(s):
+                return get_func(s)(*[a(s) for a in args], **dict(k(s) for k in keywords))
+
+        else:
+
+            def call(s):
+                return get_func(s)(*[a(s) for a in args])
+
+        return call
+
+    def _compile_keyword(self, node):
+        arg = node.arg
+        value = self._compile(node.value)
+        return lambda s: (arg, value(s))
+
+    def _compile_name(self, node):
+        name = node.id
+
+        def lookup(s):
+            try:
+                if hasattr(s.names, "__getitem__"):
+                    return s.names[name]
+                elif callable(s.names):
+                    return s.names(node)
+                else:
+                    raise InvalidExpression(
+                        'Trying to use name (variable) "{0}"' ' when no "names" defined for' " evaluator".format(name)
+                    )
+
+            except KeyError:
+                if name in s.functions:
+                    return s.functions[name]
+
+                raise NameNotDefined(name, s.expr)
+
+        if not self._compile_scopes:
+            return lookup
+
+        # inside a comprehension, its targets hide the other names:
+        def scoped_lookup(s):
+            for extra_names in reversed(s._scopes):
+                if name in extra_names:
+                    return extra_names[name]
+            return lookup(s)
+
+        return scoped_lookup
+
+    def _compile_subscript(self, node):
+        value = self._compile(node.value)
+        key = self._compile(node.slice)
+
+        def subscript(s):
+            container = value(s)
+            return container[key(s)]
+
+        return subscript
+
+    def _compile_attribute(self, node):
+        attr = node.attr
+        value = self._compile(node.value)
+        checked = self._compile_checked
+
+        def attribute(s):
+            if not checked:
+                check_attribute(attr)
+            node_evaluated = value(s)
+
+            try:
+                return getattr(node_evaluated, attr)
+            except (AttributeError, TypeError):
+                pass
+
+            if s.ATTR_INDEX_FALLBACK:
+                try:
+                    return node_evaluated[attr]
+                except (KeyError, TypeError):
+                    pass
+
+            raise AttributeDoesNotExist(attr, s.expr)
+
+        return attribute
+
+    def _compile_slice(self, node):
+        none = lambda s: None  # noqa: E731
+        lower = none if node.lower is None else self._compile(node.lower)
+        upper = none if node.upper is None else self._compile(node.upper)
+        step = none if node.step is None else self._compile(node.step)
+
+        def slice_(s):
+            return slice(lower(s), upper(s), step(s))
+
+        return slice_
+
+    def _compile_joinedstr(self, node):
+        values = [self._compile(n) for n in node.values]
+
+        def joinedstr(s):
+            length = 0
+            evaluated_values = []
+            for value in values:
+                val = str(value(s))
+                if len(val) + length > MAX_STRING_LENGTH:
+                    raise IterableTooLong("Sorry, I will not evaluate something this long.")
+                evaluated_values.append(val)
+            return "".join(evaluated_values)
+
+        return joinedstr
+
+    def _compile_formattedvalue(self, node):
+        value = self._compile(node.value)
+        if not node.format_spec:
+            return value
+
+        format_spec = self._compile(node.format_spec)
+
+        def formattedvalue(s):
+            fmt = "{:" + format_spec(s) + "}"
+            return fmt.format(value(s))
+
+        return formattedvalue
+
+    ########################################
+    # The stack engine:
+    #
+    # Each _emit_<x> mirrors _eval_<x> too, appending to a program the
+    # instructions pushing the value of the node on the stack of values (see
+    # run_program). Instructions return None, the index of the next one
+    # to run (a jump), RETURN or a MacroCall. Labels are lists of the index
+    # they are at, set once it is known.
+
+    def assemble(self, node, checked=False):
+        """assemble a parsed tree into a program, run with run_program(evaluator, program).
+        checked trees (see ParsedExpression) skip the attribute checks."""
+
+        self._compile_scopes = 0
+        self._compile_checked = checked
+        program = []
+        self._emit(node, program)
+        program.append(lambda s, values: RETURN)
+        return program
+
+    def _emit(self, node, program):
+        try:
+            handler_name = self.NODE_HANDLERS[type(node)]
+        except KeyError:
+            message = "Sorry, {0} is not available in this " "evaluator".format(type(node).__name__)
+
+            def unavailable(s, values):
+                raise FeatureNotAvailable(message)
+
+            program.append(unavailable)
+            return
+
+        emitter = getattr(self, handler_name.replace("_eval_", "_emit_", 1), None)
+        if emitter is None:
+            # no instructions for this node, interpret it:
+            program.append(lambda s, values: values.append(s._eval(node)))
+            return
+
+        emitter(node, program)
+
+    def _emit_expr(self, node, program):
+        self._emit(node.value, program)
+
+    def _emit_assign(self, node, program):
+        def assign(s, values):
+            warnings.warn(
+                "Assignment ({}) attempted, but this is ignored".format(s.expr),
+                AssignmentAttempted,
+            )
+
+        program.append(assign)
+        self._emit(node.value, program)
+
+    _emit_aug_assign = _emit_assign
+
+    def _emit_import(self, node, program):
+        def import_(s, values):
+            raise FeatureNotAvailable("Sorry, 'import' is not allowed.")
+
+        program.append(import_)
+
+    def _emit_constant(self, node, program):
+        value = node.value
+
+        if not hasattr(value, "__len__"):
+            program.append(lambda s, values: values.append(value))
+            return
+
+        def constant(s, values):
+            if len(value) > MAX_STRING_LENGTH:
+                raise IterableTooLong(
+                    "Literal in statement is too long!" " ({0}, when {1} is max)".format(len(value), MAX_STRING_LENGTH)
+                )
+            values.append(value)
+
+        program.append(constant)
+
+    def _emit_unaryop(self, node, program):
+        op_type = type(node.op)
+        self._emit(node.operand, program)
+
+        def unaryop(s, values):
+            values[-1] = s.operators[op_type](values[-1])
+
+        program.append(unaryop)
+
+    def _emit_binop(self, node, program):
+        op_type = type(node.op)
+        self._emit(node.left, program)
+        self._emit(node.right, program)
+
+        def binop(s, values):
+            right = values.pop()
+            values[-1] = s.operators[op_type](values[-1], right)
+
+        program.append(binop)
+
+    def _emit_boolop(self, node, program):
+        if isinstance(node.op, ast.And):
+
+            def boolop(s, values):
+                if not values[-1]:
+                    return end[0]  # the value, falsy
+                values.pop()
+
+        elif isinstance(node.op, ast.Or):
+
+            def boolop(s, values):
+                if values[-1]:
+                    return end[0]
+                values.pop()
+
+        else:
+            program.append(lambda s, values: values.append(None))
+            return
+
+        end = [None]
+        for value in node.values[:-1]:
+            self._emit(value, program)
+            program.append(boolop)
+        self._emit(node.values[-1], program)
+        end[0] = len(program)
+
+    def _emit_compare(self, node, program):
+        self._emit(node.left, program)
+        last = len(node.ops) - 1
+        end = [None]
+
+        for i, (operation, comp) in enumerate(zip(node.ops, node.comparators)):
+            op_type = type(operation)
+            self._emit(comp, program)
+
+            if i == last:
+
+                def compare(s, values, op_type=op_type):
+                    right = values.pop()
+                    values[-1] = s.operators[op_type](values[-1], right)
+
+            else:
+                # the left of the next comparison is this right, unless this one is false
+
+                def compare(s, values, op_type=op_type):
+                    right = values.pop()
+                    to_return = s.operators[op_type](values[-1], right)
+                    if not to_return:
+                        values[-1] = to_return
+                        return end[0]
+                    values[-1] = right
+
+            program.append(compare)
+        end[0] = len(program)
+
+    def _emit_ifexp(self, node, program):
+        orelse, end = [None], [None]
+
+        def test(s, values):
+            if not values.pop():
+                return orelse[0]
+
+        def jump(s, values):
+            return end[0]
+
+        self._emit(node.test, program)
+        program.append(test)
+        self._emit(node.body, program)
+        program.append(jump)
+        orelse[0] = len(program)
+        self._emit(node.orelse, program)
+        end[0] = len(program)
+
+    def _emit_call(self, node, program):
+        if isinstance(node.func, ast.Attribute):
+            self._emit(node.func, program)
+
+        elif isinstance(node.func, ast.Name):
+            func_name = node.func.id
+
+            def get_func(s, values):
+                try:
+                    func = s.functions[func_name]
+                except KeyError:
+                    raise FunctionNotDefined(func_name, s.expr)
+
+                if func in DISALLOW_FUNCTIONS:
+                    raise FeatureNotAvailable("This function is forbidden")
+                values.append(func)
+
+            program.append(get_func)
+
+        else:
+
+            def get_func(s, values):
+                raise FeatureNotAvailable("Lambda Functions not implemented")
+
+            program.append(get_func)
+
+        for a in node.args:
+            self._emit(a, program)
+        for k in node.keywords:
+            self._emit(k, program)
+
+        nargs = len(node.args)
+        count = nargs + len(node.keywords)
+
+        if node.keywords:
+
+            def call(s, values):
+                arguments = values[-count:]
+                del values[-count:]
+                return call_function(values.pop(), tuple(arguments[:nargs]), dict(arguments[nargs:]), values)
+
+        elif nargs:
+
+            def call(s, values):
+                args = tuple(values[-nargs:])
+                del values[-nargs:]
+                return call_function(values.pop(), args, None, values)
+
+        else:
+
+            def call(s, values):
+                return call_function(values.pop(), (), None, values)
+
+        program.append(call)
+
+    def _emit_keyword(self, node, program):
+        arg = node.arg
+        self._emit(node.value, program)
+
+        def keyword(s, values):
+            values[-1] = (arg, values[-1])
+
+        program.append(keyword)
+
+    def _emit_name(self, node, program):
+        lookup = self._compile_name(node)  # scoped in comprehensions, see _compile_name
+        if self._compile_scopes:
+            program.append(lambda s, values: values.append(lookup(s)))
+            return
+
+        name = node.id
+
+        def name_(s, values):
+            try:
+                values.append(s.names[name])
+            except (KeyError, TypeError):  # a function, names that aren't a dict... as lookup does
+                values.append(lookup(s))
+
+        program.append(name_)
+
+    def _emit_subscript(self, node, program):
+        self._emit(node.value, program)
+        self._emit(node.slice, program)
+
+        def subscript(s, values):
+            key = values.pop()
+            values[-1] = values[-1][key]
+
+        program.append(subscript)
+
+    def _emit_attribute(self, node, program):
+        attr = node.attr
+        if not self._compile_checked:
+            program.append(lambda s, values: check_attribute(attr))
+        self._emit(node.value, program)
+
+        def attribute(s, values):
+            node_evaluated = values[-1]
+
+            try:
+                values[-1] = getattr(node_evaluated, attr)
+                return
+            except (AttributeError, TypeError):
+                pass
+
+            if s.ATTR_INDEX_FALLBACK:
+                try:
+                    values[-1] = node_evaluated[attr]
+                    return
+                except (KeyError, TypeError):
+                    pass
+
+            raise AttributeDoesNotExist(attr, s.expr)
+
+        program.append(attribute)
+
+    def _emit_slice(self, node, program):
+        for part in (node.lower, node.upper, node.step):
+            if part is None:
+                program.append(lambda s, values: values.append(None))
+            else:
+                self._emit(part, program)
+
+        def slice_(s, values):
+            lower, upper, step = values[-3:]
+            del values[-3:]
+            values.append(slice(lower, upper, step))
+
+        program.append(slice_)
+
+    def _emit_joinedstr(self, node, program):
+        def to_str(s, values):
+            val = values[-1] = str(values[-1])
+            if len(val) > MAX_STRING_LENGTH:
+                raise IterableTooLong("Sorry, I will not evaluate something this long.")
+
+        for n in node.values:
+            self._emit(n, program)
+            program.append(to_str)
+
+        count = len(node.values)
+
+        def joinedstr(s, values):
+            evaluated_values = values[len(values) - count :]
+            del values[len(values) - count :]
+            values.append("".join(evaluated_values))
+
+        program.append(joinedstr)
+
+    def _emit_formattedvalue(self, node, program):
+        if not node.format_spec:
+            self._emit(node.value, program)
+            return
+
+        self._emit(node.format_spec, program)
+        self._emit(node.value, program)
+
+        def formattedvalue(s, values):
+            value = values.pop()
+            fmt = "{:" + values[-1] + "}"
+            values[-1] = fmt.format(value)
+
+        program.append(formattedvalue)
+
+
+SimpleEval._dispatch = SimpleEval._dispatch_table()
+
 
 class EvalWithCompoundTypes(SimpleEval):
     """
@@ -499,25 +1928,24 @@ class EvalWithCompoundTypes(SimpleEval):
     function editions. (list, tuple, dict, set).
     """
 
+    NODE_HANDLERS = {
+        **SimpleEval.NODE_HANDLERS,
+        ast.Dict: "_eval_dict",
+        ast.Tuple: "_eval_tuple",
+        ast.List: "_eval_list",
+        ast.Set: "_eval_set",
+        ast.ListComp: "_eval_comprehension",
+        ast.GeneratorExp: "_eval_comprehension",
+    }
+
     def __init__(self, operators=None, functions=None, names=None):
         super(EvalWithCompoundTypes, self).__init__(operators, functions, names)
 
-        self.functions.update(list=list, tuple=tuple, dict=dict, set=set)
-
-        self.nodes.update(
-            {
-                ast.Dict: self._eval_dict,
-                ast.Tuple: self._eval_tuple,
-                ast.List: self._eval_list,
-                ast.Set: self._eval_set,
-                ast.ListComp: self._eval_comprehension,
-                ast.GeneratorExp: self._eval_comprehension,
-            }
-        )
+        self.functions = dict(self.functions, list=list, tuple=tuple, dict=dict, set=set)
 
-    def eval(self, expr):
+    def eval(self, expr, engine=None):
         self._max_count = 0
-        return super(EvalWithCompoundTypes, self).eval(expr)
+        return super(EvalWithCompoundTypes, self).eval(expr, engine)
 
     def _eval_dict(self, node):
         return {self._eval(k): self._eval(v) for (k, v) in zip(node.keys, node.values)}
@@ -534,20 +1962,9 @@ class EvalWithCompoundTypes(SimpleEval):
     def _eval_comprehension(self, node):
         to_return = []
 
+        # Here we hide our extra scope for within this comprehension (see _eval_name)
         extra_names = {}
 
-        previous_name_evaller = self.nodes[ast.Name]
-
-        def eval_names_extra(node):
-            """
-            Here we hide our extra scope for within this comprehension
-            """
-            if node.id in extra_names:
-                return extra_names[node.id]
-            return previous_name_evaller(node)
-
-        self.nodes.update({ast.Name: eval_names_extra})
-
         def recurse_targets(target, value):
             """
                 Recursively (enter, (into, (nested, name), unpacking)) = \
@@ -559,6 +1976,8 @@ class EvalWithCompoundTypes(SimpleEval):
                 for t, v in zip(target.elts, value):
                     recurse_targets(t, v)
 
+        steps = iteration_steps(node)
+
         def do_generator(gi=0):
             g = node.generators[gi]
             for i in self._eval(g.iter):
@@ -566,6 +1985,9 @@ class EvalWithCompoundTypes(SimpleEval):
 
                 if self._max_count > MAX_COMPREHENSION_LENGTH:
                     raise IterableTooLong("Comprehension generates too many elements")
+                self._steps_left -= steps[gi]
+                if self._steps_left < 0:
+                    self._lease(BUDGET_CHECK_STEPS)
                 recurse_targets(g.target, i)
                 if all(self._eval(iff) for iff in g.ifs):
                     if len(node.generators) > gi + 1:
@@ -573,35 +1995,368 @@ class EvalWithCompoundTypes(SimpleEval):
                     else:
                         to_return.append(self._eval(node.elt))
 
+        self._scopes.append(extra_names)
         try:
             do_generator()
         finally:
-            self.nodes.update({ast.Name: previous_name_evaller})
+            self._scopes.pop()
 
         return to_return
 
+    def _eval_name(self, node):
+        for extra_names in reversed(self._scopes):
+            if node.id in extra_names:
+                return extra_names[node.id]
+        return super(EvalWithCompoundTypes, self)._eval_name(node)
+
+    def _compile_dict(self, node):
+        items = [(self._compile(k), self._compile(v)) for (k, v) in zip(node.keys, node.values)]
+        return lambda s: {k(s): v(s) for (k, v) in items}
+
+    def _compile_tuple(self, node):
+        elts = [self._compile(x) for x in node.elts]
+        return lambda s: tuple(x(s) for x in elts)
+
+    def _compile_list(self, node):
+        elts = [self._compile(x) for x in node.elts]
+        return lambda s: list(x(s) for x in elts)
+
+    def _compile_set(self, node):
+        elts = [self._compile(x) for x in node.elts]
+        return lambda s: set(x(s) for x in elts)
+
+    def _compile_comprehension(self, node):
+        self._compile_scopes += 1
+        try:
+            elt = self._compile(node.elt)
+            generators = [
+                (self._compile(g.iter), g.target, [self._compile(iff) for iff in g.ifs]) for g in node.generators
+            ]
+        finally:
+            self._compile_scopes -= 1
+
+        steps = iteration_steps(node)
+
+        def comprehension(s):
+            to_return = []
+
+            extra_names = {}
+
+            def recurse_targets(target, value):
+                if isinstance(target, ast.Name):
+                    extra_names[target.id] = value
+                else:
+                    for t, v in zip(target.elts, value):
+                        recurse_targets(t, v)
+
+            def do_generator(gi=0):
+                iter_, target, ifs = generators[gi]
+                for i in iter_(s):
+                    s._max_count += 1
+
+                    if s._max_count > MAX_COMPREHENSION_LENGTH:
+                        raise IterableTooLong("Comprehension generates too many elements")
+                    s._steps_left -= steps[gi]
+                    if s._steps_left < 0:
+                        s._lease(BUDGET_CHECK_STEPS)
+                    recurse_targets(target, i)
+                    if all(iff(s) for iff in ifs):
+                        if len(generators) > gi + 1:
+                            do_generator(gi + 1)
+                        else:
+                            to_return.append(elt(s))
+
+            s._scopes.append(extra_names)
+            try:
+                do_generator()
+            finally:
+                s._scopes.pop()
+
+            return to_return
+
+        return comprehension
+
+    def _emit_dict(self, node, program):
+        for k, v in zip(node.keys, node.values):
+            self._emit(k, program)
+            self._emit(v, program)
+        count = 2 * len(node.keys)
+
+        def dict_(s, values):
+            items = values[len(values) - count :]
+            del values[len(values) - count :]
+            values.append({items[i]: items[i + 1] for i in range(0, count, 2)})
+
+        program.append(dict_)
+
+    def _emit_elts(self, node, program, build):
+        for x in node.elts:
+            self._emit(x, program)
+        count = len(node.elts)
+
+        def elts(s, values):
+            items = values[len(values) - count :]
+            del values[len(values) - count :]
+            values.append(build(items))
+
+        program.append(elts)
+
+    def _emit_tuple(self, node, program):
+        self._emit_elts(node, program, tuple)
+
+    def _emit_list(self, node, program):
+        self._emit_elts(node, program, list)
+
+    def _emit_set(self, node, program):
+        self._emit_elts(node, program, set)
+
+    def _emit_comprehension(self, node, program):
+        # on the stack: the list built, then the iterator of each generator running
+        steps = iteration_steps(node)
+        inner = len(node.generators)
+        end = [None]
+        heads = []  # where each generator takes its next item
+
+        def recurse_targets(extra_names, target, value):
+            if isinstance(target, ast.Name):
+                extra_names[target.id] = value
+            else:
+                for t, v in zip(target.elts, value):
+                    recurse_targets(extra_names, t, v)
+
+        def begin(s, values):
+            values.append([])
+            s._scopes.append({})
 
-def simple_eval(expr, operators=None, functions=None, names=None):
-    """Simply evaluate an expresssion"""
+        def iterate(s, values):
+            values[-1] = iter(values[-1])
+
+        def append(s, values):
+            element = values.pop()
+            values[-1 - inner].append(element)
+            return heads[-1][0]
+
+        def finish(s, values):
+            s._scopes.pop()
+
+        program.append(begin)
+        self._compile_scopes += 1
+        try:
+            for gi, g in enumerate(node.generators):
+                self._emit(g.iter, program)
+                program.append(iterate)
+
+                # done, the generator before it goes on (or the comprehension ends):
+                def for_iter(s, values, target=g.target, step=steps[gi], done=heads[-1] if heads else end):
+                    try:
+                        i = next(values[-1])
+                    except StopIteration:
+                        values.pop()
+                        return done[0]
+
+                    s._max_count += 1
+                    if s._max_count > MAX_COMPREHENSION_LENGTH:
+                        raise IterableTooLong("Comprehension generates too many elements")
+                    s._steps_left -= step
+                    if s._steps_left < 0:
+                        s._lease(BUDGET_CHECK_STEPS)
+                    recurse_targets(s._scopes[-1], target, i)
+
+                head = [len(program)]
+                heads.append(head)
+                program.append(for_iter)
+
+                for iff in g.ifs:
+                    self._emit(iff, program)
+
+                    def test(s, values, head=head):
+                        if not values.pop():
+                            return head[0]
+
+                    program.append(test)
+
+            self._emit(node.elt, program)
+            program.append(append)
+        finally:
+            self._compile_scopes -= 1
+
+        end[0] = len(program)
+        program.append(finish)
+
+
+def simple_eval(expr, operators=None, functions=None, names=None, engine=None):
+    """Simply evaluate an expresssion (a string, or a ParsedExpression)"""
     s = SimpleEval(operators=operators, functions=functions, names=names)
-    return s.eval(expr)
+    return s.eval(expr, engine)
 
 
 class CalculationDataNotFound(Exception):
     ...
 
 
-def evaluate(expr: str, cache_path: str) -> Optional[str]:
-    swl_cache_file = cache_path + "/" + "swl.pkl"
-    cache = Path(swl_cache_file)
+EvalResult = namedtuple("EvalResult", ["expr", "result", "error"])
+
+
+class Session(object):
+    """Keeps the resolved environment of a cache directory in memory, so
+    it is loaded once instead of on every evaluation.
+    The cache file is checked before an evaluation at most once every
+    check_interval seconds (0: before each one, a stat per call), and right
+    away after a resolve() in this process; a new cache is loaded and
+    swapped in as a whole.
+    >>> session = Session("swirl/cache")  # doctest: +SKIP
+    >>> session.evaluate("mk.force(40, 45)")  # doctest: +SKIP
+    1800
+    """
+
+    def __init__(self, cache_path: str, engine: Optional[str] = None, check_interval: float = CHECK_INTERVAL):
+        self.cache_path = cache_path
+        self.engine = engine
+        self.check_interval = check_interval
+        self.generation = 0  # number of times the cache was loaded
+
+        self._calc_data: Optional[Dict] = None
+        self._stamp: Optional[tuple] = None
+        self._checked_at = 0.0
+        self._writes = -1  # _cache_writes when it was checked
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def cache_file(self) -> str:
+        """swl.cache, or the swl.pkl of a cache resolved by an older version"""
+
+        import cachefile
+
+        cache_file = self.cache_path + "/" + cachefile.CACHE_NAME
+        if os.path.exists(cache_file):
+            return cache_file
+        return self.cache_path + "/" + cachefile.LEGACY_CACHE_NAME
+
+    def _cache_stamp(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.cache_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> Dict:
+        """the environment, (re)loaded if the cache file changed"""
+
+        if self.check_interval:
+            now = time.monotonic()
+            checked = self._writes == _cache_writes and now - self._checked_at < self.check_interval
+            if checked and self._calc_data is not None:
+                return self._calc_data
+            self._checked_at, self._writes = now, _cache_writes
+
+        stamp = self._cache_stamp()
+        if stamp is None:
+            # resolve() replaces the file in one step, keep what is loaded
+            if self._calc_data is None:
+                raise CalculationDataNotFound("File 'swl.cache' is missing! Please restart the app.")
+            return self._calc_data
+
+        if stamp != self._stamp:
+            self.reload(stamp)
+
+        return self._calc_data  # type: ignore
+
+    def reload(self, stamp: Optional[tuple] = None) -> None:
+        """load the cache file, and swap it in"""
+
+        import cachefile
+
+        with self._lock:
+            stamp = stamp or self._cache_stamp()
+            if self._calc_data is not None and stamp == self._stamp:
+                return  # loaded by another thread meanwhile
+
+            try:
+                calc_data: Dict = cachefile.read_cache(self.cache_path)
+            except FileNotFoundError:
+                raise CalculationDataNotFound("File 'swl.cache' is missing! Please restart the app.")
+            except cachefile.CacheVersionError as e:
+                raise CalculationDataNotFound(f"{e} Please resolve the environment again.")
+
+            log.debug(f"Loaded '{self.cache_file}'")
+            self._calc_data, self._stamp = calc_data, stamp
+            self.generation += 1
+
+    def evaluator(self) -> SimpleEval:
+        """the evaluator of this thread, set up once per loaded environment"""
+
+        calc_data = self.load()
+        local = self._local
+        if getattr(local, "calc_data", None) is not calc_data:
+            local.evaluator = SimpleEval(functions=calc_data)
+            local.calc_data = calc_data
+        return local.evaluator
+
+    def evaluate(self, expr: str, engine: Optional[str] = None) -> Optional[str]:
+        return self.evaluator().eval(expr, engine or self.engine)
+
+    def profile(self, expr: str) -> ProfiledResult:
+        """evaluate an expression, with the report of the nodes evaluated (see SimpleEval.profile)"""
+
+        return self.evaluator().profile(expr)
+
+    def evaluate_many(
+        self, exprs: Iterable[str], engine: Optional[str] = None, stream: bool = False
+    ) -> Union[List[EvalResult], Iterator[EvalResult]]:
+        """evaluate independent expressions against the same environment.
+        Results come in input order, an expression that fails gets its
+        exception as error instead of stopping the batch. With stream,
+        results are yielded as they are evaluated."""
+
+        results = self._evaluate_many(exprs, engine or self.engine)
+        return results if stream else list(results)
+
+    def _evaluate_many(self, exprs: Iterable[str], engine: Optional[str]) -> Iterator[EvalResult]:
+        # one environment and one evaluator for the whole batch
+        evaluator = self.evaluator()
+
+        for expr in exprs:
+            try:
+                yield EvalResult(expr, evaluator.eval(expr, engine), None)
+            except Exception as e:
+                yield EvalResult(expr, None, e)
+
+
+_cache_writes = 0  # caches written by this process, see cache_written
+
+
+def cache_written() -> None:
+    """a cache was written by this process (see resolver.create_cache), the
+    sessions check their cache file on their next evaluation"""
+
+    global _cache_writes
+    _cache_writes += 1
+
+
+_sessions: Dict[str, Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(cache_path: str) -> Session:
+    """the default session of a cache directory, used by evaluate()"""
+
+    try:
+        return _sessions[cache_path]
+    except KeyError:
+        with _sessions_lock:
+            return _sessions.setdefault(cache_path, Session(cache_path))
+
+
+def evaluate(expr: str, cache_path: str, engine: Optional[str] = None) -> Optional[str]:
+    return get_session(cache_path).evaluate(expr, engine)
 
-    if cache.is_file():
-        with open(swl_cache_file, "rb") as swl_cache:
-            calc_data: Dict = pickle.load(swl_cache)
 
-            result = simple_eval(expr, functions=calc_data)
+def evaluate_profiled(expr: str, cache_path: str) -> ProfiledResult:
+    return get_session(cache_path).profile(expr)
 
-            return result
 
-    else:
-        raise CalculationDataNotFound("File 'swl.pkl' is missing! Please restart the app.")
+def evaluate_many(
+    exprs: Iterable[str], cache_path: str, engine: Optional[str] = None, stream: bool = False
+) -> Union[List[EvalResult], Iterator[EvalResult]]:
+    return get_session(cache_path).evaluate_many(exprs, engine, stream)
@@ -0,0 +1,130 @@
+# memo tables of pure macros (see analysis.is_pure)
+
+import math
+import threading
+import weakref
+
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict
+
+
+MEMO_SIZE = 1024  # results kept per macro, unless the macro sets memo_size
+NEGATIVE_ZERO = "-0.0"  # the kind of -0.0 in a key, see kind
+
+
+MemoInfo = namedtuple("MemoInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# every memoized macro of the process, to clear them all on resolve
+_memoized: "weakref.WeakSet[MemoizedMacro]" = weakref.WeakSet()
+
+
+class MemoizedMacro:
+    """A pure macro with an LRU table of its results, keyed on the arguments
+    and their kinds (1 and 1.0, or 0.0 and -0.0, are different keys). Calls
+    with unhashable arguments, and calls that raise, are not memoized."""
+
+    def __init__(self, name: str, func: Callable, maxsize: int = MEMO_SIZE):
+        self.name = name
+        self.func = func
+        self.maxsize = maxsize
+
+        # so that inspect.signature and the evaluators see the macro
+        self.__wrapped__ = func
+        self.formula = getattr(func, "formula", None)
+        self.variables = getattr(func, "variables", None)
+        self.env = getattr(func, "env", None)
+        self.pure = True
+
+        self._setup()
+
+    def _setup(self):
+        self.hits = 0
+        self.misses = 0
+        self._table: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        _memoized.add(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("hits", "misses", "_table", "_lock"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def __repr__(self):
+        return f"<memoized macro {self.name}>"
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(args, kwargs)
+        try:
+            return self.lookup(key)
+        except KeyError:
+            pass
+        except TypeError:  # unhashable arguments
+            return self.func(*args, **kwargs)
+
+        result = self.func(*args, **kwargs)
+        self.store(key, result)
+        return result
+
+    # for the evaluators running the formula themselves (see evaluator.run_program):
+
+    @staticmethod
+    def key(args: tuple, kwargs: Dict) -> tuple:
+        kinds = tuple(map(type, args))
+        if float in kinds or complex in kinds:
+            kinds = tuple(map(kind, args))
+        key = args + kinds
+        if kwargs:
+            key += tuple(sorted((k, v, kind(v)) for k, v in kwargs.items()))
+        return key
+
+    def lookup(self, key: tuple):
+        """the result memoized for key, KeyError if there is none (TypeError if it is unhashable)"""
+
+        with self._lock:
+            result = self._table[key]
+            self._table.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def store(self, key: tuple, result) -> None:
+        with self._lock:
+            self.misses += 1
+            self._table[key] = result
+            if len(self._table) > self.maxsize:
+                self._table.popitem(last=False)
+
+    def info(self) -> MemoInfo:
+        return MemoInfo(self.hits, self.misses, self.maxsize, len(self._table))
+
+    def clear(self):
+        with self._lock:
+            self._table.clear()
+            self.hits = self.misses = 0
+
+
+def kind(value):
+    """the type of value, with the sign of a zero: 0.0 == -0.0 (with the same
+    hash), but copysign, atan2 or 1 / x tell them apart"""
+
+    value_type = type(value)
+    if value_type is float:
+        return value_type if value or math.copysign(1.0, value) > 0 else NEGATIVE_ZERO
+    if value_type is complex and not (value.real and value.imag):
+        return value_type, repr(value)
+    return value_type
+
+
+def clear_memo_tables() -> None:
+    """forget every memoized result, for when the environment changed"""
+
+    for macro in list(_memoized):
+        macro.clear()
+
+
+def memo_stats() -> Dict[str, MemoInfo]:
+    return {macro.name: macro.info() for macro in list(_memoized)}
@@ -1,13 +1,20 @@
 from __future__ import annotations
 
 import os
-import re
 import json
-import dill as pickle
+import hashlib
+import pickle
 import logging
 
+import evaluator as evl
+import cachefile
+from analysis import DependencyGraph, referenced_names
 from data_models import Environment, Package, Macro
-from typing import List, Dict
+from errors import DependencyError, NameAlreadyUsedError
+from memo import clear_memo_tables
+from parallel import build_env
+from envstore import open_store, write_atomic
+from typing import Any, List, Dict, Optional, Set
 from dacite import from_dict
 from dataclasses import asdict
 
@@ -18,33 +25,46 @@ logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)  # type: ignore
 
 
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
+
 # dataclass
 
 
+def env_files(env_path: str) -> List[str]:
+    """the package/macro files of an env (a directory, in os.listdir order, or a bundle)"""
+
+    return open_store(env_path).files()
+
+
 def create_env_class(env_path: str) -> Environment:
+    return load_env_class(scan_env(env_path))
+
+
+def load_env_class(files: Dict[str, Dict]) -> Environment:
+    """the Environment of the files of a manifest (see scan_env), the names
+    a package/macro refers to coming before it"""
 
     packages: List[Package] = list()
     macros: List[Macro] = list()
 
-    pattern = r"^[package|macro]+\.[a-zA-Z0-9_]+[a-zA-Z0-9]\.json"
-
-    for file in os.listdir(env_path):
-        result = re.search(pattern, file)
-        if result:
-            if (valid_file := result.group()) == file:
-                log.debug(f"reading {valid_file}")
-                with open(f"{env_path}/{valid_file}", "r+") as json_file:
-                    try:
-                        data = json.load(json_file)
-                        if valid_file.startswith("macro"):
-                            macro = load_macro_data(data)
-                            macros.append(macro)
-
-                        elif valid_file.startswith("package"):
-                            package = load_package_data(data)
-                            packages.append(package)
-                    except json.JSONDecodeError:
-                        log.debug(f"Missing details on {file}")
+    order = {name: i for i, name in enumerate(dependency_graph(files).order())}
+
+    def position(item) -> int:
+        names = entry_name(item[1])
+        return order[names.pop()] if names else -1
+
+    for file, entry in sorted(files.items(), key=position):
+        data = entry["data"]
+        if data is None:
+            continue
+
+        if file.startswith("macro"):
+            macros.append(load_macro_data(data))
+
+        elif file.startswith("package"):
+            packages.append(load_package_data(data))
 
     env_class = Environment(_id="", macros=macros, packages=packages)
 
@@ -59,44 +79,288 @@ def load_package_data(data: Dict) -> Package:
     return from_dict(Package, data)
 
 
-def resolve(env_path: str, cache_path: str) -> str:
-    env_class = create_env_class(env_path)
+# manifest
+
+
+def scan_env(env_path: str, manifest: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """the manifest entries of the env files: their stamp (size and mtime,
+    size and offset in a bundle, or size and version in a database, see envstore), sha256, data (None if it
+    isn't valid json) and the names they refer to.
+
+    Files whose stamp is the one in manifest are not read, and files whose
+    content hash is the same are not decoded again.
+    """
+
+    manifest = manifest or {}
+    files: Dict[str, Dict] = dict()
+
+    store = open_store(env_path)
+    stamps = store.stamps()
+
+    def unchanged(file: str) -> bool:
+        entry = manifest.get(file)
+        return entry is not None and all(entry.get(key) == value for key, value in stamps[file].items())
+
+    contents = store.read([file for file in stamps if not unchanged(file)])
+
+    for file, stamp in stamps.items():
+        entry = manifest.get(file)
+        if file not in contents:
+            files[file] = entry
+            continue
+
+        content = contents[file]
+        digest = hashlib.sha256(content).hexdigest()
+
+        if entry and entry["sha256"] == digest:
+            files[file] = entry | stamp  # touched (or moved in a bundle), not changed
+            continue
+
+        log.debug(f"reading {file}")
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError:
+            log.debug(f"Missing details on {file}")
+            data = None
+
+        refs = sorted(entry_refs(data)) if isinstance(data, dict) else []
+        files[file] = stamp | {"sha256": digest, "data": data, "refs": refs}
+
+    return files
+
+
+def entry_refs(data: Dict) -> Set[str]:
+    """the names of the env the formulas of a macro, or of a package and its
+    dependencies, refer to (not their variables, nor the dependencies)"""
+
+    if "formula" in data:
+        variables = {var.split("=")[0].strip() for var in data.get("variables") or []}
+        return referenced_names(data["formula"] or "") - variables
+
+    refs: Set[str] = set()
+    for macro in data.get("macros") or []:
+        refs |= entry_refs(macro)
+    for dep in data.get("dependencies") or []:
+        refs |= entry_refs(dep)
+
+    return refs - {dep.get("name") for dep in data.get("dependencies") or []}
+
+
+def entry_name(entry: Optional[Dict]) -> Set[str]:
+    if entry and isinstance(entry["data"], dict) and "name" in entry["data"]:
+        return {entry["data"]["name"]}
+    return set()
+
+
+def dependency_graph(files: Dict[str, Dict]) -> DependencyGraph:
+    """the graph of the names defined by the files of a manifest"""
+
+    refs: Dict[str, Set[str]] = dict()
+    for entry in files.values():
+        for name in entry_name(entry):
+            refs.setdefault(name, set()).update(entry["refs"])
+
+    return DependencyGraph(refs)
+
+
+def changed_names(old_files: Dict[str, Dict], files: Dict[str, Dict]) -> Set[str]:
+    """the names of the files added, changed or deleted since old_files"""
+
+    changed: Set[str] = set()
+    for file, entry in files.items():
+        old_entry = old_files.get(file)
+        if old_entry is None or old_entry["sha256"] != entry["sha256"]:
+            changed |= entry_name(entry) | entry_name(old_entry)
+
+    for file in old_files.keys() - files.keys():
+        changed |= entry_name(old_files[file])
+
+    return changed
+
+
+def reusable(cache_path: str, files: Dict[str, Dict], affected: Set[str]) -> Dict[str, Any]:
+    """the objects of the cached build that don't have to be built again"""
 
-    swl_dict: Dict = env_class.build()
+    swl_dict = cachefile.read_cache(cache_path)
+
+    reuse = dict()
+    for entry in files.values():
+        for name in entry_name(entry) - affected:
+            if name in swl_dict:
+                reuse[name] = swl_dict[name]
+
+    return reuse
+
+
+def file_stamp(file_name: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_manifest(cache_path: str) -> Dict:
+    try:
+        with open(cache_path + "/" + MANIFEST_NAME, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest
+
+
+def write_manifest(cache_path: str, files: Dict[str, Dict]) -> None:
+    manifest_file = cache_path + "/" + MANIFEST_NAME
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "swl": file_stamp(cache_path + "/" + cachefile.CACHE_NAME),
+        "files": files,
+    }
+
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as manifest_json:
+            json.dump(manifest, manifest_json)
+        os.replace(tmp_file, manifest_file)
+    finally:
+        Path(tmp_file).unlink(missing_ok=True)
+
+
+def resolve(env_path: str, cache_path: str, full: bool = False, jobs: int = 1) -> str:
+    """build the env files into the caches.
+
+    Only the files that changed since the last resolve (see the manifest)
+    are built and tested again, with the macros referring to them; the
+    rest is taken from the cache. full: build everything, like the first time.
+    jobs: the processes building it (see parallel.build_env).
+    """
+
+    manifest = {} if full else read_manifest(cache_path)
+    files = scan_env(env_path, manifest.get("files"))
+    graph = dependency_graph(files)
+
+    reuse: Dict[str, Any] = dict()
+
+    # the manifest only describes the caches written with it
+    if manifest and manifest["swl"] == file_stamp(cache_path + "/" + cachefile.CACHE_NAME):
+        changed = changed_names(manifest["files"], files)
+
+        if not changed and os.path.exists(cache_path + "/" + "env.pkl"):
+            log.debug("Nothing changed since the last resolve")
+            write_manifest(cache_path, files)  # the new mtimes of touched files
+            with open(cache_path + "/" + "env.pkl", "rb") as env_cache:
+                return json.dumps(pickle.load(env_cache))
+
+        affected = changed | graph.dependents(changed)
+        log.debug(f"{len(changed)} changed, building {len(affected)}")
+        reuse = reusable(cache_path, files, affected)
+
+    env_class = load_env_class(files)
+
+    swl_dict: Dict = build_env(env_class, graph, reuse=reuse, jobs=jobs)
     env_dict: Dict = asdict(env_class)
 
-    delete_cache(cache_path)
+    # replacing the files, sessions holding the old cache reload it
     create_cache(cache_path, swl_dict, env_dict)
+    write_manifest(cache_path, files)
+    clear_memo_tables()
 
     result = json.dumps(env_dict)
     return result
 
 
-def delete_cache(cache_path: str):
-    env_cache_file = cache_path + "/" + "env.pkl"
-    swl_cache_file = cache_path + "/" + "swl.pkl"
-    env_cache = Path(env_cache_file)
-    swl_cache = Path(swl_cache_file)
+# targeted builds (create/edit/delete of a macro)
+
+
+def check_delete(env_path: str, cache_path: Optional[str], files: Dict[str, Optional[Dict]]) -> Dict[str, Dict]:
+    """the manifest of the env once files (file name -> new data, None to
+    delete it) are written, if what refers to the names going away doesn't.
+
+    Raises DependencyError otherwise, nothing is built.
+    """
+
+    manifest = read_manifest(cache_path) if cache_path else {}
+    old_files = scan_env(env_path, manifest.get("files"))
+    new_files = {file: entry for file, entry in old_files.items() if file not in files}
+    for file, data in files.items():
+        if data is not None:
+            new_files[file] = {"data": data, "refs": sorted(entry_refs(data))}
+
+    graph = dependency_graph(new_files)
+    for file in files:
+        for name in entry_name(old_files.get(file)):
+            if name not in graph and graph.users.get(name):
+                raise DependencyError(ref=name, dependents=sorted(graph.users[name]))
+
+    return new_files
+
+
+def check_changes(env_path: str, cache_path: str, files: Dict[str, Optional[Dict]]) -> List[str]:
+    """build the packages/macros of files (file name -> new data, None to
+    delete it) and the ones referring to them, against the cached build.
+
+    Raises what resolve would, nothing is written. Returns the names built.
+    """
 
-    env_cache.unlink(missing_ok=True)
-    swl_cache.unlink(missing_ok=True)
+    new_files = check_delete(env_path, cache_path, files)
+    graph = dependency_graph(new_files)
+    entries = {name: (file, entry) for file, entry in new_files.items() for name in entry_name(entry)}
+    packages = {name for name, (file, _) in entries.items() if file.startswith("package")}
+
+    changed: Set[str] = set()
+    for file, data in files.items():
+        if data is not None:
+            changed |= entry_name(new_files[file])
+
+    for name in changed:
+        defined = [file for file, entry in new_files.items() if name in entry_name(entry)]
+        if len(defined) > 1 or name in evl.DEFAULT_PACKAGES:
+            raise NameAlreadyUsedError(ref=name)
+
+    env: Dict[str, Any] = cachefile.read_cache(cache_path)
+
+    for name in list(env):
+        if name not in entries and name not in evl.DEFAULT_PACKAGES:
+            del env[name]  # deleted
+
+    built = graph.order(changed | graph.dependents(changed))
+    for name in built:
+        file, entry = entries[name]
+        if file.startswith("macro"):
+            env[name] = load_macro_data(entry["data"]).build(namespace=env)
+
+        elif file.startswith("package"):
+            defaults = {key: value for key, value in env.items() if key in packages or key in evl.DEFAULT_PACKAGES}
+            env[name] = load_package_data(entry["data"]).build(defaults=defaults)
+
+    return built
+
+
+def delete_cache(cache_path: str):
+    for file_name in ("env.pkl", cachefile.CACHE_NAME, cachefile.LEGACY_CACHE_NAME):
+        Path(cache_path + "/" + file_name).unlink(missing_ok=True)
 
 
 def create_cache(cache_path: str, swl_dict: Dict, env_dict: Dict):
     env_cache_file = cache_path + "/" + "env.pkl"
-    swl_cache_file = cache_path + "/" + "swl.pkl"
+    swl_cache_file = cache_path + "/" + cachefile.CACHE_NAME
 
-    with open(swl_cache_file, "wb") as swl_cache:
-        pickle.dump(swl_dict, swl_cache)
+    write_atomic(swl_cache_file, cachefile.dump_env(swl_dict))
+    write_atomic(env_cache_file, pickle.dumps(env_dict))
 
-    with open(env_cache_file, "wb") as env_cache:
-        pickle.dump(env_dict, env_cache)
+    # written by an older version, swl.cache is read instead
+    Path(cache_path + "/" + cachefile.LEGACY_CACHE_NAME).unlink(missing_ok=True)
+    evl.cache_written()
 
 
 """
 PARAMETERS:
     env_path
     cache_path
+    full: bool  :: rebuild every package/macro, not only the changed ones
 
 RETURN:
     str dict of environment data
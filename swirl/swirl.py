@@ -1,22 +1,24 @@
-from evaluator import evaluate, InvalidExpression
-from resolver import resolve
-from macro_builder import create_macro, delete_macro, edit_macro
+# the modules doing the work are imported where needed, so that
+# handing an expression to a running daemon stays fast
+from daemon import default_socket_path, evaluate_remote, serve
 import argparse
 import logging
 import sys
 
 from errors import SwirlError
 
-logging.basicConfig(level=logging.DEBUG)
-
 if __name__ == "__main__":
 
     reqs_parser = argparse.ArgumentParser(add_help=False)
     reqs_parser.add_argument("--cachepath", help="path to cache", default="swirl/cache")
-    reqs_parser.add_argument("--envpath", help="path to env", default="swirl/swirlenv")
+    reqs_parser.add_argument("--envpath", help="path to env (a directory, or a bundle file)", default="swirl/swirlenv")
 
     rscmd_parser = argparse.ArgumentParser(add_help=False)
     rscmd_parser.add_argument("--resolve", help="delete and create cache to save changes", default=False)
+    rscmd_parser.add_argument(
+        "--full", help="resolve every package/macro, not only the changed ones", action="store_true"
+    )
+    rscmd_parser.add_argument("--jobs", help="processes building the env (default: 1)", type=int, default=1)
 
     mbcmd_parser = argparse.ArgumentParser(add_help=False)
     mbcmd_parser.add_argument("--name", help="name of the macro")
@@ -28,15 +30,61 @@ if __name__ == "__main__":
 
     evcmd_parser = argparse.ArgumentParser(add_help=False)
     evcmd_parser.add_argument("--expr", help="expression to solve")
+    evcmd_parser.add_argument("--profile", help="print the nodes evaluated and their times", action="store_true")
+
+    dmcmd_parser = argparse.ArgumentParser(add_help=False)
+    dmcmd_parser.add_argument("--daemon", help="keep the cache loaded and serve expressions", action="store_true")
+    dmcmd_parser.add_argument("--socket", help="socket of the daemon (default: <cachepath>/swirl.sock)")
+    dmcmd_parser.add_argument("--macro-memory", help="MB of made macros the daemon keeps (default: 64)", type=float)
+    dmcmd_parser.add_argument("--metrics", help="record the calls of the macros the daemon makes", action="store_true")
 
-    parser = argparse.ArgumentParser(parents=[reqs_parser, rscmd_parser, mbcmd_parser, evcmd_parser])
+    bncmd_parser = argparse.ArgumentParser(add_help=False)
+    bncmd_parser.add_argument("--pack", help="write the env directory into a bundle (or *.db) file", metavar="BUNDLE")
+    bncmd_parser.add_argument("--unpack", help="write a bundle (or *.db) file into the env directory", metavar="BUNDLE")
+    bncmd_parser.add_argument(
+        "--compact", help="drop the replaced records of the env bundle (or *.db)", action="store_true"
+    )
+
+    parser = argparse.ArgumentParser(
+        parents=[reqs_parser, rscmd_parser, mbcmd_parser, evcmd_parser, dmcmd_parser, bncmd_parser]
+    )
 
     args = parser.parse_args()
+    socket_path = args.socket or default_socket_path(args.cachepath)
+
+    # the thin client only warns (e.g. of a daemon not answering), what runs here logs what it does
+    others = args.daemon or args.pack or args.unpack or args.compact or args.resolve or args.action or args.profile
+    logging.basicConfig(level=logging.WARNING if args.expr and not others else logging.DEBUG)
 
     # EVALUATOR LOGIC
-    if args.resolve:
+    if args.daemon:
+        if args.macro_memory:
+            from stubs import MACRO_CACHE
+
+            MACRO_CACHE.configure(max_bytes=int(args.macro_memory * 1024 * 1024))
+
+        if args.metrics:
+            from metrics import METRICS
+
+            METRICS.enable()
+
+        serve(cache_path=args.cachepath, socket_path=socket_path)
+
+    elif args.pack or args.unpack or args.compact:
+        from envstore import open_store, pack, unpack
+
+        if args.pack:
+            pack(env_path=args.envpath, store_path=args.pack)
+        elif args.unpack:
+            unpack(store_path=args.unpack, env_path=args.envpath)
+        else:
+            open_store(args.envpath).compact()
+
+    elif args.resolve:
+        from resolver import resolve
+
         try:
-            resolve(env_path=args.envpath, cache_path=args.cachepath)
+            resolve(env_path=args.envpath, cache_path=args.cachepath, full=args.full, jobs=args.jobs)
 
         except SwirlError as e:
             sys.stderr.write(e.message)
@@ -45,6 +93,9 @@ if __name__ == "__main__":
             sys.stderr.write(f"Unhandled exception! {e}")
 
     elif args.action:
+        from evaluator import InvalidExpression
+        from macro_builder import create_macro, delete_macro, edit_macro
+
         try:
             if args.action == "create":
                 create_macro(
@@ -74,7 +125,7 @@ if __name__ == "__main__":
                 )
 
             elif args.action == "delete":
-                delete_macro(args.id, args.envpath)
+                delete_macro(args.id, args.envpath, args.cachepath)
 
         except SwirlError as e:
             sys.stderr.write(e.message)
@@ -85,9 +136,22 @@ if __name__ == "__main__":
         except Exception as e:
             sys.stderr.write(f"Unhandled exception! {e}")
 
+    elif args.expr and not args.profile and (response := evaluate_remote(socket_path, args.expr)) is not None:
+        if "error" in response:
+            sys.stderr.write(response["message"])
+        elif response["truthy"]:
+            sys.stdout.write(response["result"])
+
     elif args.expr:
+        from evaluator import evaluate, evaluate_profiled, InvalidExpression
+
+        logging.getLogger().setLevel(logging.DEBUG)
         try:
-            result = evaluate(args.expr, args.cachepath)
+            if args.profile:
+                result, report = evaluate_profiled(args.expr, args.cachepath)
+                sys.stderr.write(f"{report}\n")
+            else:
+                result = evaluate(args.expr, args.cachepath)
             if result:
                 sys.stdout.write(str(result))
 
@@ -0,0 +1,365 @@
+# vectorized evaluation, names can be bound to NumPy arrays
+# numpy is an optional dependency (pip install swirl-api[vectorize])
+
+import ast
+import math
+import inspect
+import logging
+import operator as op
+
+from types import MappingProxyType
+from typing import Any, Dict, Optional
+
+import evaluator as evl
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+class NotVectorizable(Exception):
+    """this expression can't run over whole arrays, it is run element by element"""
+
+    pass
+
+
+# exceptions that make an evaluation fall back to the per-element loop, which
+# then raises the scalar exception of the element at fault if there is one.
+FALLBACK_ERRORS = (NotVectorizable, FloatingPointError, ValueError, TypeError, ZeroDivisionError, OverflowError)
+
+
+########################################
+# Operators over arrays:
+
+
+def is_array(value) -> bool:
+    return np is not None and isinstance(value, np.ndarray)
+
+
+def max_abs(value):
+    if is_array(value):
+        return np.abs(value).max(initial=0)
+    return abs(value)
+
+
+def vector_op(scalar_op, array_op):
+    """array_op when an operand is an array, scalar_op (the default operator) otherwise"""
+
+    def operator(*args):
+        for arg in args:
+            if is_array(arg):
+                if arg.dtype.kind not in "biufc":
+                    raise NotVectorizable(f"Array of {arg.dtype} in an operation")
+                return array_op(*args)
+        return scalar_op(*args)
+
+    return operator
+
+
+def scalar_only(scalar_op):
+    def operator(*args):
+        if any(is_array(arg) for arg in args):
+            raise NotVectorizable("Operator doesn't work element-wise")
+        return scalar_op(*args)
+
+    return operator
+
+
+def vector_power(a, b):
+    """safe_power, with the limits checked against the array maxima"""
+
+    if max_abs(a) > evl.MAX_POWER or max_abs(b) > evl.MAX_POWER:
+        raise evl.NumberTooHigh("Sorry! I don't want to evaluate {0} ** {1}".format(a, b))
+    return np.power(a, b)
+
+
+def vector_rshift(a, b):
+    if max_abs(b) > evl.MAX_SHIFT:
+        raise evl.NumberTooHigh("Sorry! I don't want to evaluate {0} >> {1}".format(a, b))
+    return np.right_shift(a, b)
+
+
+def vector_lshift(a, b):
+    if max_abs(b) > evl.MAX_SHIFT:
+        raise evl.NumberTooHigh("Sorry! I don't want to evaluate {0} << {1}".format(a, b))
+    return np.left_shift(a, b)
+
+
+if np is not None:
+    # the element-wise versions of evl.DEFAULT_OPERATORS
+    VECTOR_OPERATORS = {
+        ast.Add: vector_op(evl.safe_add, np.add),
+        ast.Sub: vector_op(op.sub, np.subtract),
+        ast.Mult: vector_op(evl.safe_mult, np.multiply),
+        ast.Div: vector_op(op.truediv, np.true_divide),
+        ast.FloorDiv: vector_op(op.floordiv, np.floor_divide),
+        ast.RShift: vector_op(evl.safe_rshift, vector_rshift),
+        ast.LShift: vector_op(evl.safe_lshift, vector_lshift),
+        ast.Pow: vector_op(evl.safe_power, vector_power),
+        ast.Mod: vector_op(op.mod, np.mod),
+        ast.Eq: vector_op(op.eq, np.equal),
+        ast.NotEq: vector_op(op.ne, np.not_equal),
+        ast.Gt: vector_op(op.gt, np.greater),
+        ast.Lt: vector_op(op.lt, np.less),
+        ast.GtE: vector_op(op.ge, np.greater_equal),
+        ast.LtE: vector_op(op.le, np.less_equal),
+        ast.Not: vector_op(op.not_, np.logical_not),
+        ast.USub: vector_op(op.neg, np.negative),
+        ast.UAdd: vector_op(op.pos, np.positive),
+        evl.Square: vector_op(evl.safe_square, lambda a: vector_power(a, 2)),
+        evl.Cube: vector_op(evl.safe_cube, lambda a: vector_power(a, 3)),
+        ast.In: scalar_only(evl.DEFAULT_OPERATORS[ast.In]),
+        ast.NotIn: scalar_only(evl.DEFAULT_OPERATORS[ast.NotIn]),
+        ast.Is: scalar_only(evl.DEFAULT_OPERATORS[ast.Is]),
+        ast.IsNot: scalar_only(evl.DEFAULT_OPERATORS[ast.IsNot]),
+    }
+    SHARED_VECTOR_OPERATORS = MappingProxyType(VECTOR_OPERATORS)
+
+    # math functions (of evl.DEFAULT_PACKAGES) and their ufuncs
+    VECTOR_MATH = {
+        "sqrt": np.sqrt,
+        "exp": np.exp,
+        "expm1": np.expm1,
+        "log10": np.log10,
+        "log2": np.log2,
+        "log1p": np.log1p,
+        "sin": np.sin,
+        "cos": np.cos,
+        "tan": np.tan,
+        "asin": np.arcsin,
+        "acos": np.arccos,
+        "atan": np.arctan,
+        "atan2": np.arctan2,
+        "sinh": np.sinh,
+        "cosh": np.cosh,
+        "tanh": np.tanh,
+        "asinh": np.arcsinh,
+        "acosh": np.arccosh,
+        "atanh": np.arctanh,
+        "hypot": np.hypot,
+        "fabs": np.fabs,
+        "copysign": np.copysign,
+        "degrees": np.degrees,
+        "radians": np.radians,
+        "isnan": np.isnan,
+        "isinf": np.isinf,
+        "isfinite": np.isfinite,
+    }
+
+
+class VectorMath:
+    """stands for the math module, its functions work element-wise on arrays"""
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(math, name)  # same AttributeError as math
+        if not callable(value):
+            return value  # pi, e, tau, inf, nan
+
+        ufunc = VECTOR_MATH.get(name)
+        if name == "log":
+            ufunc = vector_log
+
+        def function(*args):
+            if not any(is_array(arg) for arg in args):
+                return value(*args)
+            if ufunc is None:
+                raise NotVectorizable(f"math.{name} doesn't work element-wise")
+            return ufunc(*args)
+
+        function.elementwise = True  # type: ignore
+        return function
+
+
+def vector_log(x, base=None):
+    if base is None:
+        return np.log(x)
+    return np.log(x) / np.log(base)
+
+
+########################################
+# The evaluator:
+
+
+class VectorEval(evl.SimpleEval):
+    """SimpleEval where names can be NumPy arrays, operators and math
+    functions work element-wise, and macros are run on the arrays as a
+    whole. Whatever can't be, raises NotVectorizable (see vector_eval)."""
+
+    def __init__(self, operators=None, functions=None, names=None):
+        if np is None:
+            raise evl.FeatureNotAvailable("Sorry, vectorized evaluation needs numpy installed.")
+
+        super().__init__(operators or SHARED_VECTOR_OPERATORS, functions, names)
+        self.math = VectorMath()
+
+    def eval(self, expr, engine=None):
+        # the closure engine would skip the overrides below
+        return super().eval(expr, "interpreter")
+
+    def _vector(self, value):
+        return self.math if value is math else value
+
+    def _eval_name(self, node):
+        return self._vector(super()._eval_name(node))
+
+    def _eval_ifexp(self, node):
+        test = self._eval(node.test)
+        if is_array(test):
+            raise NotVectorizable("Condition depends on the array")
+        return self._eval(node.body) if test else self._eval(node.orelse)
+
+    def _eval_boolop(self, node):
+        vout = False
+        for value in node.values:
+            vout = self._eval(value)
+            if is_array(vout):
+                raise NotVectorizable("'and'/'or' of an array")
+            if bool(vout) != isinstance(node.op, ast.And):
+                return vout
+        return vout
+
+    def _eval_compare(self, node):
+        if len(node.ops) > 1:
+            raise NotVectorizable("Chained comparison")
+        return super()._eval_compare(node)
+
+    def _eval_subscript(self, node):
+        container = self._eval(node.value)
+        if is_array(container):
+            raise NotVectorizable("Subscript of an array")
+        return container[self._eval(node.slice)]
+
+    def _eval_attribute(self, node):
+        if not self._checked:
+            evl.check_attribute(node.attr)
+        node_evaluated = self._eval(node.value)
+        if is_array(node_evaluated):
+            raise NotVectorizable("Attribute of an array")
+
+        try:
+            return self._vector(getattr(node_evaluated, node.attr))
+        except (AttributeError, TypeError):
+            pass
+
+        if self.ATTR_INDEX_FALLBACK:
+            try:
+                return self._vector(node_evaluated[node.attr])
+            except (KeyError, TypeError):
+                pass
+
+        raise evl.AttributeDoesNotExist(node.attr, self.expr)
+
+    def _eval_formattedvalue(self, node):
+        value = self._eval(node.value)
+        if is_array(value):
+            raise NotVectorizable("Formatting an array")
+        if node.format_spec:
+            fmt = "{:" + self._eval(node.format_spec) + "}"
+            return fmt.format(value)
+        return value
+
+    def _eval_call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            func = self._eval(node.func)
+        else:
+            try:
+                func = self.functions[node.func.id]
+            except KeyError:
+                raise evl.FunctionNotDefined(node.func.id, self.expr)
+            except AttributeError:
+                raise evl.FeatureNotAvailable("Lambda Functions not implemented")
+
+            if func in evl.DISALLOW_FUNCTIONS:
+                raise evl.FeatureNotAvailable("This function is forbidden")
+
+        args = [self._eval(a) for a in node.args]
+        kwargs = dict(self._eval(k) for k in node.keywords)
+
+        # macros are run here, on the arrays:
+        formula = getattr(func, "formula", None)
+        if isinstance(formula, evl.ParsedExpression):
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            return VectorEval(self.operators, func.env, dict(bound.arguments)).eval(formula)
+
+        if not getattr(func, "elementwise", False):
+            if any(is_array(value) for value in args + list(kwargs.values())):
+                raise NotVectorizable(f"{func} doesn't work element-wise")
+
+        return func(*args, **kwargs)
+
+
+def vector_eval(expr, names: Dict, functions: Optional[Dict] = None) -> Any:
+    """evaluate an expression over the arrays in names, element-wise.
+
+    Integer arrays are run as float64, since NumPy integers would overflow
+    silently where Python's don't, and results follow NumPy's arithmetic
+    (which can differ from the scalar one in the last bit). Expressions that can't run over whole
+    arrays (a condition or a recursion depending on an array...) are run
+    for each element instead, by the scalar SimpleEval.
+    >>> vector_eval("x ** 2 + 1", {"x": np.arange(3)})
+    array([1., 2., 5.])
+    """
+
+    if np is None:
+        raise evl.FeatureNotAvailable("Sorry, vectorized evaluation needs numpy installed.")
+
+    parsed = expr if isinstance(expr, evl.ParsedExpression) else evl.PARSE_CACHE.get(expr)
+
+    arrays = {}
+    for name, value in names.items():
+        if is_array(value):
+            arrays[name] = value.astype(np.float64) if value.dtype.kind in "iu" else value
+
+    if not arrays:
+        return evl.SimpleEval(functions=functions, names=names).eval(parsed)
+
+    shape = np.broadcast_shapes(*(array.shape for array in arrays.values()))
+
+    try:
+        with np.errstate(all="raise"):
+            result = VectorEval(functions=functions, names={**names, **arrays}).eval(parsed)
+        return np.broadcast_to(result, shape).copy()
+
+    except FALLBACK_ERRORS as e:
+        log.debug(f"Evaluating '{parsed.expr}' element by element: {e!r}")
+        return element_eval(parsed, names, arrays, shape, functions)
+
+
+def element_eval(parsed: evl.ParsedExpression, names: Dict, arrays: Dict, shape: tuple, functions: Optional[Dict]):
+    """the per-element loop, with python scalars as the SimpleEval would get"""
+
+    element_names = dict(names)
+    s = evl.SimpleEval(functions=functions, names=element_names)
+    columns = {name: np.broadcast_to(names[name], shape).ravel() for name in arrays}
+
+    results = []
+    for i in range(math.prod(shape)):
+        for name, column in columns.items():
+            element_names[name] = column[i].item()
+        results.append(s.eval(parsed))
+
+    return np.array(results).reshape(shape)
+
+
+def evaluate_vectorized(expr: str, cache_path: str, names: Dict) -> Any:
+    """vector_eval against the environment of a cache directory"""
+
+    return vector_eval(expr, names, functions=evl.get_session(cache_path).load())
+
+
+"""
+PARAMETERS:
+    expr: str         :: the expression, e.g. "AreaofCircle(r)"
+    names: dict       :: the names of the expression, arrays are evaluated element-wise
+                         e.g. {"r": numpy.linspace(0, 1, 2_000_000)}
+    cache_path: str   :: the cache directory of the app.
+
+RETURN:
+    array (or scalar, when no name is an array)
+
+"""
@@ -0,0 +1,137 @@
+# static analysis of macro formulas (on their parsed trees)
+
+import ast
+import math
+
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import evaluator as evl
+
+
+# functions whose result isn't decided by their arguments alone
+IMPURE_FUNCTIONS = {"rand", "randint"}
+PURE_FUNCTIONS = {int, float, str}
+
+
+def resolve_call(func: ast.AST, env: Dict) -> Any:
+    """the object a call refers to, if it can be found in env (None otherwise)"""
+
+    if isinstance(func, ast.Name):
+        return env.get(func.id)
+
+    if isinstance(func, ast.Attribute):
+        value = resolve_call(func.value, env)
+        return getattr(value, func.attr, None)
+
+    return None
+
+
+def is_pure_callable(func: Any) -> bool:
+    if getattr(func, "pure", None) is True:
+        return True  # a pure macro
+
+    try:
+        if func in PURE_FUNCTIONS:
+            return True
+    except TypeError:  # unhashable
+        return False
+
+    return getattr(func, "__module__", None) == "math" or getattr(func, "__self__", None) is math
+
+
+def is_pure(parsed: evl.ParsedExpression, env: Dict, name: Optional[str] = None) -> bool:
+    """whether a formula gives the same result for the same arguments.
+
+    It is not if it calls rand/randint, a macro that is not pure, or anything
+    that can't be found in env. Calls of the macro itself (name) are pure.
+    """
+
+    for node in ast.walk(parsed.node):
+        if not isinstance(node, ast.Call):
+            continue
+
+        if isinstance(node.func, ast.Name):
+            if node.func.id in IMPURE_FUNCTIONS:
+                return False
+            if node.func.id == name:
+                continue
+
+        if not is_pure_callable(resolve_call(node.func, env)):
+            return False
+
+    return True
+
+
+def referenced_names(formula: str) -> Set[str]:
+    """the names a formula reads (for math.sqrt(x), math and x).
+
+    A formula that doesn't parse refers to nothing, building it fails anyway.
+    """
+
+    try:
+        tree = ast.parse(formula.strip())
+    except (SyntaxError, ValueError):
+        return set()
+
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+
+
+class DependencyGraph:
+    """which names of an env the formulas of each name refer to, and the other way around"""
+
+    def __init__(self, refs: Dict[str, Iterable[str]]):
+        # a name referring to itself (a recursive macro) doesn't depend on itself
+        self.refs: Dict[str, Set[str]] = {name: set(names) - {name} for name, names in refs.items()}
+
+        self.users: Dict[str, Set[str]] = dict()
+        for name, names in self.refs.items():
+            for ref in names:
+                self.users.setdefault(ref, set()).add(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.refs
+
+    def dependents(self, names: Iterable[str]) -> Set[str]:
+        """the names referring to names, directly or not (names themselves excluded)"""
+
+        names = set(names)
+        found: Set[str] = set()
+        stack = list(names)
+        while stack:
+            for user in self.users.get(stack.pop(), ()):
+                if user not in found:
+                    found.add(user)
+                    stack.append(user)
+
+        return found - names
+
+    def order(self, names: Optional[Iterable[str]] = None) -> List[str]:
+        """names (all of the graph by default) with the names they refer to
+        first, in their given order otherwise. Cycles are kept as they come."""
+
+        names = list(self.refs) if names is None else list(names)
+        position = {name: i for i, name in enumerate(names)}
+
+        def refs(name: str) -> Iterable[str]:
+            return iter(sorted((ref for ref in self.refs.get(name, ()) if ref in position), key=position.__getitem__))
+
+        ordered: List[str] = []
+        seen: Set[str] = set()
+        for root in names:
+            if root in seen:
+                continue
+
+            seen.add(root)
+            stack = [(root, refs(root))]
+            while stack:
+                name, pending = stack[-1]
+                for ref in pending:
+                    if ref not in seen:
+                        seen.add(ref)
+                        stack.append((ref, refs(ref)))
+                        break
+                else:
+                    stack.pop()
+                    ordered.append(name)
+
+        return ordered
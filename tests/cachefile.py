@@ -0,0 +1,224 @@
+# the swl.cache file: the built environment in a versioned format that is
+# loaded without unpickling closures. A macro is kept as its (checked) formula
+# and variables, with the code of its lambda marshalled, and made again on load.
+
+import gc
+import struct
+import pickle
+import logging
+import marshal
+import importlib.util
+
+from types import CodeType, ModuleType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import evaluator as evl
+from data_models import macro_source
+from memo import MemoizedMacro
+from metrics import MeasuredMacro
+from stubs import MacroStub
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+CACHE_NAME = "swl.cache"
+LEGACY_CACHE_NAME = "swl.pkl"  # dill pickles of the callables, read if there is no swl.cache
+FORMAT_VERSION = 1
+
+# "SWLC", the format version, the bytecode magic of the python that wrote the
+# code objects, and the length of the entries (the code objects come after them)
+HEADER = struct.Struct("<4sH4sQ")
+MAGIC = b"SWLC"
+
+
+class CacheVersionError(Exception):
+    """the cache file was written in another format, resolve again"""
+
+    pass
+
+
+########################################
+# Writing:
+
+
+def entry_spec(value: Any, code_index: Optional[Callable[[Tuple[str, ...]], int]] = None) -> tuple:
+    """the spec of an env entry (see FORMAT), code_index: the index of the
+    code of a macro in the code table, by its variables (-1 without table)"""
+
+    if isinstance(value, MeasuredMacro):
+        value = value.func
+
+    if isinstance(value, ModuleType):
+        for name, module in evl.DEFAULT_PACKAGES.items():
+            if module is value:
+                return ("default", name)
+
+    if isinstance(value, type):  # a package, its dependencies are its bases
+        deps = tuple(entry_spec(base, code_index) for base in value.__bases__ if base is not object)
+        attrs = tuple(
+            (attr, entry_spec(attr_value, code_index))
+            for attr, attr_value in vars(value).items()
+            if not (attr.startswith("__") and attr.endswith("__"))
+        )
+        return ("package", value.__name__, deps, attrs)
+
+    if isinstance(getattr(value, "formula", None), evl.ParsedExpression):
+        variables = tuple(value.variables)
+        if isinstance(value, MacroStub):
+            memo_size = value.memo_size
+        elif isinstance(value, MemoizedMacro):
+            memo_size = value.maxsize
+        else:
+            memo_size = 0
+        code = -1 if code_index is None else code_index(variables)
+        return ("macro", value.formula.expr, variables, code, bool(value.pure), memo_size)
+
+    try:
+        marshal.dumps(value)
+        return ("value", value)
+    except ValueError:
+        return ("pickle", pickle.dumps(value))
+
+
+def dump_env(env: Dict) -> bytes:
+    """the content of swl.cache for a built environment"""
+
+    codes: Dict[Tuple[str, ...], int] = dict()  # the lambdas of the macros sharing variables are the same
+    code_table: List[CodeType] = list()
+
+    def code_index(variables: Tuple[str, ...]) -> int:
+        if variables not in codes:
+            codes[variables] = len(code_table)
+            code_table.append(compile(macro_source(list(variables)), "<macro>", "eval"))
+        return codes[variables]
+
+    entries = marshal.dumps(tuple((name, entry_spec(value, code_index)) for name, value in env.items()))
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, importlib.util.MAGIC_NUMBER, len(entries))
+    return header + entries + marshal.dumps(tuple(code_table))
+
+
+########################################
+# Loading:
+
+
+def load_env(data: bytes) -> Dict:
+    """the environment of the content of swl.cache (see make_env)"""
+
+    if len(data) < HEADER.size:
+        raise CacheVersionError("The cache file is truncated.")
+
+    magic, version, python_magic, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise CacheVersionError(f"The cache file isn't in the format {FORMAT_VERSION} of {CACHE_NAME}.")
+
+    body = memoryview(data)[HEADER.size :]
+    entries = marshal.loads(body[:length])
+
+    # code objects are only read by the python that wrote them, the
+    # stubs compile their lambda again otherwise
+    code_table = None
+    if python_magic == importlib.util.MAGIC_NUMBER:
+        code_table = marshal.loads(body[length:])
+
+    return make_env(entries, code_table)
+
+
+def make_env(
+    entries: Iterable[Tuple[str, tuple]], code_table: Optional[Sequence[CodeType]] = None, env: Optional[Dict] = None
+) -> Dict:
+    """the environment of (name, spec) entries (see entry_spec), or env
+    (made by make_env) with the entries added.
+
+    Macros are stubs, made on their first call (see stubs.MacroStub).
+    Top-level macros share the returned dict as their namespace, and the
+    macros of a package one dict of the packages before it, its dependencies
+    and its macros. The namespaces are evl.Namespace, checked as they are loaded.
+    """
+
+    if env is None:
+        env = evl.Namespace()
+
+    # what the macros of a package see
+    defaults: Dict[str, Any] = evl.Namespace(
+        {name: value for name, value in env.items() if isinstance(value, (type, ModuleType))}
+    )
+
+    def make(name: str, spec: tuple, namespace: Dict, package: Optional[str] = None) -> Any:
+        kind = spec[0]
+
+        if kind == "value":
+            return spec[1]
+
+        if kind == "default":
+            return evl.DEFAULT_PACKAGES[spec[1]]
+
+        if kind == "macro":
+            _, formula, variables, code, pure, memo_size = spec
+            code = code_table[code] if code_table is not None and code >= 0 else None
+            return MacroStub(name, formula, variables, namespace, pure, memo_size, code, package)
+
+        if kind == "package":
+            _, package_name, dep_specs, attrs = spec
+            path = package_name if package is None else f"{package}.{package_name}"  # see Package.build
+            deps = {dep_spec[1]: make(dep_spec[1], dep_spec, namespace, path) for dep_spec in dep_specs}
+            package_env = defaults | deps
+            mac_dict = {attr: make(attr, attr_spec, package_env, path) for attr, attr_spec in attrs}
+            package_env.update(mac_dict)
+
+            package = type(package_name, tuple(deps.values()), mac_dict)
+            package.__module__ = "__main__"
+            return package
+
+        if kind == "pickle":
+            return pickle.loads(spec[1])
+
+        raise CacheVersionError(f"Unknown entry '{kind}' in the cache file.")
+
+    # the collector would go through the growing env again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for name, spec in entries:
+            env[name] = make(name, spec, env)
+            if spec[0] in ("package", "default"):
+                defaults[name] = env[name]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return env
+
+
+def read_cache(cache_path: str) -> Dict:
+    """the environment of a cache directory, from its swl.cache, or its
+    swl.pkl if it was resolved by an older version"""
+
+    try:
+        with open(cache_path + "/" + CACHE_NAME, "rb") as swl_cache:
+            return load_env(swl_cache.read())
+    except FileNotFoundError:
+        pass
+
+    with open(cache_path + "/" + LEGACY_CACHE_NAME, "rb") as swl_cache:
+        import dill
+
+        log.warning(f"Loading the old '{LEGACY_CACHE_NAME}' of '{cache_path}', resolve to write '{CACHE_NAME}'")
+        return evl.Namespace(dill.load(swl_cache))
+
+
+"""
+FORMAT (version 1):
+    header    "SWLC", u16 format version, the 4 bytes of importlib.util.MAGIC_NUMBER,
+              u64 length of the entries
+    entries   marshal of ((name, spec), ...) in build order, a spec being
+                ("value", value)
+                ("default", name)                     :: evl.DEFAULT_PACKAGES[name]
+                ("macro", formula, variables, code, pure, memo_size)
+                ("package", name, (dependency specs), ((name, spec), ...))
+                ("pickle", bytes)                     :: values marshal can't write
+    codes     marshal of the code objects of the macro lambdas, indexed by code
+              (compiled again from the variables when read by another python,
+              or when code is -1)
+
+"""
@@ -6,45 +6,110 @@ import random
 import logging
 
 from typing import Any, Callable, Optional, List, Dict
+from functools import partial
 from dataclasses import dataclass
+from types import CodeType
 from errors import NameAlreadyUsedError, LengthError, InvalidNameError, KeywordNameError
 
 import evaluator as evl
+from analysis import is_pure
+from memo import MemoizedMacro, MEMO_SIZE
+from metrics import METRICS, macro_label
+from optimizer import optimize
 
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)  # type: ignore
 
 
+def filter_defaults(var: str) -> str:
+    return var.split("=")[0]
+
+
+def macro_source(variables: List[str]) -> str:
+    """the lambda of a macro with these variables (e.g. ["r", "n=2"]), running its formula"""
+
+    var_str: str = ", ".join(variables)
+    var_str_dict: str = ", ".join([f'"{filter_defaults(var)}": {filter_defaults(var)}' for var in variables])
+    return f"(lambda {var_str}: simple_eval(parsed, names={{{var_str_dict}}}, functions=env))"
+
+
+def formula_transform(variables: Optional[List[str]], env: Dict) -> Callable:
+    """the optimization of a formula with these variables, in env (see optimizer.optimize)"""
+
+    return partial(optimize, variables=[filter_defaults(var) for var in variables or []], env=env)
+
+
+def make_macro(
+    name: str,
+    parsed: evl.ParsedExpression,
+    variables: List[str],
+    env: Dict,
+    pure: bool,
+    memo_size: int,
+    code: Optional[CodeType] = None,
+    package: Optional[str] = None,
+) -> Callable:
+    """the callable of a macro, code: macro_source compiled beforehand,
+    package: the path of its package (labelling its metrics, see metrics.METRICS)"""
+
+    eval_code = macro_source(variables) if code is None else code
+    func: Callable = eval(eval_code, {"env": env, "simple_eval": evl.simple_eval, "parsed": parsed})
+
+    # for evaluators running the formula themselves (e.g. vectorize), and the cache
+    func.formula = parsed  # type: ignore
+    func.variables = list(variables)  # type: ignore
+    func.env = env  # type: ignore
+    func.pure = pure  # type: ignore
+
+    if pure and memo_size > 0:
+        func = MemoizedMacro(name, func, memo_size)
+    if METRICS.enabled:
+        return METRICS.measured(macro_label(name, package), func)
+    return func
+
+
 @dataclass
 class Environment:
     _id: str
     packages: Optional[List[Package]] = None
     macros: Optional[List[Macro]] = None
 
-    def build(self) -> Dict:
-        """build env data for caching"""
+    def build(self, reuse: Optional[Dict[str, Any]] = None) -> Dict:
+        """build env data for caching
+
+        reuse: objects built by a previous resolve, taken as they are instead
+        of building (and testing) their package/macro again.
 
-        env: Dict[str, Any] = evl.DEFAULT_PACKAGES
+        The macros share the returned env as their namespace (as the macros
+        loaded from the cache, see cachefile.load_env), it isn't copied for each.
+        """
+
+        # a copy, so that building twice in a process doesn't see the first build
+        env: Dict[str, Any] = evl.Namespace(evl.DEFAULT_PACKAGES)
+        reuse = reuse or {}
 
         if self.packages:
             for package in self.packages:
-                log.debug(f"Building package '{package.name}'")
-
-                if package.name not in env:
-                    env[package.name] = package.build()
+                if package.name in env:
+                    raise NameAlreadyUsedError(ref=package.name)
 
+                if package.name in reuse:
+                    env[package.name] = reuse[package.name]
                 else:
-                    raise NameAlreadyUsedError(ref=package.name)
+                    log.debug(f"Building package '{package.name}'")
+                    env[package.name] = package.build(defaults=env)
 
         if self.macros:
             for macro in self.macros:
-                log.debug(f"Building macro '{macro.name}'")
+                if macro.name in env:
+                    raise NameAlreadyUsedError(ref=macro.name)
 
-                if macro.name not in env:
-                    env[macro.name] = macro.build(env=env)
+                if macro.name in reuse:
+                    env[macro.name] = reuse[macro.name]
                 else:
-                    raise NameAlreadyUsedError(ref=macro.name)
+                    log.debug(f"Building macro '{macro.name}'")
+                    env[macro.name] = macro.build(namespace=env)
 
         return env
 
@@ -79,21 +144,32 @@ class Package:
     # package.__module__ = "__main__"
     # return package
 
-    def build(self) -> type:
+    def build(self, defaults: Optional[Dict] = None, path: Optional[str] = None) -> type:
+        """defaults: the packages its macros see besides its dependencies
+        (evl.DEFAULT_PACKAGES and the packages of the env built before it),
+        a dependency hides a package of the same name.
+        path: the names of the packages it is a dependency of, and its own
+        (mk.science), labelling the metrics of its macros.
+
+        Its macros share one namespace: defaults, dependencies and macros."""
+
+        path = path or self.name
         deps_dict = {}
         if self.dependencies:
             for dep in self.dependencies:
                 if dep.name not in deps_dict:
-                    deps_dict.update({dep.name: dep.build()})
+                    deps_dict.update({dep.name: dep.build(defaults=defaults, path=f"{path}.{dep.name}")})
 
                 else:
                     raise NameAlreadyUsedError(ref=dep.name)
 
+        namespace = evl.Namespace(evl.DEFAULT_PACKAGES if defaults is None else defaults) | deps_dict
+
         mac_dict = {}
         if self.macros:
             for mac in self.macros:
                 if mac.name not in mac_dict:
-                    mac_dict.update({mac.name: mac.build(env=deps_dict)})
+                    mac_dict.update({mac.name: mac.build(namespace=namespace, package=path)})
                 else:
                     raise NameAlreadyUsedError(ref=mac.name)
 
@@ -111,34 +187,56 @@ class Macro:
     variables: Optional[List[str]]
     formula: str
     description: Optional[str] = None
-
-    def build(self, env: Dict = dict()) -> Callable:
-        """build the callable of macro"""
-
-        # putting default packages
-        env = env | evl.DEFAULT_PACKAGES
+    memo_size: Optional[int] = None  # results memoized if pure, MEMO_SIZE by default, 0 to disable
+
+    def build(
+        self,
+        env: Dict = dict(),
+        defaults: Optional[Dict] = None,
+        namespace: Optional[Dict] = None,
+        package: Optional[str] = None,
+    ) -> Callable:
+        """build the callable of macro
+
+        namespace: the evl.Namespace it shares with other macros, which the
+        macro is put in. Without it, one of defaults (evl.DEFAULT_PACKAGES)
+        and env is made for the macro.
+        package: the path of the package of the macro, if it is in one (see Package.build).
+        """
+
+        if namespace is None:
+            # putting default packages, under the names of env (checked once, see evl.Namespace)
+            namespace = evl.Namespace(evl.DEFAULT_PACKAGES if defaults is None else defaults) | env
+        env = namespace
+
+        # parsing (and optimizing) the formula once, calls only walk the tree
+        parsed = evl.ParsedExpression(self.formula, transform=formula_transform(self.variables, env))
 
         if self.variables:
-            var_str: str = ", ".join(self.variables)
-            var_str_dict: str = ", ".join(
-                [f'"{self.filter_defaults(var)}": {self.filter_defaults(var)}' for var in self.variables]
-            )
-            eval_str: str = (
-                f'(lambda {var_str}: simple_eval("{self.formula}", names={{{var_str_dict}}}, functions=env))'
-            )
-            eval_result: Callable = eval(eval_str, {"env": env, "simple_eval": evl.simple_eval})
+            memo_size = MEMO_SIZE if self.memo_size is None else self.memo_size
+            pure = is_pure(parsed, env, self.name)
+            eval_result: Any = make_macro(self.name, parsed, self.variables, env, pure, memo_size, package=package)
         else:
-            var_str = ""
-            var_str_dict = ""
-            eval_str = f'simple_eval(f"{self.formula}", functions=env)'
-            eval_result = eval(eval_str, {"env": env, "simple_eval": evl.simple_eval})
+            eval_result = evl.simple_eval(parsed, functions=env)
+
+        self.validate()
 
-        self.validate().test_macro(eval_result, env)
+        # so that a macro can call itself (e.g. factorial), until it fails its test
+        previous = env.get(self.name)
+        env[self.name] = eval_result
+        try:
+            self.test_macro(eval_result, env)
+        except Exception:
+            if previous is None:
+                del env[self.name]
+            else:
+                env[self.name] = previous
+            raise
 
         return eval_result
 
     def filter_defaults(self, var) -> str:
-        return var.split("=")[0]
+        return filter_defaults(var)
 
     def validate(self) -> Macro:
         self.is_valid_name().is_valid_variables()
@@ -156,7 +254,7 @@ class Macro:
         # log.debug(env)
 
         try:
-            test_env = env | {self.name: func}
+            test_env = env if env.get(self.name) is func else env | {self.name: func}
             evl.simple_eval(test_str, functions=test_env)
             log.debug(f"Finished macro '{self.name}'")
             return self
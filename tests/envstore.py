@@ -0,0 +1,490 @@
+# where the package/macro files of an env are kept: a directory of json files,
+# a bundle, one file of records appended one after the other, with an index
+# of their offsets, or an sqlite database, a row per file. All give the files
+# (and their content) by file name, e.g. "macro.<_id>.json", and stamps that
+# change when a file is written.
+
+import os
+import re
+import json
+import mmap
+import sqlite3
+import struct
+import logging
+
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+READERS = min(32, (os.cpu_count() or 1) + 4)  # threads reading the files of a directory
+SERIAL_READS = 16  # fewer files are read without the threads
+
+BUNDLE_FORMAT_VERSION = 2  # 1: an empty record was a deleted file
+BUNDLE_HEADER = struct.Struct("<4sH")  # "SWLB", the format version
+BUNDLE_MAGIC = b"SWLB"
+RECORD_HEADER = struct.Struct("<HI")  # the length of the file name, of the content (or DELETED)
+DELETED = 0xFFFFFFFF  # the content length of the record of a deleted file
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+SQLITE_TIMEOUT = 30.0  # seconds waiting for the transaction of another writer
+SQLITE_BATCH = 500  # files read by a query (the limit of its parameters is 999 in older sqlite)
+
+
+class BundleError(Exception):
+    """the file isn't a bundle, or is truncated"""
+
+    pass
+
+
+def write_atomic(file_name: str, content: bytes):
+    """write to a temporary file then rename it, so readers see the old or the new file"""
+
+    tmp_file = f"{file_name}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "wb") as cache:
+            cache.write(content)
+        os.replace(tmp_file, file_name)
+    finally:
+        Path(tmp_file).unlink(missing_ok=True)
+
+
+def is_sqlite(path: str) -> bool:
+    if path.endswith(SQLITE_SUFFIXES):
+        return True
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as db_file:
+        return db_file.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def open_store(env_path: str):
+    """the store of an env path, a database if it is an sqlite file
+    (or named *.db, *.sqlite), a bundle if it is another file"""
+
+    if is_sqlite(env_path):
+        return SqliteStore(env_path)
+    if os.path.isfile(env_path):
+        return BundleStore(env_path)
+    return DirectoryStore(env_path)
+
+
+########################################
+# Directory:
+
+
+class DirectoryStore(object):
+    """the env files in a directory, read by a pool of threads"""
+
+    pattern = r"^[package|macro]+\.[a-zA-Z0-9_]+[a-zA-Z0-9]\.json"
+
+    def __init__(self, path: str, readers: int = READERS):
+        self.path = path
+        self.readers = readers
+
+    def files(self) -> List[str]:
+        """the package/macro files, in os.listdir order"""
+
+        files: List[str] = list()
+        for file in os.listdir(self.path):
+            result = re.search(self.pattern, file)
+            if result and result.group() == file:
+                files.append(file)
+        return files
+
+    def stamps(self) -> Dict[str, Dict]:
+        stamps = dict()
+        for file in self.files():
+            stat = os.stat(f"{self.path}/{file}")
+            stamps[file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        return stamps
+
+    def exists(self, file: str) -> bool:
+        return os.path.exists(f"{self.path}/{file}")
+
+    def read_file(self, file: str) -> bytes:
+        with open(f"{self.path}/{file}", "rb") as json_file:
+            return json_file.read()
+
+    def read(self, files: Iterable[str]) -> Dict[str, bytes]:
+        """the content of files, read concurrently"""
+
+        files = list(files)
+        if len(files) <= SERIAL_READS or self.readers <= 1:
+            return {file: self.read_file(file) for file in files}
+
+        with ThreadPoolExecutor(max_workers=self.readers) as pool:
+            return dict(zip(files, pool.map(self.read_file, files)))
+
+    def write(self, file: str, data: Dict, indent: Optional[int] = None) -> None:
+        with open(f"{self.path}/{file}", "w") as json_file:
+            json.dump(data, json_file, indent=indent)
+
+    def delete(self, file: str) -> None:
+        Path(f"{self.path}/{file}").unlink()
+
+    def transaction(self):
+        return nullcontext()  # each file is written (or deleted) on its own
+
+
+########################################
+# Bundle:
+
+
+class BundleStore(object):
+    """The env files as records of one file. Writing a file appends its
+    record, the last record of a file is the one read, and deleting
+    appends a DELETED record. The offsets of the records are indexed in
+    <bundle>.idx, written when the bundle is packed or compacted, and
+    brought up to date by reading the records appended since.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._index: Optional[Dict[str, Tuple[int, int]]] = None
+        self._indexed = 0  # bytes of the bundle in the index
+
+    @classmethod
+    def create(cls, path: str, contents: Dict[str, bytes]) -> "BundleStore":
+        """a bundle of contents (file name -> content)"""
+
+        records = [BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_FORMAT_VERSION)]
+        for file, content in contents.items():
+            records.append(record(file, content))
+        write_atomic(path, b"".join(records))
+
+        store = cls(path)
+        store.write_index()
+        return store
+
+    # the index:
+
+    @property
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        """file name -> (offset, length) of its content in the bundle"""
+
+        size = os.path.getsize(self.path)
+        if self._index is None or size < self._indexed:
+            self._index, self._indexed = self.read_index()
+        if size > self._indexed:
+            self._indexed = self.scan(self._index, self._indexed)
+        return self._index
+
+    def read_index(self) -> Tuple[Dict[str, Tuple[int, int]], int]:
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index["version"] == BUNDLE_FORMAT_VERSION and index["size"] <= os.path.getsize(self.path):
+                return {file: tuple(place) for file, place in index["files"].items()}, index["size"]  # type: ignore
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        log.debug(f"Indexing the bundle '{self.path}'")
+        return dict(), 0
+
+    def scan(self, index: Dict[str, Tuple[int, int]], offset: int) -> int:
+        """index the records from offset, the end of the last one"""
+
+        with open(self.path, "rb") as bundle:
+            size = os.fstat(bundle.fileno()).st_size
+            if offset == 0:
+                magic, version = BUNDLE_HEADER.unpack(bundle.read(BUNDLE_HEADER.size))
+                if magic != BUNDLE_MAGIC or version != BUNDLE_FORMAT_VERSION:
+                    message = f"'{self.path}' isn't a bundle of format {BUNDLE_FORMAT_VERSION}, pack its env again."
+                    raise BundleError(message)
+                offset = BUNDLE_HEADER.size
+
+            bundle.seek(offset)
+            while True:
+                header = bundle.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break  # the end, or a record being appended
+                name_length, length = RECORD_HEADER.unpack(header)
+                file = bundle.read(name_length).decode()
+                content_offset = offset + RECORD_HEADER.size + name_length
+                if length == DELETED:
+                    if content_offset > size:
+                        break
+                    index.pop(file, None)
+                    length = 0
+                elif content_offset + length > size:
+                    break
+                else:
+                    index[file] = (content_offset, length)
+                offset = content_offset + length
+                bundle.seek(offset)
+
+        return offset
+
+    def write_index(self) -> None:
+        index = self.index
+        content = {"version": BUNDLE_FORMAT_VERSION, "size": self._indexed, "files": index}
+        write_atomic(self.index_path, json.dumps(content).encode())
+
+    # the store:
+
+    def files(self) -> List[str]:
+        return list(self.index)
+
+    def stamps(self) -> Dict[str, Dict]:
+        return {file: {"size": length, "offset": offset} for file, (offset, length) in self.index.items()}
+
+    def exists(self, file: str) -> bool:
+        return file in self.index
+
+    def read(self, files: Iterable[str]) -> Dict[str, bytes]:
+        """the content of files, sliced from the mapped bundle"""
+
+        index = self.index
+        files = list(files)
+        if not files:
+            return dict()
+
+        with open(self.path, "rb") as bundle:
+            with mmap.mmap(bundle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return {file: data[index[file][0] : index[file][0] + index[file][1]] for file in files}
+
+    def write(self, file: str, data: Dict, indent: Optional[int] = None) -> None:
+        self.append(file, json.dumps(data, indent=indent).encode())
+
+    def delete(self, file: str) -> None:
+        if file not in self.index:
+            raise FileNotFoundError(f"No '{file}' in the bundle '{self.path}'")
+        self.append(file, None)
+
+    def transaction(self):
+        return nullcontext()  # each record is appended on its own
+
+    def append(self, file: str, content: Optional[bytes]) -> None:
+        """append the record of file, of a deleted file if content is None"""
+
+        self.index  # indexed up to the end, the record is read back from there
+        with open(self.path, "ab") as bundle:
+            bundle.write(record(file, content))
+
+    def compact(self) -> None:
+        """write the bundle again without the replaced and deleted records"""
+
+        index = self.index
+        BundleStore.create(self.path, self.read(index))
+        self._index = None
+
+
+def record(file: str, content: Optional[bytes]) -> bytes:
+    name = file.encode()
+    if content is None:
+        return RECORD_HEADER.pack(len(name), DELETED) + name
+    return RECORD_HEADER.pack(len(name), len(content)) + name + content
+
+
+########################################
+# SQLite:
+
+
+class SqliteStore(object):
+    """The env files as rows of an sqlite database, with their _id, name
+    and owner_id indexed. Writes are transactions, on their own or grouped
+    in transaction(), e.g. a macro renamed is written and its old row
+    deleted at once, and other writers wait for them (SQLITE_TIMEOUT).
+
+    The stamp of a row has a version, taken from a counter of the database
+    on every write, so resolve reads only the rows written since its manifest.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None  # of the transaction
+        self._ready = False
+
+    @classmethod
+    def create(cls, path: str, contents: Dict[str, bytes]) -> "SqliteStore":
+        """a database of contents (file name -> content), replacing the one at path"""
+
+        for db_file in (path, path + "-journal", path + "-wal", path + "-shm"):
+            Path(db_file).unlink(missing_ok=True)
+
+        store = cls(path)
+        with store.transaction() as connection:
+            for file, content in contents.items():
+                store.insert(connection, file, content)
+        return store
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        if not self._ready:
+            # created once, readers of a database don't write (they would wait for its writer)
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'counter'").fetchone() is None:
+                connection.executescript(SQLITE_SCHEMA)
+            self._ready = True
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """the writes (and reads) of the store made as one transaction,
+        rolled back if it raises"""
+
+        if self._connection is not None:
+            yield self._connection  # in the transaction already
+            return
+
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")  # writers wait here, readers don't
+            self._connection = connection
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            self._connection = None
+            connection.close()
+
+    @contextmanager
+    def reading(self) -> Iterator[sqlite3.Connection]:
+        if self._connection is not None:
+            yield self._connection
+            return
+
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def insert(self, connection: sqlite3.Connection, file: str, content: bytes) -> None:
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            data = dict()
+
+        connection.execute("UPDATE counter SET version = version + 1")
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (file, kind, _id, name, owner_id, content, version)"
+            " VALUES (?, ?, ?, ?, ?, ?, (SELECT version FROM counter))",
+            (file, file.split(".")[0], *(indexed(data.get(key)) for key in ("_id", "name", "owner_id")), content),
+        )
+
+    # the store:
+
+    def files(self) -> List[str]:
+        with self.reading() as connection:
+            return [file for file, in connection.execute("SELECT file FROM entries")]
+
+    def stamps(self) -> Dict[str, Dict]:
+        with self.reading() as connection:
+            rows = connection.execute("SELECT file, length(content), version FROM entries")
+            return {file: {"size": size, "version": version} for file, size, version in rows}
+
+    def exists(self, file: str) -> bool:
+        with self.reading() as connection:
+            return connection.execute("SELECT 1 FROM entries WHERE file = ?", (file,)).fetchone() is not None
+
+    def find(self, **columns: str) -> List[str]:
+        """the files whose _id, name and/or owner_id are the ones given"""
+
+        unknown = columns.keys() - {"_id", "name", "owner_id"}
+        if unknown:
+            raise TypeError(f"Not an indexed column: {', '.join(sorted(unknown))}")
+
+        where = " AND ".join(f"{column} = ?" for column in columns) or "1"
+        with self.reading() as connection:
+            rows = connection.execute(f"SELECT file FROM entries WHERE {where}", tuple(columns.values()))
+            return [file for file, in rows]
+
+    def read(self, files: Iterable[str]) -> Dict[str, bytes]:
+        """the content of files, read in batches of SQLITE_BATCH rows"""
+
+        files = list(files)
+        contents: Dict[str, bytes] = dict()
+        with self.reading() as connection:
+            for i in range(0, len(files), SQLITE_BATCH):
+                batch = files[i : i + SQLITE_BATCH]
+                query = f"SELECT file, content FROM entries WHERE file IN ({', '.join('?' * len(batch))})"
+                contents.update(connection.execute(query, batch))
+        return {file: contents[file] for file in files}
+
+    def write(self, file: str, data: Dict, indent: Optional[int] = None) -> None:
+        with self.transaction() as connection:
+            self.insert(connection, file, json.dumps(data, indent=indent).encode())
+
+    def delete(self, file: str) -> None:
+        with self.transaction() as connection:
+            if connection.execute("DELETE FROM entries WHERE file = ?", (file,)).rowcount == 0:
+                raise FileNotFoundError(f"No '{file}' in the database '{self.path}'")
+
+    def compact(self) -> None:
+        with self.reading() as connection:
+            connection.execute("VACUUM")
+
+
+def indexed(value) -> Optional[str]:
+    return value if isinstance(value, str) else None
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    file     TEXT PRIMARY KEY,
+    kind     TEXT NOT NULL,
+    _id      TEXT,
+    name     TEXT,
+    owner_id TEXT,
+    content  BLOB NOT NULL,
+    version  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_id ON entries (_id);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+CREATE INDEX IF NOT EXISTS entries_owner_id ON entries (owner_id);
+
+CREATE TABLE IF NOT EXISTS counter (version INTEGER NOT NULL);
+INSERT INTO counter SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM counter);
+"""
+
+
+########################################
+# Converting:
+
+
+def pack(env_path: str, store_path: str):
+    """the bundle (or the database, if store_path is named *.db, *.sqlite)
+    of the files of an env directory, in file name order"""
+
+    store = DirectoryStore(env_path)
+    files = sorted(store.files())
+    store_class = SqliteStore if store_path.endswith(SQLITE_SUFFIXES) else BundleStore
+    return store_class.create(store_path, store.read(files))
+
+
+def unpack(store_path: str, env_path: str) -> DirectoryStore:
+    """the files of a bundle (or a database) written in a directory"""
+
+    store = open_store(store_path)
+    os.makedirs(env_path, exist_ok=True)
+    for file, content in store.read(store.files()).items():
+        with open(f"{env_path}/{file}", "wb") as json_file:
+            json_file.write(content)
+    return DirectoryStore(env_path)
+
+
+"""
+BUNDLE FORMAT (version 2):
+    header    "SWLB", u16 format version
+    records   u16 length of the file name, u32 length of the content
+              (0xFFFFFFFF for a deleted file), the file name (utf-8), the
+              content (the json of the file, nothing for a deleted file);
+              the last record of a file wins
+    .idx      json {"version", "size": bytes of the bundle indexed,
+              "files": {file name: [offset, length]}}
+
+SQLITE: see SQLITE_SCHEMA, content is the json of the file, version the
+        counter when it was written.
+
+"""
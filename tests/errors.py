@@ -1,3 +1,6 @@
+from typing import List
+
+
 # base
 class SwirlError(Exception):
     def __init__(self, ref, message) -> None:
@@ -34,3 +37,11 @@ class NameAlreadyUsedError(SwirlError):
         self.ref = ref
         self.message = f'"{self.ref}" is already used! Please use another name for this.'
         super().__init__(self.ref, self.message)
+
+
+class DependencyError(SwirlError):
+    def __init__(self, ref: str, dependents: List[str]) -> None:
+        self.ref = ref
+        self.dependents = dependents
+        self.message = f'"{self.ref}" is used by {", ".join(dependents)}! Please change them first.'
+        super().__init__(self.ref, self.message)
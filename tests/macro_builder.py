@@ -1,96 +1,96 @@
 # macro/package must be validated and built before saving
 
 import hashlib
-from pathlib import Path
-import dill as pickle
 import logging
 import json
 import ast
 
-from typing import Dict
+from typing import Dict, Optional
 from dacite import from_dict
 from dataclasses import asdict
-from data_models import Environment, Macro
+from data_models import Macro
+from envstore import open_store
+from errors import NameAlreadyUsedError
+from resolver import check_changes, check_delete
 
 
 log = logging.getLogger(__name__)  # type: ignore
 
 
 def create_macro(dist_path: str, cache_path: str, data: Dict) -> None:
-    env_cache_file = cache_path + "/" + "env.pkl"
     hash_str = str(data["owner_id"] + data["name"]).encode()
     data["_id"] = hashlib.sha256(hash_str).hexdigest()
     data["variables"] = ast.literal_eval(data["variables"])
 
     raw_data = from_dict(Macro, data)
     file_name = f"macro.{raw_data._id}.json"
+    store = open_store(dist_path)
 
-    with open(env_cache_file, "rb") as env_pickle:
-        env_dict = pickle.load(env_pickle)
-        env = from_dict(Environment, env_dict)
-        env.macros.append(raw_data)
+    # a database checks and writes in one transaction, another writer waits
+    with store.transaction():
+        if store.exists(file_name):
+            raise NameAlreadyUsedError(ref=raw_data.name)
 
-        # test build to see if theres any resolution errors
-        env.build()
+        # test build of the macro (and what refers to its name) against the cache
+        check_changes(dist_path, cache_path, {file_name: asdict(raw_data)})
 
-    file_path = dist_path + "/" + file_name
-    with open(file_path, "w") as json_file:
-        json.dump(asdict(raw_data), json_file)
+        store.write(file_name, asdict(raw_data))
 
 
 def edit_macro(ref: str, dist_path: str, cache_path: str, data: Dict) -> None:
-    env_cache_file = cache_path + "/" + "env.pkl"
-    data_json_file = dist_path + "/" + f"macro.{ref}.json"
+    file_name = f"macro.{ref}.json"
+    store = open_store(dist_path)
 
     hash_str = str(data["owner_id"] + data["name"]).encode()
     data["_id"] = hashlib.sha256(hash_str).hexdigest()
 
-    with open(data_json_file, "r+") as json_file:
+    with store.transaction():
+        if not store.exists(file_name):
+            raise FileNotFoundError(f"No macro '{ref}' in '{dist_path}'")
 
-        data_from_json = json.load(json_file)
+        data_from_json = json.loads(store.read([file_name])[file_name])
         for k, v in data.items():
             data_from_json[k] = v
 
         new_macro = from_dict(Macro, data_from_json)
-        with open(env_cache_file, "rb") as env_pickle:
-            env_dict = pickle.load(env_pickle)
-            env = from_dict(Environment, env_dict)
+        new_file_name = f"macro.{new_macro._id}.json"
 
-            # removing macro first to avoid already used name error
-            for mac in env.macros:
-                # log.debug(f"Macro: {mac._id}, New Macro: {new_macro._id}")
-                if mac._id == new_macro._id:
-                    print("found same")
-                    env.macros.pop(env.macros.index(mac))
-            env.macros.append(new_macro)
+        if new_file_name != file_name and store.exists(new_file_name):
+            raise NameAlreadyUsedError(ref=new_macro.name)
 
-            # test build to see if theres any resolution errors
-            env.build()
+        # test build of the macro and the ones using it, the old name must not be used anymore
+        changes: Dict[str, Optional[Dict]] = {file_name: None}
+        changes[new_file_name] = asdict(new_macro)
+        check_changes(dist_path, cache_path, changes)
 
-        # Path(data_json_file).unlink()
+        # renamed: the new file and no old one, at once in a database
+        store.write(new_file_name, data_from_json, indent=4)
+        if new_file_name != file_name:
+            store.delete(file_name)
 
-        json_file.seek(0)
-        json.dump(data_from_json, json_file, indent=4)
-        json_file.truncate()
-    new_file = dist_path + "/" + f"macro.{data_from_json['_id']}.json"
 
-    Path(data_json_file).rename(Path(new_file))
+def delete_macro(ref: str, dist_path: str, cache_path: Optional[str] = None):
+    """cache_path: where the manifest of the last resolve is, to skip reading the unchanged files"""
 
+    file_name = f"macro.{ref}.json"
+    store = open_store(dist_path)
 
-def delete_macro(ref: str, dist_path: str):
-    data_json_file = dist_path + "/" + f"macro.{ref}.json"
-    Path(data_json_file).unlink()
+    with store.transaction():
+        # raising DependencyError if a macro/package uses it
+        check_delete(dist_path, cache_path, {file_name: None})
+
+        store.delete(file_name)
 
 
 """This is the macro builder script for swirl, this allows the app to create and modify macros.
 PARAMETERS:
-    dist_path: str  :: the data(env) directory of the app.
+    dist_path: str  :: the data(env) directory (or bundle/database, see envstore) of the app.
     cache_path: str :: the cache directory of the app.
     name: str       :: the name/new name of a macro.
     desc: str       :: the description/new description of a macro.
     vars: list[str] :: the list of var(s)/new var(s) of a macro.
     formula: str    :: the formula of a macro.
-    id: str         :: the id of a macro (only needed for edit action)
+    id: str         :: the id of a macro (only needed for edit and delete actions)
     action: str     :: the action to do on the data given ('create', 'edit', 'delete')
 
 SAMPLE SCHEMA:
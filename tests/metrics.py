@@ -0,0 +1,197 @@
+# call metrics of the macros, per macro: calls, errors, cumulative and self
+# time (without the macros it calls) and a latency histogram. Off by default,
+# macros made while it is on are measured (see data_models.make_macro).
+
+import time
+import threading
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# upper bounds of the latency histogram, in seconds
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class MacroStats(object):
+    __slots__ = ("calls", "errors", "total_time", "self_time", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last one: above them all
+
+
+class MacroMetrics(object):
+    """the stats of the measured macros, by label: the name of the macro,
+    after the path of its package for a macro of a package (mk.force, or
+    mk.science.force for a macro of science, a dependency of mk)"""
+
+    def __init__(self):
+        self.enabled = False
+        self._stats: Dict[str, MacroStats] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the macro calls running in a thread
+
+    def enable(self, enabled: bool = True) -> None:
+        """measure the macros made from now on (a loaded cache makes them on
+        their first call, stubs.MACRO_CACHE.clear() makes them again)"""
+
+        self.enabled = enabled
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def measured(self, label: str, func: Callable) -> "MeasuredMacro":
+        return MeasuredMacro(label, func, self)
+
+    def _running(self) -> List[float]:
+        try:
+            return self._local.running
+        except AttributeError:
+            running = self._local.running = [0.0]  # the time of the calls under the running ones
+            return running
+
+    def record(self, label: str, elapsed: float, children: float, error: bool) -> None:
+        bucket = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            stats = self._stats.get(label)
+            if stats is None:
+                stats = self._stats[label] = MacroStats()
+            stats.calls += 1
+            stats.errors += error
+            stats.total_time += elapsed
+            stats.self_time += elapsed - children
+            stats.buckets[bucket] += 1
+
+    # exports:
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """the stats of each macro, as json"""
+
+        with self._lock:
+            return {
+                label: {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "total_time": stats.total_time,
+                    "self_time": stats.self_time,
+                    "buckets": {str(bound): count for bound, count in zip(BUCKETS + ("+Inf",), cumulative(stats))},
+                }
+                for label, stats in sorted(self._stats.items())
+            }
+
+    def prometheus(self) -> str:
+        """the stats in the Prometheus text format"""
+
+        with self._lock:
+            stats = sorted(self._stats.items())
+            lines: List[str] = []
+
+            def family(name: str, kind: str, doc: str, samples: List[Tuple[str, str, float]]) -> None:
+                lines.append(f"# HELP {name} {doc}")
+                lines.append(f"# TYPE {name} {kind}")
+                for suffix, labels, value in samples:
+                    lines.append(f"{name}{suffix}{{{labels}}} {value!r}")
+
+            def labels(label: str) -> str:
+                return f'macro="{escape(label)}"'
+
+            family(
+                "swirl_macro_calls_total",
+                "counter",
+                "Calls of the macro.",
+                [("", labels(label), s.calls) for label, s in stats],
+            )
+            family(
+                "swirl_macro_errors_total",
+                "counter",
+                "Calls of the macro that raised.",
+                [("", labels(label), s.errors) for label, s in stats],
+            )
+            family(
+                "swirl_macro_self_seconds_total",
+                "counter",
+                "Time in the macro, without the macros it calls.",
+                [("", labels(label), s.self_time) for label, s in stats],
+            )
+
+            histogram: List[Tuple[str, str, float]] = []
+            for label, s in stats:
+                for bound, count in zip(BUCKETS + ("+Inf",), cumulative(s)):
+                    histogram.append(("_bucket", f'{labels(label)},le="{bound}"', count))
+                histogram.append(("_sum", labels(label), s.total_time))
+                histogram.append(("_count", labels(label), s.calls))
+            family("swirl_macro_duration_seconds", "histogram", "Duration of the calls of the macro.", histogram)
+
+        return "\n".join(lines) + "\n"
+
+
+def cumulative(stats: MacroStats) -> List[int]:
+    counts, total = [], 0
+    for count in stats.buckets:
+        total += count
+        counts.append(total)
+    return counts
+
+
+def escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MeasuredMacro(object):
+    """A macro recording its calls in metrics. The attributes of the macro
+    it wraps (formula, variables...) are its own, for the evaluators and the
+    cache (see cachefile.entry_spec)."""
+
+    def __init__(self, label: str, func: Callable, metrics: MacroMetrics):
+        self.label = label
+        self.func = func
+        self.metrics = metrics
+        self.__wrapped__ = func
+
+    def __getattr__(self, name: str):
+        if name == "func":  # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.func, name)
+
+    def __repr__(self):
+        return f"<measured {self.func!r}>"
+
+    def __call__(self, *args, **kwargs):
+        running = self.metrics._running()
+        running.append(0.0)
+        error = True
+        start = time.perf_counter()
+        try:
+            result = self.func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            children = running.pop()
+            running[-1] += elapsed
+            self.metrics.record(self.label, elapsed, children, error)
+
+
+METRICS = MacroMetrics()
+
+
+def macro_label(name: str, package: Optional[str] = None) -> str:
+    return name if package is None else f"{package}.{name}"
+
+
+"""
+USAGE:
+    METRICS.enable()        :: measure the macros made from now on
+    METRICS.snapshot()      :: {"mk.force": {"calls", "errors", "total_time", "self_time", "buckets"}}
+    METRICS.prometheus()    :: swirl_macro_calls_total{macro="mk.force"} 3 ...
+
+"""
@@ -0,0 +1,169 @@
+# build-time optimization of macro formulas, on their checked trees
+# an optimized tree gives the same results as the formula, bit for bit, and
+# raises the same errors: what can't be decided when building is left as it is.
+
+import ast
+import math
+
+from typing import Any, Dict, Iterable, Optional
+
+import evaluator as evl
+
+
+# the types a subtree can be folded into
+CONSTANT_TYPES = (int, float, complex, bool, str, type(None))
+
+# x ** n written as one operator (see evl.safe_square)
+POWERS = {2: evl.Square, 3: evl.Cube}
+
+
+class NotConstant(Exception):
+    pass
+
+
+class Optimizer(ast.NodeTransformer):
+    """Folds the constant subtrees of a formula, with the operators of
+    evl.DEFAULT_OPERATORS (and so their limits), math constants and math
+    functions of constants. Rewrites x ** 2 and x ** 3 (see POWERS).
+
+    Subtrees are folded as they are written, without reordering: (4 / 3) * math.pi * r
+    folds (4 / 3) * math.pi, and 4 / 3 * r * math.pi doesn't change.
+    """
+
+    def __init__(self, variables: Iterable[str] = (), env: Optional[Dict] = None):
+        self.variables = set(variables)
+        self.env = evl.DEFAULT_PACKAGES if env is None else env
+
+    def constant(self, node: ast.AST) -> Any:
+        if isinstance(node, ast.Constant):
+            return node.value
+        raise NotConstant
+
+    def fold(self, node: ast.AST, compute) -> ast.AST:
+        """node as a constant, if compute() gives one"""
+
+        try:
+            value = compute()
+        except Exception:
+            return node  # raised when evaluated, as before
+
+        if type(value) not in CONSTANT_TYPES:
+            return node
+        return ast.copy_location(ast.Constant(value=value), node)
+
+    def is_math(self, node: ast.AST) -> bool:
+        # the math module, if the namespace has it under that name and no variable hides it
+        return (
+            isinstance(node, ast.Name)
+            and node.id == "math"
+            and node.id not in self.variables
+            and self.env.get("math") is math
+        )
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        operator = evl.DEFAULT_OPERATORS.get(type(node.op))
+        if operator is None:
+            return node  # not supported, raised when evaluated
+
+        try:
+            left, right = self.constant(node.left), self.constant(node.right)
+        except NotConstant:
+            pass
+        else:
+            return self.fold(node, lambda: operator(left, right))
+
+        if isinstance(node.op, ast.Pow) and isinstance(node.right, ast.Constant) and type(node.right.value) is int:
+            power = POWERS.get(node.right.value)
+            if power is not None:
+                return ast.copy_location(ast.UnaryOp(op=power(), operand=node.left), node)
+
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        try:
+            operand = self.constant(node.operand)
+        except NotConstant:
+            return node
+        return self.fold(node, lambda: evl.DEFAULT_OPERATORS[type(node.op)](operand))
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+        try:
+            values = [self.constant(node.left)] + [self.constant(comparator) for comparator in node.comparators]
+        except NotConstant:
+            return node
+
+        def compare():
+            # as SimpleEval._eval_compare
+            to_return = True
+            for operation, left, right in zip(node.ops, values, values[1:]):
+                if not to_return:
+                    break
+                to_return = evl.DEFAULT_OPERATORS[type(operation)](left, right)
+            return to_return
+
+        return self.fold(node, compare)
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        try:
+            values = [self.constant(value) for value in node.values]
+        except NotConstant:
+            return node
+
+        vout = False
+        for vout in values:
+            if bool(vout) != isinstance(node.op, ast.And):
+                break
+        return ast.copy_location(ast.Constant(value=vout), node)
+
+    def visit_IfExp(self, node: ast.IfExp) -> ast.AST:
+        self.generic_visit(node)
+        try:
+            test = self.constant(node.test)
+        except NotConstant:
+            return node
+        return node.body if test else node.orelse
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        self.generic_visit(node)
+        if not self.is_math(node.value):
+            return node
+
+        value = getattr(math, node.attr, None)
+        if callable(value):
+            return node
+        return self.fold(node, lambda: getattr(math, node.attr))
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        func = node.func
+        if node.keywords or not (isinstance(func, ast.Attribute) and self.is_math(func.value)):
+            return node
+
+        try:
+            args = [self.constant(arg) for arg in node.args]
+        except NotConstant:
+            return node
+        return self.fold(node, lambda: getattr(math, func.attr)(*args))
+
+    # not folded: names, subscripts, comprehensions, f-strings...
+
+
+def optimize(node: ast.AST, variables: Iterable[str] = (), env: Optional[Dict] = None) -> ast.AST:
+    """the optimized tree of a checked formula (see Optimizer), variables:
+    the names given on each call, env: the namespace of the formula
+    (evl.DEFAULT_PACKAGES by default)"""
+
+    return Optimizer(variables, env).visit(node)
+
+
+"""
+EXAMPLES:
+    2 * math.pi * r        ->  6.283185307179586 * r
+    (4/3) * math.pi * r**3 ->  4.1887902047863905 * Cube(r)
+    math.sqrt(2) / x       ->  1.4142135623730951 / x
+
+"""
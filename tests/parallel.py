@@ -0,0 +1,200 @@
+# building an environment across a process pool, in waves: the entries of a
+# wave only refer to entries of the waves before it, so they are built (and
+# validated and tested) at the same time, each process taking a chunk.
+#
+# Built macros are closures and can't be sent back, the processes return the
+# cache specs of what they built (see cachefile.entry_spec), merged in the
+# order of a serial build, so the env (and its swl.cache) is the same.
+
+import uuid
+import logging
+
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import evaluator as evl
+import cachefile
+from analysis import DependencyGraph
+from data_models import Environment, Macro, Package
+
+
+log = logging.getLogger(__name__)  # type: ignore
+
+
+# (name, package/macro, the packages built before it, for a package)
+Entry = Tuple[str, Union[Package, Macro], Tuple[str, ...]]
+
+# (name, spec) of what a wave added, see build_env
+Specs = List[Tuple[str, tuple]]
+
+WAVES_PER_JOB = 4  # waves a build can have per process, deeper graphs are built serially
+
+
+def serial_entries(env_class: Environment) -> Optional[List[Entry]]:
+    """the entries in the order of Environment.build, None if a name is
+    used twice (the serial build raises it where it would)"""
+
+    entries: List[Entry] = list()
+    names = set(evl.DEFAULT_PACKAGES)
+    packages: List[str] = list()
+
+    for package in env_class.packages or []:
+        if package.name in names:
+            return None
+        entries.append((package.name, package, tuple(packages)))
+        names.add(package.name)
+        packages.append(package.name)
+
+    for macro in env_class.macros or []:
+        if macro.name in names:
+            return None
+        entries.append((macro.name, macro, ()))
+        names.add(macro.name)
+
+    return entries
+
+
+def waves(entries: List[Entry], graph: DependencyGraph) -> List[List[Entry]]:
+    """the entries split in waves, an entry coming after what it refers to.
+
+    A name an entry refers to that comes after it in the serial order (in a
+    cycle) isn't waited for, the serial build doesn't see it either.
+    """
+
+    wave_of: Dict[str, int] = dict()
+    split: List[List[Entry]] = list()
+
+    for entry in entries:
+        name = entry[0]
+        wave = 1 + max((wave_of[ref] for ref in graph.refs.get(name, ()) if ref in wave_of), default=-1)
+        wave_of[name] = wave
+
+        if wave == len(split):
+            split.append(list())
+        split[wave].append(entry)
+
+    return split
+
+
+def build_entry(env: Dict, entry: Entry) -> Any:
+    """an entry built as Environment.build does, in env"""
+
+    name, item, packages = entry
+    if isinstance(item, Package):
+        defaults = evl.Namespace(evl.DEFAULT_PACKAGES)
+        defaults.update({package: env[package] for package in packages if package in env})
+        return item.build(defaults=defaults)
+    return item.build(namespace=env)
+
+
+# the env of a pool process, kept from a wave to the next so that only what
+# the waves after add is sent (and the macros it made stay made):
+# (the build it is of, the number of waves it has the specs of, the env)
+_process_state: List[Any] = [None, 0, evl.Namespace()]
+
+
+def build_chunk(build: str, first: int, added: List[Specs], chunk: List[Entry]) -> List[Tuple[str, Optional[tuple]]]:
+    """run in a pool process: the specs of the entries of chunk, built in the
+    env of the specs of the waves before, None for an entry that raised.
+    added are the specs of the waves from first on, the process has the
+    ones before (see build_env)."""
+
+    logging.disable(logging.DEBUG)
+    if _process_state[0] != build:
+        _process_state[:] = [build, 0, evl.Namespace()]
+    _, known, env = _process_state
+    if known < first:
+        raise RuntimeError(f"Wave {first} sent to a process having {known}")
+
+    for specs in added[known - first :]:
+        cachefile.make_env([(name, spec) for name, spec in specs if name not in env], env=env)
+    _process_state[1] = first + len(added)
+
+    specs: List[Tuple[str, Optional[tuple]]] = list()
+    for entry in chunk:
+        try:
+            value = env[entry[0]] = build_entry(env, entry)
+        except Exception:
+            specs.append((entry[0], None))  # raised again by the serial build, see build_env
+        else:
+            specs.append((entry[0], cachefile.entry_spec(value)))
+    return specs
+
+
+def chunks(wave: List[Entry], count: int) -> List[List[Entry]]:
+    size = -(-len(wave) // count)
+    return [wave[i : i + size] for i in range(0, len(wave), size)]
+
+
+def build_env(
+    env_class: Environment, graph: DependencyGraph, reuse: Optional[Dict[str, Any]] = None, jobs: int = 1
+) -> Dict:
+    """the env of Environment.build(reuse), built in waves by jobs processes.
+
+    graph: the dependency graph of the env files (see resolver.dependency_graph).
+    Its macros are stubs (see cachefile.make_env). If something fails, the
+    rest is built serially, raising what (and where) the serial build raises.
+    """
+
+    reuse = reuse or {}
+    entries = serial_entries(env_class)
+    if entries is None or jobs <= 1:
+        return env_class.build(reuse=reuse)
+
+    specs: Dict[str, tuple] = {name: cachefile.entry_spec(reuse[name]) for name, _, _ in entries if name in reuse}
+    defaults = [(name, cachefile.entry_spec(module)) for name, module in evl.DEFAULT_PACKAGES.items()]
+
+    def env_specs() -> tuple:
+        return tuple(defaults + [(name, specs[name]) for name, _, _ in entries if name in specs])
+
+    to_build = [entry for entry in entries if entry[0] not in specs]
+    split = waves(to_build, graph)
+    if len(split) > WAVES_PER_JOB * jobs:
+        # a wave waits for the one before, deep graphs spend more in round trips than they save
+        log.debug(f"{len(split)} waves, building serially")
+        return env_class.build(reuse=reuse)
+
+    # the specs added by each wave, the first one being what is reused: a
+    # process (one per executor, so that chunks go to the one meant) is sent
+    # the ones it doesn't have yet
+    added: List[Specs] = [list(env_specs())]
+    known = [0] * jobs  # the number of waves of specs each process has
+    build = uuid.uuid4().hex
+    failed = False
+
+    with ExitStack() as stack:
+        processes = [stack.enter_context(ProcessPoolExecutor(max_workers=1)) for _ in range(jobs)]
+
+        for number, wave in enumerate(split):
+            log.debug(f"Building wave {number} ({len(wave)} entries)")
+            futures = []
+            for process, chunk in enumerate(chunks(wave, jobs)):
+                first = known[process]
+                futures.append(processes[process].submit(build_chunk, build, first, added[first:], chunk))
+                known[process] = len(added)
+
+            new_specs: Specs = list()
+            for future in futures:
+                for name, spec in future.result():
+                    if spec is None:
+                        failed = True
+                    else:
+                        specs[name] = spec
+                        new_specs.append((name, spec))
+            added.append(new_specs)
+
+            if failed:
+                break
+
+    env = cachefile.make_env(env_specs())
+    if failed:
+        log.debug("Building the rest serially")
+        for entry in entries:
+            if entry[0] not in specs:
+                env[entry[0]] = build_entry(env, entry)
+
+        # the serial order, with the entries built after the failure
+        env = cachefile.make_env(defaults + [(name, cachefile.entry_spec(env[name])) for name, _, _ in entries])
+
+    return env
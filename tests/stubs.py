@@ -0,0 +1,164 @@
+# macros of a loaded cache, made on their first call (see cachefile.load_env)
+# the made macros (with their parsed formula) are kept under a memory budget,
+# the least recently called ones are dropped back to their stub.
+
+import inspect
+import threading
+
+from collections import OrderedDict, namedtuple
+from types import CodeType
+from typing import Callable, Dict, Optional
+
+import evaluator as evl
+from data_models import formula_transform, make_macro
+
+
+MACRO_CACHE_BYTES = 64 * 1024 * 1024  # memory budget of the made macros
+
+
+MacroCacheInfo = namedtuple("MacroCacheInfo", ["made", "evicted", "currsize", "bytes", "max_bytes"])
+
+
+class MacroCache(object):
+    """the made macros, least recently called first"""
+
+    def __init__(self, max_bytes: int = MACRO_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.made = 0
+        self.evicted = 0
+        self.bytes = 0
+
+        self._stubs: OrderedDict = OrderedDict()  # stub -> size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stubs)
+
+    def add(self, stub: "MacroStub", size: int) -> None:
+        with self._lock:
+            if stub in self._stubs:
+                return
+            self._stubs[stub] = size
+            self.bytes += size
+            self.made += 1
+            self._evict(keep=stub)
+
+    def touch(self, stub: "MacroStub") -> None:
+        with self._lock:
+            try:
+                self._stubs.move_to_end(stub)
+            except KeyError:  # evicted meanwhile
+                pass
+
+    def configure(self, max_bytes: Optional[int] = None) -> None:
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            for stub in self._stubs:
+                stub._drop()
+            self._stubs.clear()
+            self.bytes = 0
+
+    def info(self) -> MacroCacheInfo:
+        return MacroCacheInfo(self.made, self.evicted, len(self._stubs), self.bytes, self.max_bytes)
+
+    def _evict(self, keep: Optional["MacroStub"] = None) -> None:
+        # the macro just made stays, even alone over the budget
+        while self._stubs and self.bytes > self.max_bytes:
+            stub, size = next(iter(self._stubs.items()))
+            if stub is keep:
+                break
+            del self._stubs[stub]
+            self.bytes -= size
+            self.evicted += 1
+            stub._drop()
+
+
+MACRO_CACHE = MacroCache()
+
+
+class MacroStub(object):
+    """A macro of a loaded cache: its formula, variables and the code of its
+    lambda, the callable (see data_models.make_macro) is made on first call.
+    >>> stub = MacroStub("double", "x * 2", ("x",), {}, True, 0)
+    >>> stub(4)
+    8
+    """
+
+    __slots__ = ("name", "expr", "variables", "env", "pure", "memo_size", "code", "package", "_parsed", "_macro")
+
+    def __init__(
+        self,
+        name: str,
+        expr: str,
+        variables: tuple,
+        env: Dict,
+        pure: bool,
+        memo_size: int,
+        code: Optional[CodeType] = None,
+        package: Optional[str] = None,
+    ):
+        self.name = name
+        self.expr = expr
+        self.variables = variables
+        self.env = env
+        self.pure = pure
+        self.memo_size = memo_size
+        self.code = code
+        self.package = package
+
+        self._parsed: Optional[evl.ParsedExpression] = None
+        self._macro: Optional[Callable] = None
+
+    def __repr__(self):
+        return f"<macro {self.name}{'' if self._macro is None else ' (made)'}>"
+
+    @property
+    def formula(self) -> evl.ParsedExpression:
+        """the formula, parsed on first use (it was checked by resolve)"""
+
+        parsed = self._parsed
+        if parsed is None:
+            transform = formula_transform(list(self.variables), self.env)
+            parsed = self._parsed = evl.ParsedExpression(self.expr, lazy=True, transform=transform)
+        return parsed
+
+    @property
+    def __signature__(self) -> inspect.Signature:
+        return inspect.signature(self.materialize())
+
+    def materialize(self) -> Callable:
+        macro = self._macro
+        if macro is None:
+            formula = self.formula
+            macro = make_macro(
+                self.name, formula, list(self.variables), self.env, self.pure, self.memo_size, self.code, self.package
+            )
+            self._macro = macro
+            MACRO_CACHE.add(self, formula.size())
+        return macro
+
+    def __call__(self, *args, **kwargs):
+        macro = self._macro
+        if macro is None:
+            macro = self.materialize()
+        else:
+            MACRO_CACHE.touch(self)
+        return macro(*args, **kwargs)
+
+    def _drop(self) -> None:
+        # calls in progress keep the macro they have
+        self._macro = None
+        self._parsed = None
+
+
+"""
+PARAMETERS:
+    MACRO_CACHE.configure(max_bytes=...)  :: the memory budget of the made macros,
+                                             estimated from their parsed formulas.
+
+"""
@@ -1,5 +1,41 @@
+import ast
+import asyncio
+import hashlib
+import json
+import marshal
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
-from evaluator import evaluate
+import dill
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+from evaluator import evaluate, EvalWithCompoundTypes, SimpleEval, ParsedExpression, ParseCache, ENGINES
+from evaluator import FeatureNotAvailable, CalculationDataNotFound, NameNotDefined, Session, get_session
+from evaluator import evaluate_many, evaluate_profiled, Namespace
+import cachefile
+import inspect
+from stubs import MACRO_CACHE, MacroStub
+from resolver import check_changes, check_delete, create_cache, resolve
+from resolver import dependency_graph, load_env_class, scan_env
+from parallel import WAVES_PER_JOB, build_env, serial_entries, waves
+from envstore import BundleStore, DirectoryStore, SqliteStore, open_store, pack, unpack
+from macro_builder import create_macro, delete_macro, edit_macro
+from analysis import DependencyGraph
+from optimizer import optimize
+from errors import DependencyError
+from daemon import EvalServer, connect, default_socket_path, evaluate_remote
+from vectorize import np, vector_eval, evaluate_vectorized
+from evaluator import NumberTooHigh, Cube, Square, DEFAULT_PACKAGES
+from evaluator import BudgetExceeded, InvalidExpression, limits, simple_eval, thread_budget
+from memo import MemoizedMacro, clear_memo_tables
+from metrics import METRICS, MeasuredMacro
+from data_models import Environment, Macro, Package
+from aio import AsyncEvaluator
 
 
 class MacroTest(unittest.TestCase):
@@ -84,5 +120,1261 @@ class RandomTest(unittest.TestCase):
         print(evaluate("best_girl", self.cache_path))
 
 
+class PrecompiledMacroTest(unittest.TestCase):
+    """To ensure that formulas are parsed once, when the macro is built"""
+
+    def setUp(self) -> None:
+        self.macro = Macro(
+            _id="",
+            owner_id="",
+            name="factorial",
+            variables=["num"],
+            formula="1 if num <= 1 else num*factorial(num-1)",
+        )
+
+    def test_recursive_macro(self):
+        factorial = self.macro.build(env={})
+        self.assertEqual(factorial(10), 3628800)
+
+    def test_no_parsing_on_call(self):
+        factorial = self.macro.build(env={})
+        with mock.patch("evaluator.ast.parse", side_effect=AssertionError("formula parsed again")):
+            self.assertEqual(factorial(5), 120)
+
+
+class SharedNamespaceTest(unittest.TestCase):
+    """To ensure that built macros share their namespace instead of copying it"""
+
+    def test_env_macros(self):
+        env_class = Environment(
+            "env",
+            macros=[Macro("a", "", "double", ["x"], "x * 2"), Macro("b", "", "quad", ["x"], "double(double(x))")],
+        )
+        env = env_class.build()
+        self.assertIs(env["double"].env, env)
+        self.assertIs(env["quad"].env, env)
+        self.assertEqual(env["quad"](3), 12)
+        self.assertEqual(DEFAULT_PACKAGES, {"math": math})
+
+    def test_package_macros(self):
+        macros = [Macro("a", "", "double", ["x"], "x * 2"), Macro("b", "", "half", ["x"], "x / 2")]
+        package = Package("p", "", "p", None, "", macros=macros).build(defaults={"math": math})
+        self.assertIs(package.double.env, package.half.env)
+        self.assertEqual(set(package.double.env), {"math", "double", "half"})
+
+
+    def test_failed_macro(self):
+        env = Namespace(DEFAULT_PACKAGES)
+        broken = Macro("a", "", "label", ["x"], "x + 'cm'", memo_size=0)
+        for _ in range(2):  # the first build left nothing behind
+            with self.assertRaises(TypeError):
+                broken.build(namespace=env)
+        self.assertNotIn("label", env)
+
+        label = Macro("b", "", "label", ["x"], "x * 2", memo_size=0).build(namespace=env)
+        self.assertIs(env["label"], label)
+
+class ClosureEngineTest(unittest.TestCase):
+    """To ensure that the closure engine matches the interpreter"""
+
+    exprs = [
+        "1 + 2 * 3 - x",
+        "'ab' * 3",
+        "2 ** 2000",
+        "x if x > 2 else -x",
+        "1 < x < 5 <= 5",
+        "x and y or 0",
+        "f'{x:>5} and {y}'",
+        "'abc'[::-1]",
+        "math.pi * x ** 2",
+        "math.__class__",
+        "int('5') + float(x)",
+        "nope(1)",
+        "nope",
+        "x.y",
+        "(lambda: 1)()",
+        "1 / 0",
+        "x in [1, 2, 3]",
+        "[a * b for a in range(3) for b in [a, a + 1] if b]",
+        "[[i for i in range(a)] for a in [1, 2, 3]]",
+        "{'a': x, 'b': (1, 2)}['b'][0:1]",
+        "[i for i in range(20000)]",
+        "import os",
+    ]
+
+    def run_engines(self, evaluator, expr):
+        results = []
+        for engine in ENGINES:
+            s = evaluator(names={"x": 3, "y": 0}, functions={"int": int, "float": float, "range": range, "math": math})
+            try:
+                results.append(("result", s.eval(expr, engine)))
+            except Exception as e:
+                results.append(("error", type(e), str(e)))
+        return results
+
+    def test_same_results(self):
+        for evaluator in (SimpleEval, EvalWithCompoundTypes):
+            for expr in self.exprs:
+                with self.subTest(evaluator=evaluator.__name__, expr=expr):
+                    interpreted, *others = self.run_engines(evaluator, expr)
+                    for other in others:
+                        self.assertEqual(interpreted, other)
+
+    def test_plan_is_reused(self):
+        parsed = ParsedExpression("x * 2")
+        s = SimpleEval(names={"x": 4})
+        self.assertEqual(s.eval(parsed, "closure"), 8)
+        plan = parsed.plans[SimpleEval]
+        self.assertEqual(s.eval(parsed, "closure"), 8)
+        self.assertIs(parsed.plans[SimpleEval], plan)
+
+    def test_macros_use_engine(self):
+        factorial = Macro(
+            _id="",
+            owner_id="",
+            name="factorial",
+            variables=["num"],
+            formula="1 if num <= 1 else num*factorial(num-1)",
+        ).build(env={})
+        s = SimpleEval(functions={"factorial": factorial})
+        self.assertEqual(s.eval("factorial(6)", "closure"), 720)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            SimpleEval().eval("1", "jit")
+
+    def test_evaluate(self):
+        self.assertEqual(
+            evaluate("mk.grav_pot_esc_spd(mass=20, radius=5) + mk.force(40, 45)", "tests/cache"),
+            evaluate("mk.grav_pot_esc_spd(mass=20, radius=5) + mk.force(40, 45)", "tests/cache", engine="closure"),
+        )
+
+
+class SharedTablesTest(unittest.TestCase):
+    """To ensure that evaluators share their dispatch and default tables"""
+
+    def test_shared(self):
+        a, b = SimpleEval(), SimpleEval()
+        self.assertIs(a.operators, b.operators)
+        self.assertIs(a.functions, b.functions)
+        self.assertIs(a._dispatch, b._dispatch)
+        with self.assertRaises(TypeError):
+            a.functions["f"] = abs
+
+    def test_subclass_dispatch(self):
+        class Doubling(SimpleEval):
+            def _eval_constant(self, node):
+                return node.value * 2
+
+        self.assertEqual(Doubling().eval("1 + 2"), 6)
+        self.assertEqual(SimpleEval().eval("1 + 2"), 3)
+        self.assertIsNot(Doubling._dispatch, SimpleEval._dispatch)
+
+    def test_instance_settings(self):
+        s = SimpleEval(names={"d": {"a": 1}})
+        s.ATTR_INDEX_FALLBACK = False
+        s.label = "no fallback"  # callers can still set their own attributes
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                with self.assertRaises(InvalidExpression):
+                    s.eval("d.a", engine)
+                self.assertEqual(SimpleEval(names={"d": {"a": 1}}).eval("d.a", engine), 1)
+
+        self.assertEqual(s.nodes[ast.BinOp](ast.parse("2 * 3").body[0].value), 6)
+        with self.assertRaises(TypeError):
+            s.nodes[ast.BinOp] = None
+
+    def test_compound_types(self):
+        functions = {"double": lambda x: x * 2}
+        s = EvalWithCompoundTypes(functions=functions)
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                self.assertEqual(s.eval("[double(x) * y for x in [1, 2] for y in (x, 3) if y > 1]", engine), [6, 8, 12])
+                self.assertEqual(s.eval("list((1, 2))", engine), [1, 2])
+        self.assertEqual(list(functions), ["double"])
+
+    def test_disallowed_functions(self):
+        self.assertRaises(FeatureNotAvailable, SimpleEval, functions={"e": eval})
+        self.assertRaises(TypeError, SimpleEval, functions={"values": [1, 2]})
+
+
+class NamespaceTest(unittest.TestCase):
+    """To ensure that namespaces are checked once, when filled"""
+
+    def test_checked_when_filled(self):
+        namespace = Namespace(math=math)
+        for fill in (
+            lambda: namespace.__setitem__("e", eval),
+            lambda: namespace.update({"e": eval}),
+            lambda: namespace.setdefault("e", eval),
+            lambda: namespace | {"e": eval},
+            lambda: Namespace(e=eval),
+        ):
+            with self.subTest(fill=fill):
+                self.assertRaises(FeatureNotAvailable, fill)
+        self.assertEqual(namespace, {"math": math})
+        self.assertIsInstance(namespace | {"x": 1}, Namespace)
+        self.assertIsInstance(namespace.copy(), Namespace)
+
+    def test_not_scanned(self):
+        namespace = Namespace(double=lambda x: x * 2, values=[1, 2])
+        with mock.patch("evaluator.check_functions") as check_functions:
+            self.assertEqual(SimpleEval(functions=namespace).eval("double(4)"), 8)
+            SimpleEval(functions={"double": abs})
+        check_functions.assert_called_once_with({"double": abs})
+
+    def test_resolved_env(self):
+        env = cachefile.read_cache("tests/cache")
+        self.assertIsInstance(env, Namespace)
+        self.assertIsInstance(env["Sine"].env, Namespace)
+
+
+class ParseCacheTest(unittest.TestCase):
+    """To ensure that repeated expressions are parsed once"""
+
+    def test_hits_and_misses(self):
+        cache = ParseCache(maxsize=4)
+        parsed = cache.get("mk.force(40, 45)")
+        self.assertIs(cache.get("mk.force(40, 45)"), parsed)
+        self.assertEqual(cache.info().hits, 1)
+        self.assertEqual(cache.info().misses, 1)
+
+    def test_lru_eviction(self):
+        cache = ParseCache(maxsize=2)
+        cache.get("1")
+        cache.get("2")
+        cache.get("1")
+        cache.get("3")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(set(cache._entries), {"1", "3"})
+
+    def test_memory_budget(self):
+        size = ParsedExpression("1 + 1").size()
+        cache = ParseCache(maxsize=100, max_bytes=size * 2)
+        for i in range(10):
+            cache.get(f"{i} + 1")
+        self.assertLessEqual(cache.info().bytes, size * 2)
+        self.assertEqual(len(cache), 2)
+
+        cache.configure(max_bytes=size)
+        self.assertEqual(len(cache), 1)
+
+    def test_errors_not_cached(self):
+        cache = ParseCache()
+        for _ in range(2):
+            with self.assertRaises(FeatureNotAvailable):
+                cache.get("x.__class__")
+        self.assertEqual(len(cache), 0)
+
+    def test_eval_uses_cache(self):
+        s = SimpleEval(names={"x": 2})
+        with mock.patch("evaluator.PARSE_CACHE", ParseCache()) as cache:
+            s.eval("x * 21")
+            self.assertEqual(s.eval("x * 21"), 42)
+            self.assertEqual(cache.info().hits, 1)
+
+
+class SessionTest(unittest.TestCase):
+    """To ensure that a session loads the cache once, and reloads it when it changes"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp.name
+        create_cache(self.cache_path, {"base": 1}, {})
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_loads_once(self):
+        session = Session(self.cache_path)
+        self.assertEqual(session.evaluate("base + 1"), 2)
+        with mock.patch("cachefile.load_env", side_effect=AssertionError("cache loaded again")):
+            self.assertEqual(session.evaluate("base + 2"), 3)
+        self.assertEqual(session.generation, 1)
+
+    def test_reloads_new_cache(self):
+        session = Session(self.cache_path)
+        self.assertEqual(session.evaluate("base + 1"), 2)
+        create_cache(self.cache_path, {"base": 10}, {})
+        self.assertEqual(session.evaluate("base + 1"), 11)
+        self.assertEqual(session.generation, 2)
+
+    def test_check_interval(self):
+        session = Session(self.cache_path, check_interval=0.1)
+        self.assertEqual(session.evaluate("base + 1"), 2)
+        with mock.patch.object(session, "_cache_stamp", side_effect=AssertionError("cache file checked")):
+            self.assertEqual(session.evaluate("base + 2"), 3)
+
+        # written by another process: seen once the interval is over
+        with mock.patch("evaluator.cache_written"):
+            create_cache(self.cache_path, {"base": 10}, {})
+        self.assertEqual(session.evaluate("base + 1"), 2)
+        time.sleep(0.1)
+        self.assertEqual(session.evaluate("base + 1"), 11)
+
+    def test_missing_cache(self):
+        with self.assertRaises(CalculationDataNotFound):
+            Session(self.tmp.name + "/nowhere").evaluate("1")
+
+    def test_default_session(self):
+        self.assertIs(get_session(self.cache_path), get_session(self.cache_path))
+        self.assertEqual(evaluate("base * 5", self.cache_path), 5)
+
+
+class EvaluateManyTest(unittest.TestCase):
+    """To ensure that a batch is evaluated in order, with errors per expression"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp.name
+        create_cache(self.cache_path, {"base": 1}, {})
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_results_in_order(self):
+        results = evaluate_many(["base + 1", "nope", "1 / 0", "base * 3"], self.cache_path)
+        self.assertEqual([r.result for r in results], [2, None, None, 3])
+        self.assertIsInstance(results[1].error, NameNotDefined)
+        self.assertIsInstance(results[2].error, ZeroDivisionError)
+        self.assertIsNone(results[3].error)
+
+    def test_one_evaluator(self):
+        session = Session(self.cache_path)
+        with mock.patch("evaluator.SimpleEval", wraps=SimpleEval) as evaluator:
+            session.evaluate_many([f"base + {i}" for i in range(10)], engine="closure")
+        self.assertEqual(evaluator.call_count, 1)
+
+    def test_stream(self):
+        results = evaluate_many((f"base + {i}" for i in range(3)), self.cache_path, stream=True)
+        self.assertEqual(next(results).result, 1)
+        self.assertEqual([r.result for r in results], [2, 3])
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class VectorizeTest(unittest.TestCase):
+    """To ensure that vectorized evaluation matches the scalar one"""
+
+    def setUp(self) -> None:
+        self.cache_path = "tests/cache"
+        self.session = get_session(self.cache_path)
+
+    def assert_elementwise(self, expr, **arrays):
+        result = evaluate_vectorized(expr, self.cache_path, arrays)
+        for i in range(len(result)):
+            scalars = ", ".join(f"{k}={v[i].item()!r}" for k, v in arrays.items())
+            expected = evaluate_scalar(self.session, expr, {k: v[i].item() for k, v in arrays.items()})
+            self.assertAlmostEqual(result[i], expected, msg=scalars)
+
+    def test_macros(self):
+        self.assert_elementwise("AreaofCircle(r)", r=np.linspace(0, 10, 50))
+        self.assert_elementwise("mk.grav_pot_esc_spd(mass=m, radius=5) + mk.force(40, m)", m=np.arange(1, 20))
+        self.assert_elementwise("Sine(x) ** 2 + Cosine(x) ** 2", x=np.linspace(-3, 3, 20))
+
+    def test_fallback(self):
+        factorial = Macro(
+            _id="",
+            owner_id="",
+            name="factorial",
+            variables=["num"],
+            formula="1 if num <= 1 else num*factorial(num-1)",
+        ).build(env={})
+        result = vector_eval("factorial(n)", {"n": np.arange(7)}, {"factorial": factorial})
+        self.assertEqual(result.tolist(), [1, 1, 2, 6, 24, 120, 720])
+
+    def test_scalar_errors(self):
+        with self.assertRaises(ZeroDivisionError):
+            vector_eval("1 / x", {"x": np.arange(3)})
+        with self.assertRaises(ValueError):
+            evaluate_vectorized("math.sqrt(x)", self.cache_path, {"x": np.array([4.0, -1.0])})
+
+    def test_power_limit(self):
+        with self.assertRaises(NumberTooHigh):
+            vector_eval("x ** 2", {"x": np.array([1, 5000])})
+
+
+def evaluate_scalar(session, expr, names):
+    return SimpleEval(functions=session.load(), names=names).eval(expr)
+
+
+class MemoTest(unittest.TestCase):
+    """To ensure that pure macros, and only those, are memoized"""
+
+    def build(self, name, variables, formula, env=None, **kwargs):
+        return Macro(_id="", owner_id="", name=name, variables=variables, formula=formula, **kwargs).build(
+            env=env or {}
+        )
+
+    def test_pure_macro(self):
+        factorial = self.build("factorial", ["num"], "1 if num <= 1 else num*factorial(num-1)")
+        self.assertIsInstance(factorial, MemoizedMacro)
+
+        factorial.clear()
+        self.assertEqual(factorial(10), 3628800)
+        self.assertEqual(factorial.info().misses, 10)
+        self.assertEqual(factorial(11), 39916800)
+        self.assertEqual(factorial.info().hits, 1)
+
+    def test_impure_macros(self):
+        env = {"rand": lambda: 4, "randint": lambda top: 4}
+        dice = self.build("dice", ["sides"], "randint(sides) + 1", env=env)
+        self.assertNotIsInstance(dice, MemoizedMacro)
+        self.assertFalse(dice.pure)
+
+        # reaching an impure macro
+        two_dice = self.build("two_dice", ["sides"], "dice(sides) + dice(sides)", env=env | {"dice": dice})
+        self.assertNotIsInstance(two_dice, MemoizedMacro)
+
+        # or an unknown function
+        other = self.build("other", ["x"], "x.conjugate()")
+        self.assertNotIsInstance(other, MemoizedMacro)
+
+    def test_package_macros(self):
+        env = get_session("tests/cache").load()
+        double = self.build("double_force", ["m"], "2 * mk.force(m, 9) + math.sqrt(m)", env=env)
+        self.assertIsInstance(double, MemoizedMacro)
+
+    def test_size_limit(self):
+        square = self.build("square", ["x"], "x * x", memo_size=2)
+        for i in range(5):
+            square(i)
+        self.assertEqual(square.info().currsize, 2)
+        self.assertNotIsInstance(self.build("square", ["x"], "x * x", memo_size=0), MemoizedMacro)
+
+    def test_typed_and_unhashable(self):
+        square = self.build("square", ["x"], "x * x")
+        square.clear()
+        self.assertIsInstance(square(2), int)
+        self.assertIsInstance(square(2.0), float)
+        self.assertEqual(square.info().misses, 2)
+
+        twice = self.build("twice", ["x"], "x * 2")
+        self.assertEqual(twice(x=[1]), [1, 1])
+
+    def test_signed_zero(self):
+        inverse = self.build("inverse", ["x"], "1 / x if x else math.copysign(1, x)")
+        self.assertIsInstance(inverse, MemoizedMacro)
+        self.assertEqual(inverse(0.0), 1)
+        self.assertEqual(inverse(-0.0), -1)
+        self.assertEqual(inverse(x=-0.0), -1)
+        self.assertNotEqual(MemoizedMacro.key((0j,), {}), MemoizedMacro.key((complex(0, -0.0),), {}))
+
+    def test_cleared_on_resolve(self):
+        square = self.build("square", ["x"], "x * x")
+        square(3)
+        clear_memo_tables()
+        self.assertEqual(square.info().currsize, 0)
+
+
+class DaemonTest(unittest.TestCase):
+    """To ensure that the daemon answers pipelined requests in order"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp.name
+        self.socket_path = default_socket_path(self.cache_path)
+        create_cache(self.cache_path, {"base": 1}, {})
+
+        self.server = EvalServer(self.socket_path, self.cache_path)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_pipelined(self):
+        with connect(self.socket_path) as client:
+            responses = client.evaluate_many([f"base + {i}" for i in range(50)] + ["nope", "0"])
+
+        self.assertEqual([r["result"] for r in responses[:50]], [str(i + 1) for i in range(50)])
+        self.assertEqual([r["id"] for r in responses], list(range(52)))
+        self.assertEqual(responses[50]["error"], "NameNotDefined")
+        self.assertFalse(responses[51]["truthy"])
+
+    def test_large_batch(self):
+        # more requests and responses than the socket buffers hold
+        with connect(self.socket_path, timeout=30) as client:
+            responses = client.evaluate_many([f"base + {i}" for i in range(20000)])
+
+        self.assertEqual(len(responses), 20000)
+        self.assertEqual(responses[-1], {"id": 19999, "result": "20000", "truthy": True})
+
+    def test_wedged_daemon(self):
+        # listening, never answering
+        wedged = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        wedged.bind(self.cache_path + "/wedged.sock")
+        wedged.listen()
+        with wedged:
+            self.assertIsNone(evaluate_remote(self.cache_path + "/wedged.sock", "base + 1", timeout=0.1))
+        self.assertEqual(evaluate_remote(self.socket_path, "base + 1")["result"], "2")
+
+    def test_no_daemon(self):
+        self.assertIsNone(connect(self.cache_path + "/other.sock"))
+
+
+class IncrementalResolveTest(unittest.TestCase):
+    """To ensure that resolve only builds the files that changed, and what refers to them"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env_path = self.tmp.name + "/env"
+        self.cache_path = self.tmp.name + "/cache"
+        os.mkdir(self.env_path)
+        os.mkdir(self.cache_path)
+
+        self.write_package("phys", {"g": "9.8"})
+        self.write_macro("weight", ["m"], "m * phys.g")
+        self.write_macro("square", ["x"], "x * x")
+        resolve(self.env_path, self.cache_path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def write_macro(self, name, variables, formula):
+        data = {"_id": "", "owner_id": "", "name": name, "variables": variables, "formula": formula}
+        with open(f"{self.env_path}/macro.{name}.json", "w") as json_file:
+            json.dump(data, json_file)
+
+    def write_package(self, name, constants):
+        macros = [
+            {"_id": "", "owner_id": "", "name": const, "variables": [], "formula": formula}
+            for const, formula in constants.items()
+        ]
+        data = {"_id": "", "owner_id": "", "name": name, "description": "", "date_created": "", "macros": macros}
+        with open(f"{self.env_path}/package.{name}.json", "w") as json_file:
+            json.dump(data, json_file)
+
+    def resolve(self, full=False):
+        """the names of the macros built"""
+
+        with mock.patch.object(Macro, "test_macro", autospec=True, side_effect=lambda macro, *args: macro) as tested:
+            resolve(self.env_path, self.cache_path, full=full)
+        return sorted(call.args[0].name for call in tested.call_args_list)
+
+    def test_nothing_changed(self):
+        with mock.patch("resolver.create_cache", side_effect=AssertionError("cache written again")):
+            self.assertEqual(self.resolve(), [])
+        self.assertEqual(evaluate("weight(2)", self.cache_path), 19.6)
+
+    def test_changed_and_dependents(self):
+        self.write_package("phys", {"g": "10"})
+        self.assertEqual(self.resolve(), ["g", "weight"])
+        self.assertEqual(evaluate("weight(2) + square(3)", self.cache_path), 29)
+
+    def test_added_and_deleted(self):
+        self.write_macro("cube", ["x"], "x ** 3")
+        os.remove(f"{self.env_path}/macro.weight.json")
+        self.assertEqual(self.resolve(), ["cube"])
+
+        env = get_session(self.cache_path).load()
+        self.assertEqual(env["cube"](3), 27)
+        self.assertNotIn("weight", env)
+
+    def test_full(self):
+        self.assertEqual(self.resolve(full=True), ["g", "square", "weight"])
+
+    def test_referenced_first(self):
+        # whatever the order of the files
+        self.write_macro("a_cube", ["x"], "x * z_square(x)")
+        self.write_macro("z_square", ["x"], "x * x")
+        self.assertEqual(self.resolve(), ["a_cube", "z_square"])
+        self.assertEqual(evaluate("a_cube(3)", self.cache_path), 27)
+
+    def test_targeted_build(self):
+        self.write_macro("cube", ["x"], "x * square(x)")
+        resolve(self.env_path, self.cache_path)
+
+        with mock.patch.object(Macro, "build", autospec=True, wraps=Macro.build) as built:
+            square = {"_id": "", "owner_id": "", "name": "square", "variables": ["y"], "formula": "y ** 2"}
+            changes = {"macro.square.json": square}
+            self.assertEqual(check_changes(self.env_path, self.cache_path, changes), ["square", "cube"])
+        self.assertEqual(built.call_count, 2)
+
+    def test_delete_used(self):
+        with self.assertRaises(DependencyError) as e:
+            check_delete(self.env_path, self.cache_path, {"package.phys.json": None})
+        self.assertEqual(e.exception.dependents, ["weight"])
+
+        check_delete(self.env_path, self.cache_path, {"macro.weight.json": None})
+
+
+class CacheFileTest(unittest.TestCase):
+    """To ensure that swl.cache gives the environment back, without pickles of closures"""
+
+    def setUp(self) -> None:
+        self.env = get_session("tests/cache").load()
+        self.data = cachefile.dump_env(self.env)
+
+    def test_same_results(self):
+        env = cachefile.load_env(self.data)
+        self.assertEqual(list(env), list(self.env))
+
+        for expr in ["mk.grav_pot_esc_spd(mass=20, radius=5) + mk.force(40, 45)", "mk.best_girl", "AreaofCircle(5)"]:
+            with self.subTest(expr=expr):
+                self.assertEqual(SimpleEval(functions=env).eval(expr), SimpleEval(functions=self.env).eval(expr))
+
+    def test_macros(self):
+        env = cachefile.load_env(self.data)
+        self.assertIsInstance(env["AreaofCircle"].materialize(), MemoizedMacro)
+        self.assertIs(env["AreaofCircle"].env, env)
+        self.assertIs(env["math"], math)
+        self.assertEqual(env["mk"].__bases__[0].__name__, "science")
+
+    def test_values(self):
+        env = {"base": 1, "name": "swirl", "points": [(1, 2)], "path": Path("a")}
+        self.assertEqual(cachefile.load_env(cachefile.dump_env(env)), env)
+
+    def test_other_python(self):
+        with mock.patch("importlib.util.MAGIC_NUMBER", b"\0\0\r\n"):
+            env = cachefile.load_env(self.data)
+        self.assertEqual(env["VolumeOfCuboid"](2, 3), self.env["VolumeOfCuboid"](2, 3))
+
+    def test_other_format(self):
+        with self.assertRaises(cachefile.CacheVersionError):
+            cachefile.load_env(b"\x80\x04" + self.data)
+
+    def test_legacy_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(tmp + "/swl.pkl", "wb") as legacy:
+                dill.dump({"base": 2}, legacy)
+            self.assertEqual(evaluate("base * 3", tmp), 6)
+
+
+class MacroStubTest(unittest.TestCase):
+    """To ensure that loaded macros are made on first call, and dropped under the memory budget"""
+
+    def setUp(self) -> None:
+        self.data = cachefile.dump_env(get_session("tests/cache").load())
+        self.max_bytes = MACRO_CACHE.max_bytes
+
+    def tearDown(self) -> None:
+        MACRO_CACHE.configure(max_bytes=self.max_bytes)
+
+    def test_made_on_first_call(self):
+        with mock.patch("stubs.make_macro", side_effect=AssertionError("made on load")):
+            env = cachefile.load_env(self.data)
+
+        self.assertIsInstance(env["Sine"], MacroStub)
+        self.assertIsNone(env["Sine"]._macro)
+        self.assertEqual(SimpleEval(functions=env).eval("Sine(1) + mk.force(2, 3)"), math.sin(1) + 6)
+        self.assertIsNotNone(env["Sine"]._macro)
+
+    def test_memory_budget(self):
+        env = cachefile.load_env(self.data)
+        MACRO_CACHE.configure(max_bytes=1)
+        evicted = MACRO_CACHE.info().evicted
+
+        for _ in range(2):
+            self.assertEqual(env["Sine"](1) + env["Cosine"](1), math.sin(1) + math.cos(1))
+        self.assertEqual(MACRO_CACHE.info().currsize, 1)
+        self.assertEqual(MACRO_CACHE.info().evicted - evicted, 3)
+        self.assertIsNone(env["Sine"]._macro)
+
+    def test_signature(self):
+        env = cachefile.load_env(self.data)
+        self.assertEqual(list(inspect.signature(env["VolumeOfCuboid"]).parameters), ["w", "h"])
+
+
+class ParallelBuildTest(unittest.TestCase):
+    """To ensure that an env built in waves by a process pool is the one built serially"""
+
+    def setUp(self) -> None:
+        self.files = scan_env("tests/test_env")
+        self.env_class = load_env_class(self.files)
+        self.graph = dependency_graph(self.files)
+
+    def entries(self, env):
+        data = cachefile.dump_env(env)
+        length = cachefile.HEADER.unpack_from(data)[3]
+        return marshal.loads(data[cachefile.HEADER.size : cachefile.HEADER.size + length])
+
+    def test_same_env(self):
+        env = build_env(self.env_class, self.graph, jobs=2)
+        self.assertEqual(self.entries(env), self.entries(self.env_class.build()))
+        self.assertEqual(env["mk"].force(2, 3), 6)
+
+    def test_waves(self):
+        graph = DependencyGraph({"c": {"b"}, "b": {"a"}, "a": set(), "d": set()})
+        macros = [Macro("", "", name, ["x"], "x") for name in ("a", "b", "d", "c")]
+        split = waves(serial_entries(Environment("", macros=macros)), graph)
+        self.assertEqual([[entry[0] for entry in wave] for wave in split], [["a", "d"], ["b"], ["c"]])
+
+    def chain(self, length):
+        macros = [Macro("", "", "a1", ["x"], "x")]
+        macros += [Macro("", "", f"a{i}", ["x"], f"a{i - 1}(x) + 1") for i in range(2, length + 1)]
+        graph = DependencyGraph({f"a{i}": {f"a{i - 1}", "x"} for i in range(2, length + 1)} | {"a1": {"x"}})
+        return Environment("", macros=macros), graph
+
+    def test_chain(self):
+        # each wave is sent what the waves before added, to the processes not having it
+        env_class, graph = self.chain(WAVES_PER_JOB * 2)
+        sent = []
+
+        class Executor(ProcessPoolExecutor):
+            def submit(self, fn, *args):
+                sent.append([name for specs in args[2] for name, _ in specs])
+                return super().submit(fn, *args)
+
+        with mock.patch("parallel.ProcessPoolExecutor", Executor):
+            env = build_env(env_class, graph, jobs=2)
+        self.assertEqual(sent[1:], [[f"a{i}"] for i in range(1, WAVES_PER_JOB * 2)])
+        self.assertEqual(self.entries(env), self.entries(env_class.build()))
+        self.assertEqual(env[f"a{WAVES_PER_JOB * 2}"](1), WAVES_PER_JOB * 2)
+
+    def test_deep_graph(self):
+        env_class, graph = self.chain(WAVES_PER_JOB * 2 + 1)
+        with mock.patch("parallel.ProcessPoolExecutor", side_effect=AssertionError("built in a pool")):
+            env = build_env(env_class, graph, jobs=2)
+        self.assertEqual(env[f"a{WAVES_PER_JOB * 2 + 1}"](1), WAVES_PER_JOB * 2 + 1)
+
+    def test_serial_error(self):
+        self.env_class.macros.append(Macro("", "", "broken", ["x"], "math.sqrt(-x)"))
+        self.graph = DependencyGraph(dict(self.graph.refs, broken={"math", "x"}))
+        with self.assertRaises(ValueError) as serial:
+            self.env_class.build()
+        with self.assertRaises(ValueError) as parallel:
+            build_env(self.env_class, self.graph, jobs=2)
+        self.assertEqual(str(parallel.exception), str(serial.exception))
+
+
+class BundleTest(unittest.TestCase):
+    """To ensure that an env bundle gives the env of its directory"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bundle_path = self.tmp.name + "/env.swlb"
+        self.bundle = pack("tests/test_env", self.bundle_path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_same_files(self):
+        directory = DirectoryStore("tests/test_env")
+        files = directory.files()
+        self.assertEqual(sorted(self.bundle.files()), sorted(files))
+        self.assertEqual(self.bundle.read(files), directory.read(files))
+        self.assertEqual(DirectoryStore("tests/test_env", readers=1).read(files), directory.read(files))
+
+        unpacked = unpack(self.bundle_path, self.tmp.name + "/env")
+        self.assertEqual(unpacked.read(files), directory.read(files))
+
+    def test_resolve(self):
+        resolve(self.bundle_path, self.tmp.name)
+        self.assertEqual(evaluate("mk.force(2, 3) + Sine(1)", self.tmp.name), 6 + math.sin(1))
+
+    def test_appended(self):
+        macro_file = next(file for file in self.bundle.files() if file.startswith("macro"))
+        self.bundle.write("macro.added.json", {"name": "added"})
+        self.bundle.delete(macro_file)
+
+        # another reader, with the index of the packed bundle
+        bundle = BundleStore(self.bundle_path)
+        self.assertIn("macro.added.json", bundle.files())
+        self.assertNotIn(macro_file, bundle.files())
+        self.assertEqual(json.loads(bundle.read(["macro.added.json"])["macro.added.json"]), {"name": "added"})
+
+        size = os.path.getsize(self.bundle_path)
+        bundle.compact()
+        self.assertLess(os.path.getsize(self.bundle_path), size)
+        self.assertEqual(sorted(BundleStore(self.bundle_path).files()), sorted(bundle.files()))
+
+    def test_empty_file(self):
+        env_path = self.tmp.name + "/env"
+        os.mkdir(env_path)
+        Path(env_path + "/macro.empty.json").touch()
+        Path(env_path + "/macro.full.json").write_text("{}")
+        bundle = pack(env_path, self.tmp.name + "/empty.swlb")
+        bundle.delete("macro.full.json")
+
+        unpacked = unpack(self.tmp.name + "/empty.swlb", self.tmp.name + "/unpacked")
+        self.assertEqual(unpacked.files(), ["macro.empty.json"])
+        self.assertEqual(unpacked.read_file("macro.empty.json"), b"")
+
+    def test_macro_builder(self):
+        cache_path = self.tmp.name
+        resolve(self.bundle_path, cache_path)
+        data = {"name": "twice", "owner_id": "o", "variables": "['x']", "formula": "x * 2", "description": ""}
+        create_macro(self.bundle_path, cache_path, data)
+        resolve(self.bundle_path, cache_path)
+        self.assertEqual(evaluate("twice(4)", cache_path), 8)
+
+        ref = hashlib.sha256(b"otwice").hexdigest()
+        edit_macro(ref, self.bundle_path, cache_path, {"name": "thrice", "owner_id": "o", "formula": "x * 3"})
+        resolve(self.bundle_path, cache_path)
+        self.assertEqual(evaluate("thrice(4)", cache_path), 12)
+
+        delete_macro(hashlib.sha256(b"othrice").hexdigest(), self.bundle_path, cache_path)
+        self.assertNotIn("thrice", resolve(self.bundle_path, cache_path))
+
+
+class SqliteStoreTest(unittest.TestCase):
+    """To ensure that an env database gives the env of its directory, and writes in transactions"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = self.tmp.name + "/env.db"
+        self.db = pack("tests/test_env", self.db_path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_same_files(self):
+        self.assertIsInstance(self.db, SqliteStore)
+        self.assertIsInstance(open_store(self.db_path), SqliteStore)
+        directory = DirectoryStore("tests/test_env")
+        files = directory.files()
+        self.assertEqual(sorted(self.db.files()), sorted(files))
+        self.assertEqual(self.db.read(files), directory.read(files))
+
+        unpacked = unpack(self.db_path, self.tmp.name + "/env")
+        self.assertEqual(unpacked.read(files), directory.read(files))
+
+    def test_find(self):
+        macro_file = next(file for file in self.db.files() if file.startswith("macro"))
+        data = json.loads(self.db.read([macro_file])[macro_file])
+        self.assertEqual(self.db.find(name=data["name"]), [macro_file])
+        self.assertIn(macro_file, self.db.find(owner_id=data["owner_id"]))
+        self.assertEqual(self.db.find(_id=data["_id"], name="not a name"), [])
+        with self.assertRaises(TypeError):
+            self.db.find(formula="x")
+
+    def test_stamps(self):
+        stamps = self.db.stamps()
+        macro_file = next(file for file in stamps if file.startswith("macro"))
+        data = json.loads(self.db.read([macro_file])[macro_file])
+        self.db.write(macro_file, data)
+
+        changed = {file for file, stamp in self.db.stamps().items() if stamp != stamps[file]}
+        self.assertEqual(changed, {macro_file})
+
+    def test_transaction(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.write("macro.added.json", {"name": "added"})
+                self.assertTrue(self.db.exists("macro.added.json"))
+                raise ValueError
+        self.assertFalse(SqliteStore(self.db_path).exists("macro.added.json"))
+
+        with self.assertRaises(FileNotFoundError):
+            self.db.delete("macro.added.json")
+
+    def test_resolve(self):
+        resolve(self.db_path, self.tmp.name)
+        self.assertEqual(evaluate("mk.force(2, 3) + Sine(1)", self.tmp.name), 6 + math.sin(1))
+
+    def test_macro_builder(self):
+        cache_path = self.tmp.name
+        resolve(self.db_path, cache_path)
+        data = {"name": "twice", "owner_id": "o", "variables": "['x']", "formula": "x * 2", "description": ""}
+        create_macro(self.db_path, cache_path, data)
+        resolve(self.db_path, cache_path)
+        self.assertEqual(evaluate("twice(4)", cache_path), 8)
+
+        ref = hashlib.sha256(b"otwice").hexdigest()
+        edit_macro(ref, self.db_path, cache_path, {"name": "thrice", "owner_id": "o", "formula": "x * 3"})
+        self.assertEqual(self.db.find(owner_id="o"), [f"macro.{hashlib.sha256(b'othrice').hexdigest()}.json"])
+        resolve(self.db_path, cache_path)
+        self.assertEqual(evaluate("thrice(4)", cache_path), 12)
+
+        delete_macro(hashlib.sha256(b"othrice").hexdigest(), self.db_path, cache_path)
+        self.assertNotIn("thrice", resolve(self.db_path, cache_path))
+
+    def test_failed_edit(self):
+        files = self.db.read(self.db.files())
+        macro_file = next(file for file in files if file.startswith("macro"))
+        ref = macro_file.split(".")[1]
+        with self.assertRaises(Exception):
+            edit_macro(ref, self.db_path, self.tmp.name, {"formula": "x +"})
+        self.assertEqual(self.db.read(self.db.files()), files)
+
+
+class ProfileTest(unittest.TestCase):
+    """To ensure that profiled evaluations count and time their nodes, and the ones of the macros called"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp.name
+        resolve("tests/test_env", self.cache_path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_counts(self):
+        s = SimpleEval(names={"x": 2})
+        result, report = s.profile("x * 3 + x * 4 if x < 3 else 0")
+        self.assertEqual(result, 14)
+        self.assertEqual(report.nodes["BinOp.Mult"].count, 2)
+        self.assertEqual(report.nodes["BinOp.Add"].count, 1)
+        self.assertEqual(report.nodes["Compare.Lt"].count, 1)
+        self.assertEqual(report.nodes["Name"].count, 3)
+        self.assertGreaterEqual(report.total_time, report.nodes["IfExp"].total_time)
+        self.assertEqual(json.loads(json.dumps(report.as_dict()))["nodes"]["BinOp.Mult"]["count"], 2)
+
+        # not profiled anymore
+        self.assertIs(type(s), SimpleEval)
+        self.assertEqual(s.eval("x * 3"), 6)
+
+    def test_comprehension(self):
+        s = EvalWithCompoundTypes(functions={"sum": sum, "range": range})
+        result, report = s.profile("sum([i * 2 for i in range(10)])")
+        self.assertEqual(result, 90)
+        self.assertEqual(report.nodes["BinOp.Mult"].count, 10)
+        self.assertEqual(report.nodes["ListComp"].count, 1)
+
+    def test_macros(self):
+        result, report = evaluate_profiled("mk.force(2, 3) + Sine(1)", self.cache_path)
+        self.assertEqual(result, 6 + math.sin(1))
+        self.assertEqual(report.nodes["Call.mk.force"].count, 1)
+        self.assertEqual(report.nodes["Call.math.sin"].count, 1)  # in Sine
+        self.assertEqual(report.nodes["Expr"].count, 3)  # the expression and both formulas
+
+        call = report.nodes["Call.Sine"]
+        self.assertLess(call.self_time, call.total_time)
+        self.assertAlmostEqual(sum(stats.self_time for stats in report.nodes.values()), report.total_time, places=6)
+
+    def test_recursion(self):
+        s = SimpleEval(names={"x": 1})
+        report = s.profile("((x + 1) + 1) + 1").report
+        self.assertEqual(report.nodes["BinOp.Add"].count, 3)
+        self.assertLessEqual(report.nodes["BinOp.Add"].total_time, report.total_time)
+
+    def test_error(self):
+        s = SimpleEval()
+        with self.assertRaises(NameNotDefined):
+            s.profile("1 + y")
+        self.assertIs(type(s), SimpleEval)
+        self.assertEqual(s.eval("2 * 3", "closure"), 6)
+
+
+class MetricsTest(unittest.TestCase):
+    """To ensure that measured macros record their calls, labelled with their package"""
+
+    def setUp(self) -> None:
+        METRICS.reset()
+        METRICS.enable()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        METRICS.enable(False)
+        METRICS.reset()
+        self.tmp.cleanup()
+
+    def test_calls(self):
+        env = Namespace(DEFAULT_PACKAGES)
+        inverse = Macro("inverse", "o", "inverse", ["x"], "1 / x", memo_size=0).build(namespace=env)
+        twice = Macro("twice", "o", "twice", ["x"], "inverse(x) * 2", memo_size=0).build(namespace=env)
+        self.assertIsInstance(twice, MeasuredMacro)
+        METRICS.reset()  # the test calls of the build
+
+        self.assertEqual(twice(4), 0.5)
+        with self.assertRaises(ZeroDivisionError):
+            twice(0)
+
+        snapshot = METRICS.snapshot()
+        self.assertEqual(snapshot["twice"]["calls"], 2)
+        self.assertEqual(snapshot["twice"]["errors"], 1)
+        self.assertEqual(snapshot["inverse"]["errors"], 1)
+        self.assertLess(snapshot["twice"]["self_time"], snapshot["twice"]["total_time"])
+        self.assertEqual(snapshot["twice"]["buckets"]["+Inf"], 2)
+
+        text = METRICS.prometheus()
+        self.assertIn('swirl_macro_calls_total{macro="twice"} 2', text)
+        self.assertIn('swirl_macro_duration_seconds_count{macro="inverse"} 2', text)
+        self.assertIn("# TYPE swirl_macro_duration_seconds histogram", text)
+
+        # cached as the macro it measures
+        self.assertEqual(cachefile.entry_spec(twice), cachefile.entry_spec(twice.func))
+        self.assertEqual(inspect.signature(twice), inspect.signature(twice.func))
+
+    def test_packages(self):
+        resolve("tests/test_env", self.tmp.name)
+        METRICS.reset()  # the test calls of the build
+        session = Session(self.tmp.name)
+        session.evaluate("mk.force(2, 3) + mk.grav_pot_esc_spd(1, 2) + science.force(1, 2)")
+
+        calls = {label: stats["calls"] for label, stats in METRICS.snapshot().items()}
+        self.assertEqual(calls["mk.science.force"], 1)
+        self.assertEqual(calls["mk.grav_pot_esc_spd"], 1)
+        self.assertEqual(calls["mk.science.grav_pot_esc_spd"], 1)
+        self.assertEqual(calls["science.force"], 1)
+
+    def test_disabled(self):
+        METRICS.enable(False)
+        macro = Macro("inverse", "o", "inverse", ["x"], "1 / x", memo_size=0).build()
+        self.assertNotIsInstance(macro, MeasuredMacro)
+        macro(2)
+        self.assertEqual(METRICS.snapshot(), {})
+
+
+class BudgetTest(unittest.TestCase):
+    """To ensure that evaluations, with the macros they call, stop at their step budget or their deadline"""
+
+    def test_steps(self):
+        s = SimpleEval()
+        for engine in ENGINES:
+            with self.subTest(engine=engine), limits(max_steps=10):
+                self.assertEqual(s.eval("1 + 2 * 3", engine), 7)  # 6 nodes
+                with self.assertRaises(BudgetExceeded):
+                    s.eval("1 + 2 * 3 + 4 * 5 + 6", engine)
+
+    def test_comprehension(self):
+        s = EvalWithCompoundTypes(functions={"range": range})
+        for engine in ENGINES:
+            with self.subTest(engine=engine), limits(max_steps=100):
+                self.assertEqual(len(s.eval("[i * 2 for i in range(10)]", engine)), 10)
+                with self.assertRaises(BudgetExceeded):
+                    s.eval("[i * 2 for i in range(100)]", engine)
+
+    def test_nested(self):
+        # a macro calling a macro calling... shares the budget of the expression
+        def deep(n):
+            return SimpleEval(functions={"deep": deep}, names={"n": n}).eval("deep(n - 1) + 1 if n > 0 else 0")
+
+        s = SimpleEval(functions={"deep": deep})
+        with limits(max_steps=500):  # about 16 steps a call
+            self.assertEqual(s.eval("deep(20)"), 20)
+            with self.assertRaises(BudgetExceeded):
+                s.eval("deep(40)")
+            self.assertEqual(s.eval("deep(20)"), 20)  # a new budget
+        self.assertEqual(thread_budget().depth, 0)
+
+    def test_unpickled(self):
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                parsed = dill.loads(dill.dumps(ParsedExpression("1 + 2 * 3", lazy=lazy)))
+                with limits(max_steps=10):
+                    self.assertEqual(SimpleEval().eval(parsed), 7)
+                self.assertEqual(parsed.steps, ParsedExpression("1 + 2 * 3").steps)
+
+    def test_deadline(self):
+        def slow():
+            time.sleep(0.02)
+            return 1
+
+        s = EvalWithCompoundTypes(functions={"slow": slow, "range": range})
+        with mock.patch("evaluator.BUDGET_CHECK_STEPS", 1), limits(timeout=0.01):
+            with self.assertRaisesRegex(BudgetExceeded, "too long"):
+                s.eval("[slow() for i in range(10)]")
+            self.assertEqual(s.eval("1 + 1"), 2)
+
+    def test_returned(self):
+        # the steps leased and not run go back to the budget
+        s = SimpleEval(functions={"f": lambda: SimpleEval().eval("1 + 1")})
+        with limits(max_steps=5000):
+            self.assertEqual(s.eval(" + ".join(["f()"] * 20)), 40)
+            self.assertTrue(4800 < thread_budget().left < 5000)
+
+    def test_invalid_expression(self):
+        with limits(max_steps=1):
+            self.assertRaises(InvalidExpression, simple_eval, "1 + 1")
+
+
+class StackEngineTest(unittest.TestCase):
+    """To ensure that the stack engine runs macros calling each other on its own stack, as the other engines do"""
+
+    def macro(self, name, variables, formula, memo_size=0):
+        return Macro(_id="", owner_id="", name=name, variables=variables, formula=formula, memo_size=memo_size)
+
+    def test_deep_recursion(self):
+        factorial = self.macro("factorial", ["num"], "1 if num <= 1 else num * factorial(num - 1)").build()
+        s = SimpleEval(functions=factorial.env)
+        self.assertEqual(s.eval("factorial(3000)", "stack"), math.factorial(3000))
+        with self.assertRaises(RecursionError):
+            s.eval("factorial(3000)", "interpreter")
+
+        # deep as the step budget lets it
+        with limits(max_steps=1000), self.assertRaises(BudgetExceeded):
+            s.eval("factorial(3000)", "stack")
+
+    def test_memoized(self):
+        fib = self.macro("fib", ["n"], "n if n < 2 else fib(n - 1) + fib(n - 2)", memo_size=None).build()
+        self.assertIsInstance(fib, MemoizedMacro)
+        s = SimpleEval(functions=fib.env)
+        self.assertEqual(s.eval("fib(300)", "stack"), s.eval("fib(300)", "closure"))  # memoized
+        self.assertEqual(fib.info().misses, 301)
+        self.assertEqual(s.eval("fib(90)", "stack"), 2880067194370816120)
+
+    def test_arguments(self):
+        hyp = self.macro("hyp", ["a", "b=4"], "math.sqrt(a ** 2 + b ** 2)").build()
+        s = SimpleEval(functions=hyp.env)
+        for expr in ("hyp(3)", "hyp(6, b=8)", "hyp(b=8, a=6)", "hyp()", "hyp(1, 2, 3)", "hyp(1, c=2)"):
+            with self.subTest(expr=expr):
+                results = []
+                for engine in ENGINES:
+                    try:
+                        results.append(s.eval(expr, engine))
+                    except TypeError as e:
+                        results.append(str(e))
+                self.assertEqual(results, [results[0]] * len(ENGINES))
+
+    def test_errors(self):
+        broken = self.macro("broken", ["x"], "x + y")
+        with self.assertRaises(NameNotDefined):  # tested when built
+            broken.build()
+
+        s = EvalWithCompoundTypes(names={"x": 2}, functions={"range": range})
+        with self.assertRaises(ZeroDivisionError):
+            s.eval("[1 / (i - 2) for i in range(3)]", "stack")
+        self.assertEqual(s._scopes, [])
+        self.assertEqual(s.eval("[x for i in range(2)]", "stack"), [2, 2])
+
+    def test_cache(self):
+        for expr in (
+            "mk.grav_pot_esc_spd(mass=20, radius=5) + mk.force(40, 45)",
+            "Sine(1) + Cosine(2) * Tangent(1) + SlopeFormula(1, b=2, c=3, d=4)",
+        ):
+            with self.subTest(expr=expr):
+                self.assertEqual(evaluate(expr, "tests/cache", engine="stack"), evaluate(expr, "tests/cache"))
+
+
+class AsyncTest(unittest.TestCase):
+    """To ensure that evaluate_async runs cheap expressions inline, the others in a worker it can cancel"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        env_path = self.tmp.name + "/env"
+        self.cache_path = self.tmp.name + "/cache"
+        os.mkdir(env_path)
+        os.mkdir(self.cache_path)
+
+        formula = "0 if n <= 0 else spin(n - 1)"
+        data = {"_id": "", "owner_id": "", "name": "spin", "variables": ["n"], "formula": formula, "memo_size": 0}
+        with open(f"{env_path}/macro.spin.json", "w") as json_file:
+            json.dump(data, json_file)
+        resolve(env_path, self.cache_path)
+        self.evaluator = AsyncEvaluator(self.cache_path, workers=1, inline_steps=100)
+
+    def tearDown(self) -> None:
+        self.evaluator.close()
+        self.tmp.cleanup()
+
+    def test_inline(self):
+        self.assertEqual(asyncio.run(self.evaluator.evaluate("spin(3) + 1")), 1)
+        self.assertEqual(self.evaluator._workers, [])
+        with self.assertRaises(BudgetExceeded):  # the steps asked for, not worth a worker
+            asyncio.run(self.evaluator.evaluate("spin(50)", max_steps=50))
+
+    def test_offloaded(self):
+        async def run():
+            self.assertEqual(await self.evaluator.evaluate("spin(200) + 2", "stack"), 2)
+            self.assertEqual(len(self.evaluator._workers), 1)
+            with self.assertRaises(NameNotDefined) as raised:
+                await self.evaluator.evaluate("spin(200) + x", "stack")
+            self.assertEqual((raised.exception.name, raised.exception.expression), ("x", "spin(200) + x"))
+            with self.assertRaises(BudgetExceeded):
+                await self.evaluator.evaluate("spin(1000)", "stack", max_steps=5000)
+
+        asyncio.run(run())
+        processes = [worker.process for worker in self.evaluator._workers]
+        self.evaluator.close()
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_timeout(self):
+        # the worker gets the time left after trying inline
+        offload = mock.AsyncMock(return_value=0)
+        with mock.patch.object(self.evaluator, "_offload", offload):
+            asyncio.run(self.evaluator.evaluate("spin(200)", timeout=5))
+        timeout = offload.call_args.args[3]
+        self.assertLess(timeout, 5)
+        self.assertGreater(timeout, 0)
+
+    def test_cancel(self):
+        async def run():
+            await self.evaluator.evaluate("spin(200)", "stack")
+            pid = self.evaluator._workers[0].process.pid
+
+            task = asyncio.ensure_future(self.evaluator.evaluate("spin(10 ** 7)", "stack", max_steps=10**9))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+            # the evaluation stopped in the worker, it answers the next one
+            start = time.monotonic()
+            self.assertEqual(await self.evaluator.evaluate("spin(300)", "stack"), 0)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(self.evaluator._workers[0].process.pid, pid)
+
+        asyncio.run(run())
+
+
+class DependencyGraphTest(unittest.TestCase):
+    """To ensure that the dependency graph orders and finds the dependents of names"""
+
+    def setUp(self) -> None:
+        self.graph = DependencyGraph({"c": {"b", "x"}, "b": {"a", "b"}, "a": {"math"}, "d": set()})
+
+    def test_dependents(self):
+        self.assertEqual(self.graph.dependents({"a"}), {"b", "c"})
+        self.assertEqual(self.graph.dependents({"math"}), {"a", "b", "c"})
+        self.assertEqual(self.graph.dependents({"d"}), set())
+
+    def test_order(self):
+        self.assertEqual(self.graph.order(), ["a", "b", "c", "d"])
+        self.assertEqual(self.graph.order(["d", "c", "b"]), ["d", "b", "c"])
+
+    def test_cycle(self):
+        graph = DependencyGraph({"a": {"b"}, "b": {"a"}})
+        self.assertEqual(graph.order(), ["b", "a"])
+        self.assertEqual(graph.dependents({"a"}), {"b"})
+
+
+class OptimizerTest(unittest.TestCase):
+    """To ensure that optimized formulas give the same results, bit for bit"""
+
+    FORMULAS = [
+        "2 * math.pi * r",
+        "(4 / 3) * math.pi * r ** 3",
+        "math.pi * r ** 2",
+        "math.sqrt(2) / r + 10 ** 2",
+        "r ** 2 - r ** 3 if 1 < 2 < 3 else 0",
+        "-r ** 2 + (3 > 4 or r)",
+        "math.factorial(5) * r",
+    ]
+
+    def evaluate(self, formula, r, optimized):
+        transform = (lambda node: optimize(node, variables=["r"])) if optimized else None
+        parsed = ParsedExpression(formula, transform=transform)
+        try:
+            result = SimpleEval(names={"r": r}, functions=DEFAULT_PACKAGES).eval(parsed)
+        except Exception as exc:
+            return type(exc)
+        return type(result), repr(result)
+
+    def test_same_results(self):
+        for formula in self.FORMULAS:
+            for r in (0, 7, -3, 1000, 1001, 2.5, -0.1, 1e200, True):
+                with self.subTest(formula=formula, r=r):
+                    self.assertEqual(self.evaluate(formula, r, True), self.evaluate(formula, r, False))
+
+    def test_folded(self):
+        node = optimize(ParsedExpression("2 * math.pi * r").node, variables=["r"])
+        self.assertEqual(node.value.left.value, 2 * math.pi)
+
+        node = optimize(ParsedExpression("r ** 2 + x ** 3 + r ** 4").node, variables=["r"])
+        self.assertIsInstance(node.value.left.left.op, Square)
+        self.assertIsInstance(node.value.left.right.op, Cube)
+        self.assertIsInstance(node.value.right.op, ast.Pow)
+
+    def test_errors_kept(self):
+        parsed = ParsedExpression("1 + 10001 ** 2", transform=optimize)
+        self.assertIsInstance(parsed.node.value.right, ast.BinOp)
+        self.assertRaises(NumberTooHigh, SimpleEval().eval, parsed)
+
+    def test_math_name(self):
+        node = optimize(ParsedExpression("math.pi * 2").node, variables=["math"])
+        self.assertIsInstance(node.value, ast.BinOp)
+        node = optimize(ParsedExpression("math.pi * 2").node, env={"math": {"pi": 3}})
+        self.assertIsInstance(node.value, ast.BinOp)
+        node = optimize(ParsedExpression("math.pi * 2").node, env={})
+        self.assertIsInstance(node.value, ast.BinOp)
+
+    def test_macros_optimized(self):
+        func = Macro("x", "a", "CircleArea", ["r"], "math.pi * r ** 2").build()
+        self.assertIsInstance(func.formula.node.value.left, ast.Constant)
+        self.assertEqual(func(3), math.pi * 3**2)
+
+
 if __name__ == "__main__":
     unittest.main()